@@ -0,0 +1,69 @@
+'''
+compares the registered page codecs on a corpus of saved HTML/JSON pages: compression ratio, compression and
+decompression speed. Half of the corpus trains a shared dictionary which is then measured on the other half.
+
+usage: python bench_codecs.py <directory with saved pages>
+       python bench_codecs.py --mongo [numPages]     samples pages from the local cache
+'''
+import os
+import sys
+import time
+
+import pagecodecs
+
+
+def loadDirectory(directory):
+    corpus = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            with open(os.path.join(root, name), "rb") as fi:
+                corpus.append(fi.read())
+    return corpus
+
+
+def loadFromMongo(numPages):
+    from storage import getDB
+    corpus = []
+    for page in getDB().webpages.aggregate([{"$sample": {"size": numPages}}]):
+        for field, codec in [("content_raw", page.get("codec", "bz2")), ("content_raw_bz2", "bz2")]:
+            if page.get(field):
+                corpus.append(pagecodecs.decompress(page[field], codec))
+                break
+    return corpus
+
+
+def measure(codecName, corpus):
+    codec = pagecodecs.getCodec(codecName)
+    start = time.perf_counter()
+    blobs = [codec.compress(page) for page in corpus]
+    compressDuration = time.perf_counter() - start
+    start = time.perf_counter()
+    for blob in blobs:
+        codec.decompress(blob)
+    decompressDuration = time.perf_counter() - start
+    rawBytes = sum(len(page) for page in corpus)
+    print("%-20s ratio=%6.2f  compress=%7.1f MB/s  decompress=%7.1f MB/s" % (
+        codecName, rawBytes / sum(len(blob) for blob in blobs), rawBytes / 1e6 / compressDuration,
+        rawBytes / 1e6 / decompressDuration))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == "--mongo":
+        corpus = loadFromMongo(int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
+    else:
+        corpus = loadDirectory(sys.argv[1])
+    training, evaluation = corpus[::2], corpus[1::2]
+    print("%s pages, %.1f MB" % (len(corpus), sum(len(page) for page in corpus) / 1e6))
+    for codecName in sorted(pagecodecs.CODECS):
+        measure(codecName, corpus)
+
+    dictId = pagecodecs.registerDictionary(pagecodecs.trainDictionary(training))
+    smallPages = [page for page in evaluation if len(page) <= 16 * 1024]
+    print("\n%s pages up to 16kB not used for training the dictionary" % len(smallPages))
+    for codecName in pagecodecs.DICTIONARY_CODECS:
+        if codecName in pagecodecs.CODECS:
+            measure(codecName, smallPages)
+            measure("%s:%s" % (codecName, dictId), smallPages)
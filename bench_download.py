@@ -0,0 +1,92 @@
+'''
+benchmark of the page download loop: the loop obtainPage used to run (2 KB iter_content chunks appended with
+data += chunk, then captcha search, hash and compression over the whole body) against pagestream.PageBuffer (adaptive
+reads into a preallocated buffer, captcha search, hash and compression as the bytes arrive). Reports CPU time of the
+downloading thread and peak Python memory per MB downloaded, for bodies of several sizes from a local stub origin.
+
+usage: python bench_download.py [sizeMB ...]
+'''
+import random
+import sys
+import time
+import tracemalloc
+
+import requests
+
+import pagecodecs
+from blobstore import contentHash
+from data_service import PAGE_CODEC, RECAPTCHA_PATTERN, has_captcha
+from pagestream import PageBuffer, expectedLength
+from stuborigin import StubOrigin
+
+MAX_BYTES = 64e6
+WORDS = [b"<div>", b"</div>", b"class", b"href", b"the", b"webcache", b"price", b"\n"] + \
+        [bytes(random.Random(i).choices(b"abcdefghijklmnopqrstuvwxyz", k=8)) for i in range(500)]
+
+
+def pageBody(size):
+    rand = random.Random(size)
+    words = []
+    length = 0
+    while length < size:
+        word = rand.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return b" ".join(words)[:size]
+
+
+def legacyDownload(url):
+    with requests.get(url, stream=True) as req:
+        data = b''
+        for chunk in req.iter_content(2048):
+            data += chunk
+            if len(data) > MAX_BYTES:
+                break
+        has_captcha(data)
+        contentHash(data)
+        return len(pagecodecs.compress(data, PAGE_CODEC))
+
+
+def streamingDownload(url):
+    with requests.get(url, stream=True) as req:
+        body = PageBuffer(MAX_BYTES, expectedLength(req.headers), PAGE_CODEC, 0, RECAPTCHA_PATTERN)
+        while True:
+            chunk = req.raw.read(body.chunkSize, decode_content=True)
+            if not chunk or not body.write(chunk):
+                break
+        body.matches(RECAPTCHA_PATTERN)
+        body.contentHash()
+        return len(body.compressed(PAGE_CODEC))
+
+
+def measure(download, url, sizeMB, repetitions):
+    start = time.thread_time()
+    wallStart = time.perf_counter()
+    for _ in range(repetitions):
+        download(url)
+    cpuPerMB = (time.thread_time() - start) / repetitions / sizeMB * 1000
+    wallPerMB = (time.perf_counter() - wallStart) / repetitions / sizeMB * 1000
+    tracemalloc.start()
+    download(url)
+    peakPerMB = tracemalloc.get_traced_memory()[1] / 1e6 / sizeMB
+    tracemalloc.stop()
+    return cpuPerMB, wallPerMB, peakPerMB
+
+
+def run(sizesMB):
+    print("codec %s" % PAGE_CODEC)
+    print("%8s %-10s %12s %12s %16s" % ("size MB", "loop", "cpu ms/MB", "wall ms/MB", "peak MB per MB"))
+    for sizeMB in sizesMB:
+        body = pageBody(int(sizeMB * 1e6))
+        with StubOrigin() as origin:
+            origin.body = lambda path: body
+            url = "%s/page" % origin.baseURL
+            repetitions = max(1, int(20 / sizeMB))
+            for name, download in [("data+=", legacyDownload), ("PageBuffer", streamingDownload)]:
+                download(url)  # warm up the connection and the codec
+                print("%8s %-10s %12.1f %12.1f %16.2f" % ((sizeMB, name) + measure(download, url, sizeMB,
+                                                                                  repetitions)))
+
+
+if __name__ == '__main__':
+    run([float(arg) for arg in sys.argv[1:]] or [0.1, 1, 5, 20])
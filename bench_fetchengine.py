@@ -0,0 +1,62 @@
+'''
+compares the fetch stage of the fork + ThreadPool path with the asyncio fetch engine against a local stub server.
+No proxies and no MongoDB are involved, only downloading and building the page entries is measured.
+
+usage: python bench_fetchengine.py [numURLs ...]
+'''
+import multiprocessing
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+from data_service import buildPageEntry, obtainPage
+from fetchengine import AsyncFetchEngine, FetchRequest
+from hostscheduler import HostPolicy
+from stuborigin import StubOrigin
+
+
+def fetchChunkWithThreads(chunk):
+    with ThreadPool(min(100, len(chunk))) as thread_pool:
+        thread_pool.starmap(obtainPage, [(urlTuple, "GET", "json", None) for urlTuple in chunk])
+
+
+def runForkPath(urlTuples):
+    chunkLen = max(1, int(len(urlTuples) / os.cpu_count()))
+    processes = [multiprocessing.Process(target=fetchChunkWithThreads, args=(urlTuples[x:x + chunkLen],))
+                 for x in range(0, len(urlTuples), chunkLen)]
+    for proc in processes:
+        proc.start()
+    for proc in processes:
+        proc.join()
+    return len(urlTuples)
+
+
+def runEnginePath(engine, urlTuples):
+    def processBody(req, body, sizeLimitHit, downloadStartTime, responseHeaders, status):
+        return buildPageEntry(req.urlTuple, "json", body, sizeLimitHit, downloadStartTime, responseHeaders)
+
+    results = engine.fetch([FetchRequest(urlTuple[0], urlTuple) for urlTuple in urlTuples], processBody,
+                           maxAttempts=1)
+    return len(results)
+
+
+def benchmark(sizes, latency=0.05):
+    with StubOrigin(latency=latency, size=4096) as origin:
+        # no politeness limits: the stub origin is the only host
+        engine = AsyncFetchEngine(concurrency=2000,
+                                  defaultHostPolicy=HostPolicy(requestsPerSecond=1e6, concurrency=2000))
+        for numURLs in sizes:
+            urlTuples = [("%s/page/%s" % (origin.baseURL, i), "{}") for i in range(numURLs)]
+            for name, run in [("fork+threads", lambda: runForkPath(urlTuples)),
+                              ("asyncio engine", lambda: runEnginePath(engine, urlTuples))]:
+                start = time.perf_counter()
+                fetched = run()
+                duration = time.perf_counter() - start
+                print("%-15s urls=%-6s fetched=%-6s %.2fs  %.0f urls/s" % (name, numURLs, fetched, duration,
+                                                                         numURLs / duration))
+        engine.close()
+
+
+if __name__ == '__main__':
+    benchmark([int(arg) for arg in sys.argv[1:]] or [100, 1000, 3000])
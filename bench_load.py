@@ -0,0 +1,306 @@
+'''
+reproducible load test of the data service with everything on this machine: a stub origin (latency, page size, error
+and captcha rate), a stub forward proxy, the data service in this process and a local mongod or, with --mongomock,
+mongomock in its place. For every batch size and hit ratio it drives WebCacheClient.fetchURLs and POST /fetch with
+fresh urls, hitRatio of them fetched beforehand, and it drives GET /proxies. Every scenario reports throughput,
+p50/p99 latency per call, the peak RSS of this process while it ran and Mongo operations per url. The results and the
+settings of the run go to a JSON file; --baseline prints the change against an earlier one.
+
+Mongo operations are the commands pymongo sent, see metrics.CommandMetrics. mongomock sends none, with it the calls on
+its collections are counted instead, so the two are not comparable. Uses the webdata_loadtest database, dropped before
+and after the run.
+
+usage: python bench_load.py [--mongomock] [--batch-sizes 100,1000] [--hit-ratios 0,0.5,0.9] [--out results.json]
+    [--baseline earlier.json], see --help for the origin settings
+'''
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+from werkzeug.serving import make_server
+
+import storage
+
+storage.MONGO_DATABASE = "webdata_loadtest"
+
+import data_service
+from hostscheduler import HostPolicy
+from hotcache import HotCache
+from metrics import MONGO_COMMAND_SECONDS
+from stuborigin import StubOrigin, StubProxy
+from webcacheclient import WebCacheClient
+
+RSS_SAMPLE_INTERVAL_S = 0.05
+# collection methods counted as one Mongo operation under mongomock
+MONGO_OPERATIONS = {"find", "find_one", "find_one_and_update", "insert_one", "insert_many", "update_one",
+                    "update_many", "replace_one", "delete_one", "delete_many", "bulk_write", "distinct", "aggregate",
+                    "count_documents", "create_index"}
+
+
+class CountingMongo:
+    '''
+    mongomock client counting the operations on its collections
+    '''
+
+    def __init__(self, client):
+        self.client = client
+        self.operations = 0
+        self._lock = threading.Lock()
+
+    def count(self):
+        with self._lock:
+            self.operations += 1
+
+    def __getitem__(self, name):
+        return _CountingDatabase(self, self.client[name])
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class _CountingDatabase:
+    def __init__(self, counter, database):
+        self._counter = counter
+        self._database = database
+
+    def __getitem__(self, name):
+        return _CountingCollection(self._counter, self._database[name])
+
+    def __getattr__(self, name):
+        value = getattr(self._database, name)
+        return _CountingCollection(self._counter, value) if hasattr(value, "find_one") else value
+
+
+class _CountingCollection:
+    def __init__(self, counter, collection):
+        self._counter = counter
+        self._collection = collection
+
+    def __getattr__(self, name):
+        value = getattr(self._collection, name)
+        if name not in MONGO_OPERATIONS:
+            return value
+
+        def counted(*args, **kwargs):
+            self._counter.count()
+            return value(*args, **kwargs)
+
+        return counted
+
+
+class RSSSampler:
+    '''
+    peak resident set size of this process while the with block runs, sampled from /proc. Falls back to the peak of
+    the whole process so far (ru_maxrss) where there is no /proc
+    '''
+
+    def __enter__(self):
+        self.peak = currentRSS()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        if self.peak is None:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL_S):
+            rss = currentRSS()
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+
+def currentRSS():
+    try:
+        with open("/proc/self/status") as fi:
+            for line in fi:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)] if ordered else None
+
+
+class LoadTest:
+    def __init__(self, settings):
+        self.settings = settings
+        self.mongo = None
+        if settings.mongomock:
+            import mongomock  # only needed for this option
+            self.mongo = CountingMongo(mongomock.MongoClient())
+            storage.getClient = lambda: self.mongo
+        self.origin = StubOrigin(settings.latency, settings.size, host="127.0.0.2", errorRate=settings.error_rate,
+                                 captchaRate=settings.captcha_rate)
+        self.proxy = StubProxy()
+        self.server = make_server("127.0.0.1", 0, data_service.app, threaded=True)
+        self.location = "127.0.0.1:%s" % self.server.server_port
+        data_service.fetchEngine.defaultHostPolicy = HostPolicy(requestsPerSecond=1e6, concurrency=1000)
+
+    def mongoOperations(self):
+        return self.mongo.operations if self.mongo is not None else MONGO_COMMAND_SECONDS.count()
+
+    def run(self):
+        storage.getClient().drop_database(storage.MONGO_DATABASE)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        results = []
+        try:
+            with self.origin, self.proxy:
+                storage.getDB().proxies.insert_one({"address": self.proxy.address, "successful_job_completion": 5})
+                with WebCacheClient(self.location) as client:
+                    def clientFetch(urls):
+                        return client.fetchURLs(urls, "loadtest", self.settings.output).values()
+
+                    for batchSize in self.settings.batch_sizes:
+                        for hitRatio in self.settings.hit_ratios:
+                            results.append(self.fetchScenario("client", batchSize, hitRatio, clientFetch))
+                            results.append(self.fetchScenario("fetch", batchSize, hitRatio, self.postFetch))
+                results.append(self.proxiesScenario())
+        finally:
+            self.server.shutdown()
+            data_service.fetchEngine.close()
+        storage.getClient().drop_database(storage.MONGO_DATABASE)
+        return results
+
+    def postFetch(self, urls):
+        response = requests.post("http://%s/fetch/360/loadtest/%s/GET" % (self.location, self.settings.output),
+                                 data={"urls": json.dumps([[url, "{}"] for url in urls])},
+                                 headers={"Accept-Encoding": "gzip"})
+        response.raise_for_status()
+        return response.json()["response"]
+
+    def fetchScenario(self, target, batchSize, hitRatio, fetch):
+        '''
+        calls fetch(urls) settings.calls times, settings.concurrency calls at a time, each with its own batchSize
+        urls. The first hitRatio of every batch are fetched and stored before, the hot cache starts out empty unless
+        --hot-cache is given
+        '''
+        name = "%s batch=%s hit=%s" % (target, batchSize, hitRatio)
+        batches = [["%s/%s/%s/%s/%s/%s" % (self.origin.baseURL, target, batchSize, hitRatio, call, i)
+                    for i in range(batchSize)] for call in range(self.settings.calls)]
+        cachedURLs = [url for urls in batches for url in urls[:round(hitRatio * batchSize)]]
+        if cachedURLs:
+            with WebCacheClient(self.location) as client:
+                client.fetchURLs(cachedURLs, "loadtest", self.settings.output)
+        if not self.settings.hot_cache:
+            data_service.hotCache = HotCache(data_service.HOT_CACHE_MAX_BYTES, data_service.HOT_CACHE_TTL_S)
+
+        def call(urls):
+            start = time.perf_counter()
+            failed = sum(1 for page in fetch(urls) if page.get("error"))
+            return time.perf_counter() - start, failed
+
+        return self.measure(name, call, batches, batchSize, dict(target=target, batch_size=batchSize,
+                                                                 hit_ratio=hitRatio))
+
+    def proxiesScenario(self):
+        url = "http://%s/proxies/%s" % (self.location, self.settings.proxies_per_call)
+
+        def call(_):
+            start = time.perf_counter()
+            requests.get(url).raise_for_status()
+            return time.perf_counter() - start, 0
+
+        return self.measure("proxies", call, range(self.settings.proxy_calls), 1, dict(target="proxies"))
+
+    def measure(self, name, call, arguments, urlsPerCall, fields):
+        originRequests = sum(self.origin.requestCounts.values())
+        operations = self.mongoOperations()
+        with RSSSampler() as rss:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(self.settings.concurrency) as executor:
+                outcomes = list(executor.map(call, arguments))
+            duration = time.perf_counter() - start
+        latencies = [latency * 1000 for latency, _ in outcomes]
+        numURLs = len(outcomes) * urlsPerCall
+        result = dict(fields, scenario=name, calls=len(outcomes), urls=numURLs, duration_s=round(duration, 3),
+                      calls_per_s=round(len(outcomes) / duration, 2), urls_per_s=round(numURLs / duration, 1),
+                      p50_ms=round(percentile(latencies, 0.5), 1), p99_ms=round(percentile(latencies, 0.99), 1),
+                      max_ms=round(max(latencies), 1), peak_rss_mb=round(rss.peak / 1e6, 1),
+                      mongo_ops_per_url=round((self.mongoOperations() - operations) / numURLs, 3),
+                      origin_requests=sum(self.origin.requestCounts.values()) - originRequests,
+                      failed_urls=sum(failed for _, failed in outcomes))
+        print("%-28s %7.1f calls/s %8.1f urls/s  p50 %8.1fms  p99 %8.1fms  rss %7.1fMB  mongo ops/url %6.2f  "
+              "failed %s" % (name, result["calls_per_s"], result["urls_per_s"], result["p50_ms"], result["p99_ms"],
+                             result["peak_rss_mb"], result["mongo_ops_per_url"], result["failed_urls"]))
+        return result
+
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baselineFile):
+    with open(baselineFile) as fi:
+        baseline = {result["scenario"]: result for result in json.load(fi)["results"]}
+    print("\nchange against %s" % baselineFile)
+    for result in results:
+        before = baseline.get(result["scenario"])
+        if before is None:
+            continue
+        print("%-32s %+7.1f%% urls/s  %+7.1f%% p99  %+7.1f%% mongo ops/url" % tuple(
+            [result["scenario"]] + [(result[key] / before[key] - 1) * 100 if before[key] else 0.0
+                                    for key in ["urls_per_s", "p99_ms", "mongo_ops_per_url"]]))
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description="load test of the data service against local stubs")
+    parser.add_argument("--mongomock", action="store_true", help="use mongomock instead of the local mongod")
+    parser.add_argument("--batch-sizes", type=lambda value: [int(size) for size in value.split(",")],
+                        default=[100, 1000])
+    parser.add_argument("--hit-ratios", type=lambda value: [float(ratio) for ratio in value.split(",")],
+                        default=[0.0, 0.5, 0.9])
+    parser.add_argument("--calls", type=int, default=8, help="calls per scenario, each with its own batch")
+    parser.add_argument("--concurrency", type=int, default=4, help="calls in flight at a time")
+    parser.add_argument("--hot-cache", action="store_true", help="keep the pages fetched beforehand in the hot cache")
+    parser.add_argument("--output", default="xml", help="xml pages are checked for captchas, json ones are not")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds the origin takes per page")
+    parser.add_argument("--size", type=int, default=8192, help="bytes per page")
+    parser.add_argument("--error-rate", type=float, default=0.01,
+                        help="share of pages whose first request is dropped")
+    parser.add_argument("--captcha-rate", type=float, default=0.01,
+                        help="share of pages whose first request gets a captcha")
+    parser.add_argument("--proxy-calls", type=int, default=500)
+    parser.add_argument("--proxies-per-call", type=int, default=100)
+    parser.add_argument("--out", default="bench_load_%s.json" % datetime.now().strftime("%Y%m%d_%H%M%S"))
+    parser.add_argument("--baseline", help="results file of an earlier run to compare with")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    settings = parseArguments(argv)
+    started = datetime.now()
+    results = LoadTest(settings).run()
+    with open(settings.out, "w") as fo:
+        json.dump({"started": started.isoformat(), "commit": gitCommit(), "python": platform.python_version(),
+                   "platform": platform.platform(), "mongo": "mongomock" if settings.mongomock else "mongod",
+                   "fetch_engine": data_service.FETCH_ENGINE, "settings": vars(settings), "results": results},
+                  fo, indent=2)
+    print("results written to %s" % settings.out)
+    if settings.baseline:
+        compare(results, settings.baseline)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
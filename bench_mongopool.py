@@ -0,0 +1,52 @@
+'''
+load test for the shared MongoDB pool. Writes and reads page entries from many threads the way the fetch stage does,
+once with a fresh MongoClient per write (the old behaviour) and once through storage.getDB(), and reports the
+connections opened per URL. Needs a local mongod; uses the webdata_loadtest database.
+
+usage: python bench_mongopool.py [numURLs]
+'''
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pymongo
+
+import storage
+from storage import PoolMetrics
+
+
+def pageEntry(i):
+    return {"urlKey": "http://loadtest/%s/" % i, "format": "json", "creation_date": datetime.now(),
+            "content_raw_bz2": b"x" * 512}
+
+
+def writeWithFreshClient(i, metrics):
+    client = pymongo.MongoClient(storage.MONGO_LOCATION, event_listeners=[metrics])
+    entry = pageEntry(i)
+    client.webdata_loadtest.webpages.replace_one({"urlKey": entry["urlKey"]}, entry, upsert=True)
+    client.close()
+
+
+def writeWithPool(i):
+    entry = pageEntry(i)
+    storage.getClient().webdata_loadtest.webpages.replace_one({"urlKey": entry["urlKey"]}, entry, upsert=True)
+
+
+def run(name, numURLs, write, metrics):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(100) as executor:
+        list(executor.map(write, range(numURLs)))
+    duration = time.perf_counter() - start
+    stats = metrics.snapshot()
+    print("%-12s urls=%-6s %.2fs  connections=%-6s connections/url=%.3f  avg wait=%.2fms" % (
+        name, numURLs, duration, stats["connections_created"], stats["connections_created"] / numURLs,
+        stats["avg_wait_ms"]))
+
+
+if __name__ == '__main__':
+    numURLs = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    freshMetrics = PoolMetrics()
+    run("fresh client", numURLs, lambda i: writeWithFreshClient(i, freshMetrics), freshMetrics)
+    run("shared pool", numURLs, writeWithPool, storage.poolMetrics)
+    storage.getClient().drop_database("webdata_loadtest")
@@ -0,0 +1,81 @@
+'''
+compares the JSON/base64 encoding of /fetch with the binary frame transport: bytes on the wire, service-side encoding
+and client-side decoding throughput for a batch of compressed pages.
+
+usage: python bench_transport.py [numPages] [pageSize]
+'''
+import base64
+import io
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import pagecodecs
+from data_service import app, encodePage, framePage
+from webcacheclient import decodeContent, readFrames
+
+
+def makePages(numPages, pageSize):
+    pages = []
+    for i in range(numPages):
+        content = json.dumps({"id": i, "text": os.urandom(pageSize // 4).hex()}).encode()
+        pages.append({"urlKey": "http://bench/%s/" % i, "urlTuple": ["http://bench/%s" % i, "{}"], "format": "json",
+                      "size": pageSize, "creation_date": datetime.now(), "category": "bench",
+                      "content_raw": pagecodecs.compress(content), "codec": pagecodecs.DEFAULT_CODEC})
+    return pages
+
+
+def decodePage(pageData, output):
+    '''
+    decodes a page record of the JSON transport the way a client of it would, WebCacheClient only reads frames
+    :return: cache-result with "content" or None if the record carries no content
+    '''
+    target_field = "content_bz2" if "content_bz2" in pageData and pageData[
+        "content_bz2"] is not None else "content_raw" if "content_raw" in pageData else "content_raw_bz2"
+    if target_field not in pageData:
+        print("there was a problem processing URL %s" % pageData.get("urlKey"))
+        return None
+    return decodeContent(pageData, target_field, base64.b64decode(pageData.pop(target_field)[2:]), output)
+
+
+def encodeJSON(pages):
+    with app.app_context():
+        return json.dumps({"response": [json.loads(app.json.dumps(encodePage(dict(page), pagecodecs.CODECS)))
+                                        for page in pages]}).encode()
+
+
+def decodeJSON(body):
+    for pageData in json.loads(body)["response"]:
+        decodePage(pageData, "json")
+
+
+def encodeFrames(pages):
+    with app.app_context():
+        return b"".join(chunk for page in pages for chunk in framePage(dict(page)))
+
+
+def decodeFrames(body):
+    for pageData, blob in readFrames(io.BytesIO(body)):
+        decodeContent(pageData, pageData.pop("content_field"), blob, "json")
+
+
+def measure(function, argument):
+    start = time.perf_counter()
+    result = function(argument)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    numPages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    pageSize = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    pages = makePages(numPages, pageSize)
+    blobBytes = sum(len(page["content_raw"]) for page in pages)
+    print("%s pages, %.1f MB of compressed content" % (numPages, blobBytes / 1e6))
+    for name, encode, decode in [("json+base64", encodeJSON, decodeJSON), ("frames", encodeFrames, decodeFrames)]:
+        body, encodeDuration = measure(encode, pages)
+        _, decodeDuration = measure(decode, body)
+        print("%-12s wire=%.1f MB (%.2fx content)  encode=%.0f MB/s  decode=%.0f MB/s" % (
+            name, len(body) / 1e6, len(body) / blobBytes, blobBytes / 1e6 / encodeDuration,
+            blobBytes / 1e6 / decodeDuration))
@@ -0,0 +1,36 @@
+'''
+microbenchmark of url key computation: the furl implementation dbNormalizeURL used to be, the urllib.parse fast path
+on its own, and dbNormalizeURL with a cold and a warm memo cache.
+
+usage: python bench_urlkeys.py [numURLs]
+'''
+import random
+import sys
+import time
+
+import webcacheclient
+from test_webcacheclient import realisticURL, referenceNormalizeURL
+
+
+def measure(name, normalize, urls):
+    start = time.perf_counter()
+    for url in urls:
+        normalize(url)
+    duration = time.perf_counter() - start
+    print("%-22s %8.2f us/url  %9.0f urls/s" % (name, duration / len(urls) * 1e6, len(urls) / duration))
+
+
+def run(numURLs=100000):
+    rand = random.Random(0)
+    urls = [realisticURL(rand) for _ in range(numURLs)]
+    lowerLinks = [url.lower().strip().replace("https://", "http://") for url in urls]
+    measure("furl (before)", referenceNormalizeURL, urls)
+    measure("fast path only", webcacheclient._fastNormalizeURL, lowerLinks)
+    webcacheclient._normalizeURLKey.cache_clear()
+    measure("dbNormalizeURL cold", webcacheclient.dbNormalizeURL, urls)
+    measure("dbNormalizeURL warm", webcacheclient.dbNormalizeURL, urls)
+    print(webcacheclient._normalizeURLKey.cache_info())
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
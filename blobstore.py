@@ -0,0 +1,206 @@
+import hashlib
+from collections import Counter, OrderedDict
+
+import pymongo
+
+from storage import BulkWriteBuffer, getDB
+
+BLOB_COLLECTION = "blobs"
+BLOB_FIELDS = ["content_raw", "codec"]
+BLOB_BATCH_SIZE = 100
+
+
+def contentHash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class PageWriteBuffer(BulkWriteBuffer):
+    '''
+    BulkWriteBuffer for webpages storing page bodies content-addressed. The compressed body of a page with a
+    content_hash goes into the blobs collection under that hash, together with the number of pages referring to it,
+    and the page document only keeps the hash. Identical bodies of different url keys are stored once.
+
+    reference counts are kept on every flush: pages that now point to another blob release their old one, and blobs
+    nobody refers to anymore are deleted. A flush that fails without telling which of its pages went in may count a
+    reference twice, which only keeps a blob around longer than necessary.
+    '''
+
+    def __init__(self, collectionName: str = "webpages", keyField: str = "urlKey", maxSize: int = 500,
+                 maxDelay: float = 1.0, nTries: int = 3, blobCollectionName: str = BLOB_COLLECTION):
+        super().__init__(collectionName, keyField, maxSize, maxDelay, nTries)
+        self.blobCollectionName = blobCollectionName
+        self.blobsWritten = 0
+        self.blobsReused = 0
+
+    def _write(self, docs, updates):
+        db = getDB()
+        pages, blobs = {}, {}
+        for key, doc in docs.items():
+            if doc.get("content_hash") and doc.get("content_raw") is not None:
+                doc = dict(doc)  # the caller may still serve the page, don't take its content away
+                content, codec = doc.pop("content_raw"), doc.pop("codec")
+                blobs.setdefault(doc["content_hash"], {"content_raw": content, "codec": codec, "size": doc.get("size"),
+                                                       "stored_size": len(content)})
+            pages[key] = doc
+
+        oldHashes = {page[self.keyField]: page["content_hash"] for page in db[self.collectionName].find(
+            {self.keyField: {"$in": list(pages)}, "content_hash": {"$exists": True}},
+            {self.keyField: 1, "content_hash": 1})}
+        changed = {key: page for key, page in pages.items() if page.get("content_hash") != oldHashes.get(key)}
+        added = self._references(changed)
+
+        blobOperations = [pymongo.UpdateOne({"_id": hashValue}, {"$setOnInsert": blobs[hashValue],
+                                                                  "$inc": {"refcount": count}}, upsert=True)
+                          if hashValue in blobs else
+                          pymongo.UpdateOne({"_id": hashValue}, {"$inc": {"refcount": count}})
+                          for hashValue, count in added.items()]
+        if blobOperations:
+            # blobs first: a page must never point to a blob that isn't there yet
+            try:
+                upserted = db[self.blobCollectionName].bulk_write(blobOperations, ordered=False).upserted_count
+            except pymongo.errors.BulkWriteError as e:
+                # another process inserted the same blob at the same time: now it exists, so the retry increments it
+                upserted = e.details.get("nUpserted", 0)
+                db[self.blobCollectionName].bulk_write([blobOperations[error["index"]] for error in
+                                                        e.details["writeErrors"]], ordered=False)
+            self.blobsWritten += upserted
+            self.blobsReused += len(blobOperations) - upserted
+        try:
+            super()._write(pages, updates)
+        except pymongo.errors.BulkWriteError as e:
+            rejected, _ = self._rejected(pages, updates, e)
+            self._settleReferences(db, changed, rejected, oldHashes)
+            raise
+        except Exception:
+            # no telling which pages went in: those that point to their new blob now did
+            stored = self._stored(db, changed)
+            self._settleReferences(db, changed, [key for key in changed if key not in stored], oldHashes)
+            raise
+        self._settleReferences(db, changed, (), oldHashes)
+
+    @staticmethod
+    def _references(pages):
+        return Counter(page["content_hash"] for page in pages.values() if page.get("content_hash"))
+
+    def _stored(self, db, pages):
+        stored = db[self.collectionName].find({self.keyField: {"$in": list(pages)}},
+                                              {self.keyField: 1, "content_hash": 1})
+        return {page[self.keyField] for page in stored
+                if page.get("content_hash") == pages[page[self.keyField]].get("content_hash")}
+
+    def _settleReferences(self, db, changed, rejected, oldHashes):
+        '''
+        written pages release the blob they referred to before. Rejected pages still refer to that one, they give back
+        the reference to their new blob, which the retry of their write counts again
+        '''
+        released = Counter(oldHashes[key] for key in changed if key not in rejected and key in oldHashes) + \
+            self._references({key: changed[key] for key in rejected if key in changed})
+        if released:
+            db[self.blobCollectionName].bulk_write(
+                [pymongo.UpdateOne({"_id": hashValue}, {"$inc": {"refcount": -count}})
+                 for hashValue, count in released.items()], ordered=False)
+            self._deleteUnreferenced(db, list(released))
+
+    def _deleteUnreferenced(self, db, hashValues):
+        # the reference count can be off after retried flushes, so check the pages before deleting
+        referenced = set(db[self.collectionName].distinct("content_hash", {"content_hash": {"$in": hashValues}}))
+        unreferenced = [hashValue for hashValue in hashValues if hashValue not in referenced]
+        if unreferenced:
+            db[self.blobCollectionName].delete_many({"_id": {"$in": unreferenced}, "refcount": {"$lte": 0}})
+
+    def stats(self):
+        return dict(super().stats(), blobs_written=self.blobsWritten, blobs_reused=self.blobsReused)
+
+
+class ResponseBlobs:
+    '''
+    blobs of one response, loaded from Mongo once per batch of BLOB_BATCH_SIZE pages. With a dedupe window (the frame
+    transport), a page whose blob is among the last `dedupeWindow` distinct blobs the response sent or referred to is
+    sent as a reference to it: its blob is neither loaded nor sent again. The client keeps the same window, see
+    webcacheclient.resolveContentRefs, so a response of any length holds at most dedupeWindow blobs on either side.
+    '''
+
+    def __init__(self, dedupeWindow: int = None):
+        self.dedupeWindow = dedupeWindow
+        self.sent = OrderedDict()  # hashes in the window, the least recently used first
+        self._loaded = {}
+
+    def attach(self, db, pages):
+        '''
+        :param pages: iterable of page documents, those stored by hash come without content
+        :return: generator of the pages with the content of their blob, except those that are likely to go out as a
+            reference. Pass every page to send() before it goes out, and to load() if it still needs its blob then
+        '''
+        batch = []
+        for page in pages:
+            batch.append(page)
+            if len(batch) >= BLOB_BATCH_SIZE:
+                yield from self._attachBatch(db, batch)
+                batch = []
+        yield from self._attachBatch(db, batch)
+
+    def _attachBatch(self, db, pages):
+        missing = {page["content_hash"] for page in pages if self._needsBlob(page) and not self.isReference(page)}
+        if missing:
+            for blob in db[BLOB_COLLECTION].find({"_id": {"$in": list(missing)}}, dict.fromkeys(BLOB_FIELDS, 1)):
+                self._loaded[blob["_id"]] = blob
+        for page in pages:
+            if self._needsBlob(page) and page["content_hash"] in missing:
+                self._attachBlob(page, self._loaded.get(page["content_hash"]))
+            yield page
+        self._loaded.clear()  # everything loaded went out with this batch, don't keep the blobs of a whole response
+
+    def load(self, db, page):
+        '''
+        attaches the blob of a page attach() expected to go out as a reference, but whose blob left the window since
+        '''
+        if self._needsBlob(page):
+            self._attachBlob(page, db[BLOB_COLLECTION].find_one({"_id": page["content_hash"]},
+                                                                 dict.fromkeys(BLOB_FIELDS, 1)))
+
+    def _attachBlob(self, page, blob):
+        if blob is None:
+            del page["content_hash"]  # blob is gone: the page gets marked as an error
+        else:
+            page.update({field: blob[field] for field in BLOB_FIELDS})
+
+    def _needsBlob(self, page):
+        return page.get("content_hash") and "content_raw" not in page
+
+    def isReference(self, page) -> bool:
+        return self.dedupeWindow is not None and "error" not in page and page.get("content_hash") in self.sent
+
+    def send(self, page) -> bool:
+        '''
+        moves the window on for a page going out now, pages have to pass in the order of the response
+
+        :return: whether the page goes out as a reference to a blob sent before
+        '''
+        if self.dedupeWindow is None or "error" in page or not page.get("content_hash"):
+            return False
+        reference = self.isReference(page)
+        self.sent[page["content_hash"]] = True
+        self.sent.move_to_end(page["content_hash"])
+        if len(self.sent) > self.dedupeWindow:
+            self.sent.popitem(last=False)
+        return reference
+
+
+def storageReport(db=None):
+    '''
+    :return: dict comparing the bytes the pages refer to with the bytes their deduplicated blobs take up
+    '''
+    db = db if db is not None else getDB()
+    totals = {"blobs": 0, "references": 0, "stored_bytes": 0, "referenced_bytes": 0, "raw_bytes": 0}
+    for group in db[BLOB_COLLECTION].aggregate([{"$group": {
+            "_id": None, "blobs": {"$sum": 1}, "references": {"$sum": "$refcount"},
+            "stored_bytes": {"$sum": "$stored_size"},
+            "referenced_bytes": {"$sum": {"$multiply": ["$stored_size", "$refcount"]}},
+            "raw_bytes": {"$sum": {"$multiply": ["$size", "$refcount"]}}}}]):
+        totals.update({field: group[field] for field in totals})
+    totals["pages"] = db.webpages.estimated_document_count()
+    totals["inline_pages"] = db.webpages.count_documents({"content_hash": {"$exists": False}})
+    totals["saved_bytes"] = totals["referenced_bytes"] - totals["stored_bytes"]
+    totals["dedup_ratio"] = round(totals["referenced_bytes"] / totals["stored_bytes"], 3) \
+        if totals["stored_bytes"] else 1.0
+    return totals
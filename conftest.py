@@ -0,0 +1,35 @@
+import pytest
+
+import data_service
+import storage
+from hostscheduler import HostPolicy
+from hotcache import HotCache
+from proxyhandling import ProxyPool
+from stuborigin import StubProxy
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    '''
+    fresh mongomock database in place of the local mongod, for everything that goes through storage.getClient()
+    '''
+    mongomock = pytest.importorskip("mongomock")
+    client = mongomock.MongoClient()
+    monkeypatch.setattr(storage, "getClient", lambda: client)
+    return client[storage.MONGO_DATABASE]
+
+
+@pytest.fixture
+def service(mongo, monkeypatch):
+    '''
+    data_service on mongomock with an empty hot cache, fetching through a local stub proxy without rate limits. Stub
+    origins for the tests go on 127.0.0.2, the client takes a shortcut for localhost urls
+    '''
+    monkeypatch.setattr(data_service, "hotCache", HotCache(0))
+    monkeypatch.setattr(data_service, "proxyPool", ProxyPool())
+    monkeypatch.setattr(data_service, "jobRunnerStarted", True)  # tests that need the job workers start them
+    monkeypatch.setattr(data_service.fetchEngine, "defaultHostPolicy", HostPolicy(requestsPerSecond=1e6,
+                                                                                   concurrency=1000))
+    with StubProxy() as proxy:
+        mongo.proxies.insert_one({"address": proxy.address, "successful_job_completion": 5})
+        yield data_service
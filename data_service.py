@@ -1,51 +1,179 @@
 #!flask/bin/python
 import os
 import sys
-from multiprocessing.pool import ThreadPool
 
-from requests.exceptions import ProxyError, ConnectTimeout, SSLError, ConnectionError, ChunkedEncodingError, ReadTimeout
 
+import gzip
+import io
 import json
+import zlib
 from datetime import datetime, timedelta
 import pymongo
 import traceback
-import pickle
 import base64
-from proxyhandling import DBProxyHandler
+from proxyhandling import ProxyPool
+from fetchengine import AsyncFetchEngine, FetchRequest
+from blobstore import PageWriteBuffer, ResponseBlobs, storageReport
+from hostscheduler import HostPolicy
+from hotcache import HotCache
+from jobs import JobRunner, JobStore
+from leases import FetchLeases
+from metrics import (DOWNLOADED_BYTES, HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_FLIGHT, PAGE_STAGE_SECONDS, PAGES_SERVED,
+                     REGISTRY, STORED_BYTES, finishTrace, recentTraces, span, startTrace)
+from profiler import profiler
+from retryengine import AttemptCancelled, RetryEngine
+from revalidation import VALIDATOR_FIELDS, RevalidationStats, conditionalHeaders, validatorFields
 from captcha_exception import CaptchaError
 import multiprocessing
-from bs4 import BeautifulSoup
-import bz2
-from pdfunctions import timeDiffToNow, SkipURL
-from webcacheclient import dbNormalizeURL, isValidURL
+import queue
+import threading
+import time
+from pagestream import PageBuffer, expectedLength
+from pdfunctions import timeDiffToNow
+from webcacheclient import (CODECS_HEADER, CONTENT_REF_WINDOW, FRAMES_MIMETYPE, NDJSON_MIMETYPE, dbNormalizeURL,
+                            encodeFrame, isValidURL)
+from storage import getDB, poolStats
+import pagecodecs
 import requests
 
-from typing import Union
 import os
 import re
 
-from flask import Flask, jsonify, abort, make_response, request
+from flask import Flask, Response, jsonify, abort, g, make_response, request, stream_with_context
 
 app = Flask(__name__)
+GZIP_RESPONSE_MIN_BYTES = 1024
+MAX_REQUEST_BODY_BYTES = 256 * 1024 * 1024  # of gzipped request bodies once inflated
 
-MONGO_LOCATION = "127.0.0.1"
+
+class GzipRequestBodies:
+    """
+    WSGI middleware inflating request bodies sent with Content-Encoding gzip before Flask parses the form. Bodies that
+    are no valid gzip get a 400, those inflating to more than maxBytes a 413
+    """
+
+    def __init__(self, wsgiApp, maxBytes: int = MAX_REQUEST_BODY_BYTES):
+        self.wsgiApp = wsgiApp
+        self.maxBytes = maxBytes
+
+    def __call__(self, environ, startResponse):
+        if environ.get("HTTP_CONTENT_ENCODING", "").lower() == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(environ["wsgi.input"].read(int(environ.get("CONTENT_LENGTH") or 0)),
+                                               self.maxBytes + 1)
+            except (zlib.error, ValueError) as e:
+                return self.reject(environ, startResponse, 400, "request body is no valid gzip: %s" % e)
+            if len(body) > self.maxBytes:
+                return self.reject(environ, startResponse, 413, "request body inflates to more than %s bytes" %
+                                   self.maxBytes)
+            if not decompressor.eof:
+                return self.reject(environ, startResponse, 400, "request body is no valid gzip: it is cut off")
+            environ.update({"wsgi.input": io.BytesIO(body), "CONTENT_LENGTH": str(len(body))})
+            del environ["HTTP_CONTENT_ENCODING"]
+        return self.wsgiApp(environ, startResponse)
+
+    @staticmethod
+    def reject(environ, startResponse, status, message):
+        return Response(json.dumps({"error": message}), status, mimetype="application/json")(environ, startResponse)
+
+
+app.wsgi_app = GzipRequestBodies(app.wsgi_app)
 
 FLASK_IP = "127.0.0.1"
 # FLASK_IP = "10.5.133.201"
 MAX_TIMES_FOR_URL = 20
+# worker threads per process of the "process" fetch path, and seconds after which a slow attempt gets a hedged second
+# one through another proxy (None disables hedging)
+RETRY_WORKERS = 100
+HEDGE_AFTER_S = 10
+
+# "async" runs the fetch stage on the shared event loop of fetchengine, "process" forks workers that fetch on
+# retryengine threads
+FETCH_ENGINE = "async"
+FETCH_CONCURRENCY = 2000
+FETCH_PER_HOST_CONCURRENCY = 100
+# politeness limits of the async engine: requests per second and concurrency per host, see hostscheduler.HostPolicy
+FETCH_PER_HOST_RPS = 20
+HOST_POLICIES = {
+    "nominatim.openstreetmap.org": HostPolicy(requestsPerSecond=1, concurrency=2, minRequestsPerSecond=0.1),
+}
+
+REQUEST_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    'User-Agent': "Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_5_7;en-us) AppleWebKit/530.17 (KHTML, like Gecko) Version/4.0 Safari/530.17"
+}
+
+# codec for newly stored pages. Pages up to DICTIONARY_MAX_PAGE_SIZE bytes are compressed with the shared dictionary
+# in WEBCACHE_DICTIONARY (see pagecodecs.trainDictionary) if one is configured
+PAGE_CODEC = os.environ.get("WEBCACHE_CODEC", pagecodecs.DEFAULT_CODEC)
+PAGE_DICTIONARY_FILE = os.environ.get("WEBCACHE_DICTIONARY")
+DICTIONARY_MAX_PAGE_SIZE = 16 * 1024
+PAGE_MAX_BYTES = 5e6  # larger pages are cut off and stored with cancelled "size limit"
+
+# in-process cache of recently served pages in front of Mongo. 0 disables it
+HOT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+HOT_CACHE_TTL_S = 600
+
+LEASE_POLL_INTERVAL_S = 0.5
+
+PAGE_WRITE_BATCH_SIZE = 500
+PAGE_WRITE_MAX_DELAY_S = 1.0
+# fetched pages waiting for a slow reader of a streamed response: at most FETCH_RESULT_QUEUE_SIZE are queued, and the
+# fetch engine holds at most FETCH_MAX_PENDING downloads of the batch until the queue takes them
+FETCH_RESULT_QUEUE_SIZE = 100
+FETCH_MAX_PENDING = 500
+
+# fetch jobs: results per page of /jobs/<id>/results, see jobs.JobRunner for the workers
+JOB_RESULTS_PAGE_SIZE = 1000
+
+fetchEngine = AsyncFetchEngine(FETCH_CONCURRENCY, maxBytes=PAGE_MAX_BYTES, hostPolicies=HOST_POLICIES,
+                               defaultHostPolicy=HostPolicy(FETCH_PER_HOST_RPS, FETCH_PER_HOST_CONCURRENCY))
+hotCache = HotCache(HOT_CACHE_MAX_BYTES, HOT_CACHE_TTL_S)
+fetchLeases = FetchLeases()
+revalidationStats = RevalidationStats()
+jobStore = JobStore()
+jobRunner = JobRunner(jobStore, lambda job, urlTuples: iterData(urlTuples, job["method"], job["maxAgeDays"],
+                                                                job["category"], job["output"]))
+jobRunnerStarted = False  # see startJobRunner
+jobRunnerStartLock = threading.Lock()
+retryEngine = RetryEngine(RETRY_WORKERS, MAX_TIMES_FOR_URL, hedgeAfter=HEDGE_AFTER_S)
+proxyPool = ProxyPool()
+pageWriteBuffer = PageWriteBuffer("webpages", "urlKey", PAGE_WRITE_BATCH_SIZE, PAGE_WRITE_MAX_DELAY_S)
+pagecodecs.getCodec(PAGE_CODEC)  # fail at startup, not on the first page, if the codec is not installed
+pageDictionaryId = None
+if PAGE_DICTIONARY_FILE:
+    with open(PAGE_DICTIONARY_FILE, "rb") as fi:
+        pageDictionaryId = pagecodecs.registerDictionary(fi.read())
+
+# the stats the components keep anyway, as gauges on /metrics. The workers of the "process" fetch path report to
+# their own copies of these and of the fetch metrics, not to the service's
+REGISTRY.statsGauges("webcache_hot_cache", "hot cache", hotCache.stats)
+REGISTRY.statsGauges("webcache_mongo_pool", "Mongo connection pool", poolStats)
+REGISTRY.statsGauges("webcache_page_writes", "page write buffer", pageWriteBuffer.stats)
+REGISTRY.statsGauges("webcache_fetch_leases", "fetch leases", fetchLeases.stats)
+REGISTRY.statsGauges("webcache_revalidation", "revalidation", revalidationStats.stats)
+REGISTRY.statsGauges("webcache_jobs", "fetch jobs", jobRunner.stats)
 
 
 @app.route("/fetch/<int:maxAgeDays>/<string:category>/<string:output>/<string:method>", methods=["POST"])
 def fetchURL(maxAgeDays, category, output="html", method="GET"):
     try:
-        if output.lower() not in ["xml", "json"]:
-            raise ValueError("we only support XML and JSON as output formats for now")
-
-        urls = json.loads(request.form["urls"])
-        urls = [urlTuple for urlTuple in urls if isValidURL(urlTuple[0])]
-
+        urls = requestedURLs(output)
         print("preparing to fetch data for %s urls.." % len(urls))
-        theData = {"response": list(getData(urls, method, maxAgeDays, category, output)) if len(urls) > 0 else []}
+        accept = request.headers.get("Accept", "")
+        if FRAMES_MIMETYPE in accept:
+            blobs = ResponseBlobs(CONTENT_REF_WINDOW)
+            records = iterData(urls, method, maxAgeDays, category, output, blobs) if len(urls) > 0 else []
+            return Response(stream_with_context(chunk for record in records for chunk in framePage(record, blobs)),
+                            mimetype=FRAMES_MIMETYPE)
+        codecs = acceptedCodecs()
+        if NDJSON_MIMETYPE in accept:
+            records = iterData(urls, method, maxAgeDays, category, output) if len(urls) > 0 else []
+            return Response(stream_with_context(app.json.dumps(encodePage(record, codecs)) + "\n"
+                                                for record in records), mimetype=NDJSON_MIMETYPE)
+        theData = {"response": list(getData(urls, method, maxAgeDays, category, output, codecs))
+                   if len(urls) > 0 else []}
         return make_response(jsonify(**theData))
 
     except Exception as e:
@@ -53,199 +181,592 @@ def fetchURL(maxAgeDays, category, output="html", method="GET"):
         abort(500, e)
 
 
+@app.route("/jobs/<int:maxAgeDays>/<string:category>/<string:output>/<string:method>", methods=["POST"])
+def submitJob(maxAgeDays, category, output, method="GET"):
+    """
+    like /fetch, but returns a job id right away and fetches the urls in the background, see jobs.JobRunner
+    """
+    try:
+        urlsByKey = {}
+        for urlTuple in requestedURLs(output):
+            urlsByKey.setdefault(dbNormalizeURL(urlTuple), tuple(urlTuple))
+        jobId = jobStore.submit(urlsByKey, method, maxAgeDays, category, output)
+        print("submitted fetch job %s for %s urls in category %s" % (jobId, len(urlsByKey), category))
+        jobRunner.start()
+        jobRunner.wake()
+        return make_response(jsonify(job=jobId, total=len(urlsByKey)), 202)
+
+    except Exception as e:
+        print(traceback.format_exc())
+        abort(500, e)
+
+
+@app.route("/jobs/<string:jobId>", methods=["GET"])
+def getJob(jobId):
+    job = jobStore.get(jobId)
+    if job is None:
+        abort(404)
+    return make_response(jsonify(job=job["_id"], state=job["state"], total=job["total"], counts=job["counts"],
+                                 created=job["created"], finished=job.get("finished")))
+
+
+@app.route("/jobs/<string:jobId>/results", methods=["GET"])
+def getJobResults(jobId):
+    """
+    page records of the completed urls of a job in the order they were submitted, each with its position "seq" and
+    "job_status" (cached, fetched, failed). ?after=<seq> continues after a record. Frames and NDJSON stream every
+    record there is, JSON returns up to ?limit records and the seq to continue after as "next"
+    """
+    job = jobStore.get(jobId)
+    if job is None:
+        abort(404)
+    after = request.args.get("after", 0, type=int)
+    accept = request.headers.get("Accept", "")
+    if FRAMES_MIMETYPE in accept:
+        blobs = ResponseBlobs(CONTENT_REF_WINDOW)
+        records = iterJobResults(job, after, sys.maxsize, blobs)
+        return Response(stream_with_context(chunk for record in records for chunk in framePage(record, blobs)),
+                        mimetype=FRAMES_MIMETYPE)
+    if NDJSON_MIMETYPE in accept:
+        records = iterJobResults(job, after, sys.maxsize, ResponseBlobs())
+        return Response(stream_with_context(app.json.dumps(encodePage(record)) + "\n" for record in records),
+                        mimetype=NDJSON_MIMETYPE)
+    limit = min(request.args.get("limit", JOB_RESULTS_PAGE_SIZE, type=int), JOB_RESULTS_PAGE_SIZE)
+    records = [encodePage(record) for record in iterJobResults(job, after, limit, ResponseBlobs())]
+    return make_response(jsonify(response=records, next=records[-1]["seq"] if records else after,
+                                 state=job["state"]))
+
+
 @app.route("/proxies/<int:numProxies>", methods=["GET"])
 def getProxies(numProxies):
-    client = pymongo.MongoClient(MONGO_LOCATION)
-    db = client.webdata
-    ph = DBProxyHandler(db)
-    data = {"response": ph.pick(numProxies)}
+    data = {"response": proxyPool.pick(numProxies)}
     return make_response(jsonify(**data))
 
 
-def getData(urlList: list, method: str, maxAgeDays: int, category, output="xml"):
-    if method.upper() not in ['GET', 'POST']:
-        raise ValueError("only GET/POST supported")
+@app.route("/dictionaries/<string:dictId>", methods=["GET"])
+def getDictionary(dictId):
+    dictionary = pagecodecs.DICTIONARIES.get(dictId)
+    if dictionary is None:
+        stored = getDB().dictionaries.find_one({"_id": dictId})
+        if stored is None:
+            abort(404)
+        dictionary = stored["dictionary"]
+    return Response(dictionary, mimetype="application/octet-stream")
+
+
+@app.route("/stats", methods=["GET"])
+def getStats():
+    return make_response(jsonify(mongo_pool=poolStats(), page_writes=pageWriteBuffer.stats(),
+                                 hot_cache=hotCache.stats(), fetch_leases=fetchLeases.stats(),
+                                 proxy_feedback=proxyPool.aggregator.stats(), hosts=fetchEngine.hostStats(),
+                                 revalidation=revalidationStats.stats(), jobs=jobRunner.stats()))
+
+
+@app.route("/stats/storage", methods=["GET"])
+def getStorageStats():
+    return make_response(jsonify(storageReport()))
+
+
+@app.route("/metrics", methods=["GET"])
+def getMetrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/traces", methods=["GET"])
+def getTraces():
+    """
+    the last traced requests, see traceRequest
+    """
+    return make_response(jsonify(traces=list(recentTraces)))
+
+
+@app.route("/profile/start", methods=["POST"])
+def startProfile():
+    """
+    starts the sampling profiler, ?interval_ms (default 10) and ?max_s (default 300, after which it stops by itself)
+    """
+    started = profiler.start(request.args.get("interval_ms", 10, type=float) / 1000,
+                             request.args.get("max_s", 300, type=float))
+    # 409: it was running already, its samples are kept
+    return make_response(jsonify(profiler.stats()), 200 if started else 409)
+
+
+@app.route("/profile/stop", methods=["POST"])
+def stopProfile():
+    """
+    stops the sampling profiler and returns the sampled stacks in folded format, e.g. for flamegraph.pl
+    """
+    return Response(profiler.stop(), mimetype="text/plain")
+
+
+@app.route("/profile", methods=["GET"])
+def getProfile():
+    return make_response(jsonify(profiler.stats()))
+
+
+def requestedURLs(output):
+    """
+    :return: the valid url tuples of the "urls" form field of the request
+    """
+    if output.lower() not in ["xml", "json"]:
+        raise ValueError("we only support XML and JSON as output formats for now")
+    urls = json.loads(request.form["urls"])
+    return [urlTuple for urlTuple in urls if isValidURL(urlTuple[0])]
+
+
+def acceptedCodecs():
+    """
+    :return: set of the page codecs the client of the request reads, see webcacheclient.CODECS_HEADER
+    """
+    return {codec.strip() for codec in request.headers.get(CODECS_HEADER, "").split(",") if codec.strip()}
+
+
+def iterJobResults(job, after: int, limit: int, blobs: ResponseBlobs):
+    """
+    yields the page records of the completed urls of a job with seq > after, at most limit of them, and an error record
+    for every url that failed (or whose page is gone since)
+    """
+    db = getDB()
+    # the pages were fresh enough when the job got them, they may have aged since
+    maxAgeDays = job["maxAgeDays"] + (datetime.now() - job["created"]).days + 1
+    served = 0
+    while served < limit:
+        urlDocs = jobStore.completedURLs(job["_id"], after, min(JOB_RESULTS_PAGE_SIZE, limit - served))
+        if not urlDocs:
+            return
+        pages = {page["urlKey"]: page for page in blobs.attach(db, findPages(
+            db, [urlDoc["urlKey"] for urlDoc in urlDocs if urlDoc["status"] != "failed"], job["output"], maxAgeDays))}
+        for urlDoc in urlDocs:
+            missing = {"urlTuple": urlDoc["urlTuple"], "urlKey": urlDoc["urlKey"]}
+            page = preparePage(pages.get(urlDoc["urlKey"], missing))
+            page.update(seq=urlDoc["seq"], job_status=urlDoc["status"])
+            yield page
+        after = urlDocs[-1]["seq"]
+        served += len(urlDocs)
+
 
-    urlData = {dbNormalizeURL(urlTuple): {"urlTuple": urlTuple, "urlKey": dbNormalizeURL(urlTuple)} for urlTuple in
-               urlList}
+def getData(urlList: list, method: str, maxAgeDays: int, category, output="xml", codecs=()):
+    return [encodePage(data, codecs) for data in iterData(urlList, method, maxAgeDays, category, output)]
 
-    db = pymongo.MongoClient(MONGO_LOCATION).webdata
-    existing = {data["urlKey"]: data for data in
-                db.webpages.find({"urlKey": {"$in": list(urlData.keys())}, "format": output,
-                                  "creation_date": {"$gt": datetime.now() - timedelta(days=maxAgeDays)}})}
-    urlData.update(existing)
 
-    # for those where we do not have data -> obtain
-    urlKeysToObtain = [urlKey for urlKey in urlData if "format" not in urlData[urlKey]]
-    print("found %s entries already and will need to obtain an additional %s. Total Unique urls: %s" % (
-        len(existing), len(urlKeysToObtain), len(urlData)))
+def iterData(urlList: list, method: str, maxAgeDays: int, category, output="xml", blobs: ResponseBlobs = None):
+    """
+    yields one page record per unique url key: cached pages first, fetched ones as soon as they are stored and
+    finally an error record for every url that could not be obtained.
+
+    :param blobs: loads the content of pages stored by hash, see blobstore.ResponseBlobs
+    """
+    blobs = blobs if blobs is not None else ResponseBlobs()
+    if method.upper() not in ['GET', 'POST']:
+        raise ValueError("only GET/POST supported")
+
+    urlData = {}
+    for urlTuple in urlList:
+        urlKey = dbNormalizeURL(urlTuple)
+        urlData[urlKey] = {"urlTuple": urlTuple, "urlKey": urlKey}
+
+    # the stages leave out the time the consumer takes for the pages they yield, see metrics.span
+    served = set()
+    with span("hot_cache", urls=len(urlData)) as stage:
+        for urlKey in urlData:
+            data = hotCache.get(urlKey, output, maxAgeDays)
+            if data is not None:
+                served.add(urlKey)
+                PAGES_SERVED.inc(1, "hot_cache")
+                with stage.paused():
+                    yield preparePage(data)
+
+    db = getDB()
+    with span("mongo") as stage:
+        for data in blobs.attach(db, findPages(db, [urlKey for urlKey in urlData if urlKey not in served], output,
+                                               maxAgeDays)):
+            hotCache.put(data)
+            served.add(data["urlKey"])
+            PAGES_SERVED.inc(1, "mongo")
+            with stage.paused():
+                yield preparePage(data)
+
+    # for those where we do not have data -> obtain, unless another request is fetching them already
+    missingKeys = [urlKey for urlKey in urlData if urlKey not in served]
+    with span("leases", urls=len(missingKeys)):
+        leaseOwner, urlKeysToObtain, urlKeysInFlight = fetchLeases.acquire(missingKeys, output)
+    print("found %s entries already and will need to obtain an additional %s (%s are being fetched by other requests). "
+          "Total Unique urls: %s" % (len(served), len(urlKeysToObtain), len(urlKeysInFlight), len(urlData)))
     if len(urlKeysToObtain) > 0:
-        global url_counter
-        url_counter = {urlKey: 0 for urlKey in urlKeysToObtain}
-        chunkLen = int(len(urlKeysToObtain) / os.cpu_count())
-        chunkLen = chunkLen if chunkLen != 0 else 1
-        processes = [multiprocessing.Process(target=processURLChunk, args=(
-            urlKeysToObtain[x:x + chunkLen], urlData, method, output, category, maxAgeDays)) for x in
-                     range(0, len(urlKeysToObtain), chunkLen)]
-        for proc in processes:
-            proc.start()
-
-        for proc in processes:
-            proc.join()
-        client = pymongo.MongoClient(MONGO_LOCATION)
-        db = client.webdata
-        remainingData = {data["urlKey"]: data for data in db.webpages.find(
-            {"urlKey": {"$in": list(urlData.keys())}, "format": output,
-             "creation_date": {"$gt": datetime.now() - timedelta(days=maxAgeDays)}})}
-        client.close()
-        urlData.update(remainingData)
-
-    print("finished obtaining data, encoding everything and returning it.")
-
-    for data in urlData:
-        targetField = "content_bz2" if "content_bz2" in urlData[data] and urlData[data][
-            "content_bz2"] is not None else "content_raw_bz2"
-        if targetField in urlData[data]:
-            urlData[data][targetField] = str(base64.b64encode(urlData[data][targetField]))
-        else:
-            urlData[data]["error"] = "could not obtain address!"
-            urlData[data]["content_raw_bz2"] = ""
-        if "_id" in urlData[data]:
-            del urlData[data]["_id"]
-    return urlData.values()
+        with span("fetch", urls=len(urlKeysToObtain), engine=FETCH_ENGINE) as stage:
+            abandonedFetcher = None
+            try:
+                if method.upper() == "GET":
+                    # expired pages that came with validators are only downloaded again if they changed
+                    stalePages = list(findStalePages(db, urlKeysToObtain, output))
+                    for stalePage in stalePages:
+                        urlData[stalePage["urlKey"]]["stale"] = stalePage
+                    revalidationStats.requested(len(stalePages))
+                if FETCH_ENGINE == "async":
+                    fetched = queue.Queue(maxsize=FETCH_RESULT_QUEUE_SIZE)
+                    abandoned = threading.Event()
+
+                    def onPage(data):
+                        # blocks while the reader is behind, unless it went away: the page is stored anyway
+                        while not abandoned.is_set():
+                            try:
+                                fetched.put(data, timeout=0.5)
+                                return
+                            except queue.Full:
+                                pass
+
+                    fetcher = threading.Thread(target=fetchWithEngine, args=(
+                        urlKeysToObtain, urlData, method, output, category, onPage), daemon=True)
+                    fetcher.start()
+                    try:
+                        while fetcher.is_alive() or not fetched.empty():
+                            try:
+                                data = fetched.get(timeout=0.5)
+                            except queue.Empty:
+                                continue
+                            if data["urlKey"] not in served:
+                                hotCache.put(data)
+                                served.add(data["urlKey"])
+                                PAGES_SERVED.inc(1, "fetched")
+                                with stage.paused():
+                                    yield preparePage(dict(data))
+                    finally:
+                        abandoned.set()
+                        if fetcher.is_alive():
+                            abandonedFetcher = fetcher
+                else:
+                    chunkLen = int(len(urlKeysToObtain) / os.cpu_count())
+                    chunkLen = chunkLen if chunkLen != 0 else 1
+                    processes = [multiprocessing.Process(target=processURLChunk, args=(
+                        urlKeysToObtain[x:x + chunkLen], urlData, method, output, category, maxAgeDays)) for x in
+                                 range(0, len(urlKeysToObtain), chunkLen)]
+                    for proc in processes:
+                        proc.start()
+
+                    for proc in processes:
+                        proc.join()
+            finally:
+                if abandonedFetcher is not None:
+                    # the reader went away, the download goes on: keep the leases until it is done, or other requests
+                    # would fetch the same urls again
+                    threading.Thread(target=releaseLeasesAfter, args=(
+                        abandonedFetcher, leaseOwner, urlKeysToObtain, output), daemon=True).start()
+                else:
+                    with span("flush"):
+                        pageWriteBuffer.flush()
+                    # after the flush, so waiters find the pages
+                    fetchLeases.release(leaseOwner, urlKeysToObtain, output)
+        with span("mongo_fetched") as stage:
+            for data in blobs.attach(db, findPages(db, [urlKey for urlKey in urlKeysToObtain if urlKey not in served],
+                                                   output, maxAgeDays)):
+                hotCache.put(data)
+                served.add(data["urlKey"])
+                PAGES_SERVED.inc(1, "fetched")
+                with stage.paused():
+                    yield preparePage(data)
+
+    with span("wait_leases", urls=len(urlKeysInFlight)) as stage:
+        for data in waitForPages(db, urlKeysInFlight, output, maxAgeDays, blobs):
+            hotCache.put(data)
+            served.add(data["urlKey"])
+            PAGES_SERVED.inc(1, "coalesced")
+            with stage.paused():
+                yield preparePage(data)
+
+    print("finished obtaining data, returning the remaining errors.")
+    for urlKey in urlData:
+        if urlKey not in served:
+            PAGES_SERVED.inc(1, "failed")
+            yield preparePage(urlData[urlKey])
+
+
+def releaseLeasesAfter(fetcher, leaseOwner, urlKeys, output):
+    """
+    releases the leases of a fetch whose reader went away, once its fetcher thread is done
+    """
+    fetcher.join()
+    try:
+        pageWriteBuffer.flush()
+    finally:
+        fetchLeases.release(leaseOwner, urlKeys, output)
+
+
+def waitForPages(db, urlKeys, output, maxAgeDays, blobs):
+    """
+    yields the pages other requests are fetching as soon as they are stored. Stops waiting for a key once its lease is
+    gone; a page that is still missing then could not be obtained.
+    """
+    pending = set(urlKeys)
+    while pending:
+        leased = fetchLeases.heldByOthers(pending, output)
+        for data in blobs.attach(db, findPages(db, list(pending), output, maxAgeDays)):
+            pending.discard(data["urlKey"])
+            yield data
+        pending &= leased
+        if pending:
+            time.sleep(LEASE_POLL_INTERVAL_S)
+
+
+def findStalePages(db, urlKeys, output):
+    """
+    :return: validator fields and size of the stored pages for urlKeys that can be revalidated
+    """
+    return db.webpages.find({"urlKey": {"$in": urlKeys}, "format": output, "cancelled": {"$exists": False},
+                             "$or": [{field: {"$exists": True}} for field in VALIDATOR_FIELDS]},
+                            dict({"urlKey": 1, "size": 1, "_id": 0}, **{field: 1 for field in VALIDATOR_FIELDS}))
+
+
+def findPages(db, urlKeys, output, maxAgeDays):
+    if not urlKeys:
+        return []
+    return db.webpages.find({"urlKey": {"$in": urlKeys}, "format": output,
+                             "creation_date": {"$gt": datetime.now() - timedelta(days=maxAgeDays)}})
+
+
+def preparePage(data):
+    targetField = contentField(data)
+    if targetField not in data and not data.get("content_hash"):  # hashed pages may go out as a blob reference
+        data["error"] = "could not obtain address!"
+        data[targetField] = b""
+    if "_id" in data:
+        del data["_id"]
+    return data
+
+
+def contentField(data):
+    if "content_bz2" in data and data["content_bz2"] is not None:
+        return "content_bz2"
+    return "content_raw" if "content_raw" in data else "content_raw_bz2"
+
+
+def encodePage(data, codecs=()):
+    """
+    :param codecs: page codecs the client reads. Pages in other codecs are recompressed to bz2 under content_raw_bz2,
+        which clients from before the codecs read as unparsed content
+    """
+    if "content_raw" in data and data.get("codec", "bz2").partition(":")[0] not in codecs:
+        content, codec = data.pop("content_raw"), data.pop("codec", "bz2")
+        data["content_raw_bz2"] = pagecodecs.compress(pagecodecs.decompress(content, codec), "bz2") if content else b""
+    targetField = contentField(data)
+    data[targetField] = str(base64.b64encode(data[targetField])) if data[targetField] else ""
+    return data
+
+
+def framePage(data, blobs: ResponseBlobs = None):
+    """
+    binary transport: the content blob goes out as it came from Mongo, behind a length-prefixed JSON header. Pages
+    whose blob is in the dedupe window of this response get content_field "content_ref" and an empty blob
+    """
+    if blobs is not None and not blobs.isReference(data):
+        blobs.load(getDB(), data)  # attach left it without content, but its blob has left the window since
+        preparePage(data)
+    if blobs is not None and blobs.send(data):
+        data.pop("content_raw", None)
+        data["content_field"] = "content_ref"
+        return encodeFrame(app.json.dumps(data).encode(), b"")
+    targetField = contentField(data)
+    blob = data.pop(targetField)
+    data["content_field"] = targetField
+    return encodeFrame(app.json.dumps(data).encode(), blob)
+
+
+def fetchWithEngine(urlKeys, urlData, method, output, category, onPage=None):
+    print("fetching %s URL's in category %s on the fetch engine" % (len(urlKeys), category))
+
+    def processBody(req, body, sizeLimitHit, downloadStartTime, responseHeaders, status):
+        result = buildPageEntry(req.urlTuple, output, body, sizeLimitHit, downloadStartTime, responseHeaders, status,
+                                urlData[req.key].get("stale"))
+        result["category"] = category
+        return result
+
+    def storeResult(req, result):
+        updateDBEntry(result, req.urlTuple)
+        if onPage is not None and not result.get("revalidated"):  # getData reads those back from Mongo
+            onPage(result)
+
+    fetchRequests = [FetchRequest(urlKey, urlData[urlKey]["urlTuple"], method,
+                                  dict(REQUEST_HEADERS, **conditionalHeaders(urlData[urlKey].get("stale"))))
+                     for urlKey in urlKeys]
+    results = fetchEngine.fetch(fetchRequests, processBody, proxyPool, MAX_TIMES_FOR_URL, (CaptchaError,), storeResult,
+                                FETCH_MAX_PENDING)
+    print("fetch engine finished %s of %s URL's in category %s" % (len(results), len(urlKeys), category))
 
 
 def processURLChunk(chunk, urlData, method, output, category, maxAgeDays):
     print("process started for %s URL's in category %s" % (len(chunk), category))
     if len(chunk) < 1: return
-    with ThreadPool(min(100, len(chunk))) as thread_pool:
-        thread_pool.starmap(tryNTimesToGetPage,
-                            [(urlKey, urlData[urlKey]["urlTuple"], method, output, category, maxAgeDays) for urlKey in
-                             chunk])
-        print("process finished %s URL's in category %s" % (len(chunk), category))
-
-
-def updateDBEntry(result, urlTuple, nTries=2):
-    client = pymongo.MongoClient(MONGO_LOCATION)
-    db = client.webdata
-    if nTries < 0:
-        return None
-    try:
-        db.webpages.replace_one({"urlKey": dbNormalizeURL(urlTuple)}, result, upsert=True)
-    except pymongo.errors.AutoReconnect:
-        print("pymongo error: could not autoreconnect")
-        updateDBEntry(result, nTries - 1)
-    client.close()
-
-
-def tryNTimesToGetPage(urlKey: str, urlTuple: tuple, method: str, output: str, category: str, maxAgeDays, tries=0,
-                       multiprocessed=False):
-    with pymongo.MongoClient(MONGO_LOCATION) as client:
-        db = client.webdata
-        finished = {data["urlKey"]: data for data in db.webpages.find({"urlKey": {"$in": [urlKey]}, "format": output,
-                                                                       "creation_date": {
-                                                                           "$gt": datetime.now() - timedelta(
-                                                                               days=maxAgeDays)}})}
-    if finished:
-        return
-    print("attempt %s to get URL %s" % (tries, dbNormalizeURL(urlTuple)))
-    if url_counter[urlKey] >= MAX_TIMES_FOR_URL:
-        print("I'm giving up fetching URL %s" % dbNormalizeURL(urlTuple))
-        return
-    with pymongo.MongoClient(MONGO_LOCATION) as client:
-        db = client.webdata
-        ph = DBProxyHandler(db)
-        proxy = ph.pick()
-        try:
-            result = obtainPage(urlTuple, method, output, proxy)
-            result["category"] = category
-            ph.feedback(proxy, 1)
-            updateDBEntry(result, urlTuple)
-            return
-        except (ProxyError, ConnectTimeout, SSLError, ConnectionError, ReadTimeout, ChunkedEncodingError,
-                CaptchaError) as e:
-            ph.feedback(proxy, -1)
-            if not multiprocessed:
-                with ThreadPool(5) as pool:
-                    new_queries = []
-                    for i in range(1, 6):
-                        url_counter[urlKey] = url_counter[urlKey] + 1
-                        new_queries.append(
-                            (urlKey, urlTuple, method, output, category, maxAgeDays, url_counter[urlKey], True))
-                    url_counter[urlKey] = url_counter[urlKey] + 5
-                    pool.starmap(tryNTimesToGetPage, new_queries)
-            else:
-                url_counter[urlKey] = url_counter[urlKey] + 1
-                tryNTimesToGetPage(urlKey, urlTuple, method, output, category, maxAgeDays, url_counter[urlKey], True)
-        except:
-            print("encountered exception on url %s: %s" % (dbNormalizeURL(urlTuple), traceback.format_exc()))
-            return
 
+    def attemptPage(req, proxy, cancelled):
+        result = obtainPage(req.urlTuple, method, output, proxy, cancelled, urlData[req.key].get("stale"))
+        result["category"] = category
+        return result
 
-def obtainPage(urlTuple: tuple, method: str, output: str, proxy: str):
+    try:
+        fetchRequests = [FetchRequest(urlKey, urlData[urlKey]["urlTuple"], method) for urlKey in chunk]
+        results = retryEngine.fetch(fetchRequests, attemptPage, proxyPool,
+                                    lambda req, result: updateDBEntry(result, req.urlTuple))
+        print("process finished %s of %s URL's in category %s" % (len(results), len(chunk), category))
+    finally:
+        pageWriteBuffer.flush()
+        proxyPool.flush()
+
+
+def updateDBEntry(result, urlTuple):
+    # written in bulk, getData flushes before reading the results back
+    if result.get("revalidated"):
+        revalidationStats.notModifiedPage(result["size"])
+        pageWriteBuffer.update(result["urlKey"], {field: result[field] for field in ["creation_date"] + VALIDATOR_FIELDS
+                                                  if field in result})
+    else:
+        pageWriteBuffer.add(result)
+
+
+def obtainPage(urlTuple: tuple, method: str, output: str, proxy: str, cancelled: threading.Event = None,
+               stalePage: dict = None):
+    """
+    :param stalePage: validators of the expired stored page, see findStalePages. makes the request conditional
+    """
     url, dataJson = urlTuple[0], urlTuple[1]
-    headers = {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        'User-Agent': "Mozilla/5.0 (Macintosh; U; Intel Mac OS X 10_5_7;en-us) AppleWebKit/530.17 (KHTML, like Gecko) Version/4.0 Safari/530.17"
-    }
+    headers = dict(REQUEST_HEADERS, **conditionalHeaders(stalePage))
     downloadStartTime = datetime.now()
     requests.packages.urllib3.disable_warnings()
 
     with requests.request(method, url, data=json.loads(dataJson), headers=headers, verify=False, stream=True,
                           proxies={"https": proxy, "http": proxy}, timeout=60) as req:
-        maxsize = 5e6  # max size = 5MB. Will stop afterwards
-        data = b''
-        encounteredSizeLimit = False
-        parsedData = None
-        try:
-            for chunk in req.iter_content(2048):
-                data += chunk
-                if len(data) > maxsize:
-                    raise SkipURL("too much data. I'm limited to %s bytes" % maxsize)
-            try:
-                interpreter = json.loads(data.decode()) if output.lower() == "json" else BeautifulSoup(data, "lxml")
-                if has_captcha(interpreter):
+        # the body is compressed and searched for a captcha while it arrives, see pagestream.PageBuffer
+        body = PageBuffer(PAGE_MAX_BYTES, expectedLength(req.headers), PAGE_CODEC, DICTIONARY_MAX_PAGE_SIZE,
+                          RECAPTCHA_PATTERN if output.lower() != "json" else None)
+        if not body.tooLarge:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    raise AttemptCancelled("another attempt already got %s" % url)
+                chunk = req.raw.read(body.chunkSize, decode_content=True)
+                if not chunk or not body.write(chunk):
+                    break
+                if body.sniffed:
                     raise CaptchaError('Captcha response detected.')
-                parsedData = bz2.compress(pickle.dumps(interpreter))
-            except:
-                pass  # if we cannot parse the data..
-        except SkipURL:
-            encounteredSizeLimit = True
-            pass
-
-        toReturn = {"download_duration_ms": timeDiffToNow(downloadStartTime), "content_bz2": parsedData,
-                    "size": len(data),
-                    "urlTuple": urlTuple, "format": output,
-                    "urlKey": dbNormalizeURL(urlTuple), "creation_date": datetime.now()}
-        if encounteredSizeLimit:
-            toReturn["cancelled"] = "size limit"
-        if parsedData is None:
-            toReturn["cancelled"] = "parsing error"
-            toReturn["content_raw_bz2"] = bz2.compress(data)
-
-        return toReturn
-
-
-def has_captcha(response: Union[json.JSONEncoder, BeautifulSoup]) -> bool:
-    recaptcha_url = re.compile('https?://www.google.com/recaptcha/api.*')
-    if isinstance(response, json.JSONEncoder):
-        pass
-    elif isinstance(response, BeautifulSoup):
-        script_tags = response.find_all('script')
-        for script in script_tags:
-            try:
-                if recaptcha_url.match(script['src']):
-                    return True
-            except KeyError:
-                pass
-        iframe_tags = response.find_all('iframe')
-        for iframe in iframe_tags:
-            try:
-                if recaptcha_url.match(iframe['src']):
-                    return True
-            except KeyError:
-                pass
-    return False
+
+        return buildPageEntry(urlTuple, output, body, body.tooLarge or body.truncated, downloadStartTime,
+                              req.headers, req.status_code, stalePage)
+
+
+def buildPageEntry(urlTuple: tuple, output: str, data: PageBuffer, encounteredSizeLimit: bool,
+                   downloadStartTime: datetime, responseHeaders=None, status: int = 200, stalePage: dict = None):
+    """
+    stores the page as it came over the wire, the client parses it on first access. A 304 on a conditional request
+    gives a "revalidated" entry that only refreshes creation_date and the validators of the stored page.
+
+    download_duration_ms is in milliseconds on pages with download_duration_unit "ms". Older pages have no unit, their
+    download_duration_ms holds microseconds, without the days part
+    """
+    if status == 304 and stalePage is not None:
+        return dict(validatorFields(responseHeaders), urlKey=dbNormalizeURL(urlTuple), format=output,
+                    urlTuple=urlTuple, creation_date=datetime.now(), size=stalePage.get("size"), revalidated=True)
+    DOWNLOADED_BYTES.inc(data.size)
+    if output.lower() != "json":
+        with PAGE_STAGE_SECONDS.time("captcha_check"):
+            hasCaptcha = data.matches(RECAPTCHA_PATTERN)
+        if hasCaptcha:
+            raise CaptchaError('Captcha response detected.')
+
+    codec = PAGE_CODEC
+    if pageDictionaryId is not None and data.size <= DICTIONARY_MAX_PAGE_SIZE:
+        codec = "%s:%s" % (PAGE_CODEC if PAGE_CODEC in pagecodecs.DICTIONARY_CODECS else "zlib", pageDictionaryId)
+    with PAGE_STAGE_SECONDS.time("compress"):
+        content = data.compressed(codec)
+    with PAGE_STAGE_SECONDS.time("hash"):
+        hashValue = data.contentHash()
+    STORED_BYTES.inc(len(content))
+
+    toReturn = {"download_duration_ms": timeDiffToNow(downloadStartTime), "download_duration_unit": "ms",
+                "content_raw": content, "codec": codec,
+                "content_type": responseHeaders.get("Content-Type") if responseHeaders is not None else None,
+                "size": data.size,
+                "urlTuple": urlTuple, "format": output,
+                "content_hash": hashValue, "urlKey": dbNormalizeURL(urlTuple), "creation_date": datetime.now(),
+                **validatorFields(responseHeaders)}
+    if encounteredSizeLimit:
+        toReturn["cancelled"] = "size limit"
+
+    return toReturn
+
+
+RECAPTCHA_PATTERN = re.compile(rb'<(?:script|iframe)\b[^>]*\bsrc\s*=\s*["\']?https?://www\.google\.com/recaptcha/api',
+                               re.IGNORECASE)
+
+
+def has_captcha(data: bytes) -> bool:
+    return RECAPTCHA_PATTERN.search(data) is not None
+
+
+@app.before_request
+def startJobRunner():
+    """
+    creates the job indexes and starts the job workers on the first request, however the app is served. The workers
+    pick up the jobs that were running when the service stopped.
+    """
+    global jobRunnerStarted
+    if jobRunnerStarted:
+        return
+    with jobRunnerStartLock:
+        if jobRunnerStarted:
+            return
+        jobRunner.start()
+        try:
+            jobStore.ensureIndexes()
+        except pymongo.errors.PyMongoError as e:
+            print("could not create the job indexes, trying again on the next request: %s" % e)
+            return
+        jobRunnerStarted = True
+
+
+@app.before_request
+def traceRequest():
+    """
+    times every request into the request metrics. Requests with the header X-Webcache-Trace or ?trace=1 also record
+    the spans of their stages, see metrics.span; the trace is kept for /traces
+    """
+    g.requestStart = time.perf_counter()
+    g.endpoint = request.endpoint or "unknown"
+    HTTP_REQUESTS_IN_FLIGHT.inc(1, g.endpoint)
+    if request.headers.get("X-Webcache-Trace") or request.args.get("trace"):
+        startTrace("%s %s" % (request.method, request.path))
+
+
+@app.after_request
+def finishRequestMetrics(response):
+    # streamed responses are done once their last chunk went out, when the server closes them
+    requestStart, endpoint = g.get("requestStart"), g.get("endpoint")
+    if requestStart is None:
+        return response
+
+    def finish():
+        HTTP_REQUESTS_IN_FLIGHT.dec(1, endpoint)
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - requestStart, endpoint)
+        trace = finishTrace()
+        if trace is not None:
+            print("trace of %s: %s spans in %.1fms" % (trace.name, len(trace.spans),
+                                                       (time.perf_counter() - requestStart) * 1000))
+
+    response.call_on_close(finish)
+    return response
+
+
+@app.after_request
+def gzipResponse(response):
+    """
+    gzips JSON responses for clients that accept it. Streamed responses (NDJSON, frames) go out as they are, their
+    page content is compressed already
+    """
+    if response.is_streamed or "Content-Encoding" in response.headers or \
+            "gzip" not in request.headers.get("Accept-Encoding", ""):
+        return response
+    data = response.get_data()
+    if len(data) >= GZIP_RESPONSE_MIN_BYTES:
+        response.set_data(gzip.compress(data, 5))
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+    return response
 
 
 @app.errorhandler(500)
@@ -254,11 +775,13 @@ def not_found(error):
 
 
 if __name__ == '__main__':
-    client = pymongo.MongoClient(MONGO_LOCATION)
-    db = client.webdata
+    db = getDB()
     db.webpages.create_index([('urlKey', pymongo.ASCENDING)], unique=True)
     db.webpages.create_index([('creation_date', pymongo.ASCENDING)])
-    client.close()
-    url_counter = {}
+    db.webpages.create_index([('content_hash', pymongo.ASCENDING)], sparse=True)
+    if pageDictionaryId is not None:
+        db.dictionaries.replace_one({"_id": pageDictionaryId},
+                                    {"_id": pageDictionaryId, "dictionary": pagecodecs.DICTIONARIES[pageDictionaryId]},
+                                    upsert=True)
     app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
     app.run(host=FLASK_IP, port=9011, debug=True)
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from fetcherrors import classifyError
+from hostscheduler import HostPolicy, HostScheduler
+from metrics import FETCH_ERRORS, FETCH_SECONDS, FETCHES_IN_FLIGHT, PROXY_FETCH_SECONDS
+from pagestream import PageBuffer, expectedLength
+from retryengine import DEFAULT_RETRY_POLICIES, RetryPolicy
+
+DEFAULT_CONCURRENCY = 2000
+DEFAULT_PER_HOST_CONCURRENCY = 100
+DEFAULT_PER_HOST_RPS = 20
+DEFAULT_TIMEOUT_S = 60
+DEFAULT_MAX_BYTES = 5e6
+
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class FetchRequest:
+    def __init__(self, key, urlTuple, method="GET", headers=None):
+        self.key = key
+        self.urlTuple = urlTuple
+        self.method = method
+        self.headers = headers or {}
+
+    @property
+    def url(self):
+        return self.urlTuple[0]
+
+    @property
+    def host(self):
+        return urlsplit(self.url).hostname or ""
+
+
+class AsyncFetchEngine:
+    '''
+    fetches pages on a single event loop living in a background thread. All callers of a process share the loop, the
+    connection pool and the global concurrency limit, so one service process can keep thousands of requests in flight.
+    Requests wait for their host in a HostScheduler before taking a global slot, so rate limited hosts don't block
+    the others.
+
+    :param perHostConcurrency: concurrency of the default host policy, used if defaultHostPolicy is not given
+    :param hostPolicies: dict of host name -> HostPolicy for hosts with limits different from the default policy
+    :param retryPolicies: dict of error class -> retryengine.RetryPolicy overriding DEFAULT_RETRY_POLICIES
+    '''
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, perHostConcurrency: int = DEFAULT_PER_HOST_CONCURRENCY,
+                 timeout: float = DEFAULT_TIMEOUT_S, maxBytes: float = DEFAULT_MAX_BYTES,
+                 defaultHostPolicy: HostPolicy = None, hostPolicies: dict = None, retryPolicies: dict = None):
+        self.concurrency = concurrency
+        self.defaultHostPolicy = defaultHostPolicy or HostPolicy(DEFAULT_PER_HOST_RPS, perHostConcurrency)
+        self.hostPolicies = hostPolicies or {}
+        self.retryPolicies = dict(DEFAULT_RETRY_POLICIES, **(retryPolicies or {}))
+        self.timeout = timeout
+        self.maxBytes = maxBytes
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._globalLimit = None
+        self._scheduler = None
+        self._startLock = threading.Lock()
+
+    def _ensureStarted(self):
+        with self._startLock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="fetch-engine", daemon=True)
+            self._thread.start()
+            asyncio.run_coroutine_threadsafe(self._openSession(), self._loop).result()
+
+    async def _openSession(self):
+        self._globalLimit = asyncio.Semaphore(self.concurrency)
+        self._scheduler = HostScheduler(self.defaultHostPolicy, self.hostPolicies)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=0, ssl=False, ttl_dns_cache=300)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    def hostStats(self):
+        '''
+        :return: dict of host -> current rate, requests in flight, requests started, backoffs and remaining pause
+        '''
+        if self._scheduler is None:
+            return {}
+        return self._scheduler.stats()
+
+    def close(self):
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._thread = None
+
+    def fetch(self, fetchRequests, processBody, proxyPool=None, maxAttempts=20, retryOn=(), onResult=None,
+              maxPending: int = None):
+        '''
+        fetches all requests and blocks until each of them succeeded or used up its attempts.
+
+        :param fetchRequests: list of FetchRequest
+        :param processBody: callable(request, body: pagestream.PageBuffer, sizeLimitHit: bool, downloadStartTime,
+            responseHeaders, status: int) -> result. may raise one of the exceptions in retryOn to have the page
+            fetched again through another proxy
+        :param proxyPool: picks a proxy for every attempt and gets feedback on it, see proxyhandling.ProxyPool. None ->
+            direct connection
+        :param maxAttempts: maximal number of attempts per request
+        :param retryOn: additional exception types raised by processBody that trigger a retry
+        :param onResult: optional callable(request, result), called as soon as a result is ready. Runs on a thread of
+            its own for this call, so an onResult that blocks to apply backpressure holds back no other call
+        :param maxPending: maximal number of requests of this call between the start of their download and the return
+            of onResult. With an onResult that blocks, this bounds the pages held in memory for a slow consumer
+        :return: dict of request key -> result for all successful requests. results handed to onResult are not kept,
+            their keys map to None
+        '''
+        self._ensureStarted()
+        future = asyncio.run_coroutine_threadsafe(
+            self._fetchAll(fetchRequests, processBody, proxyPool, maxAttempts, tuple(retryOn), onResult, maxPending),
+            self._loop)
+        return future.result()
+
+    async def _fetchAll(self, fetchRequests, processBody, proxyPool, maxAttempts, retryOn, onResult, maxPending):
+        results = {}
+        pending = asyncio.Semaphore(maxPending) if maxPending else None
+        resultExecutor = ThreadPoolExecutor(1, thread_name_prefix="fetch-results") if onResult is not None else None
+
+        async def fetchOne(req):
+            if pending is None:
+                return await self._fetchOne(req, processBody, proxyPool, maxAttempts, retryOn, onResult, results,
+                                            resultExecutor)
+            async with pending:
+                await self._fetchOne(req, processBody, proxyPool, maxAttempts, retryOn, onResult, results,
+                                     resultExecutor)
+
+        if proxyPool is not None:
+            # an empty pool loads from Mongo when picking, which must not block the event loop
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, proxyPool.loadIfEmpty)
+            except Exception as e:
+                print("could not load the proxy pool: %s" % e)
+        tasks = [asyncio.ensure_future(fetchOne(req)) for req in fetchRequests]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if resultExecutor is not None:
+                resultExecutor.shutdown(wait=False)
+        return results
+
+    async def _fetchOne(self, req, processBody, proxyPool, maxAttempts, retryOn, onResult, results,
+                        resultExecutor=None):
+        loop = asyncio.get_running_loop()
+        failures = {}
+        for attempt in range(maxAttempts):
+            proxy = None
+            try:
+                proxy = proxyPool.pick(refreshIfEmpty=False) if proxyPool is not None else None
+                async with self._scheduler.slot(req.host), self._globalLimit:
+                    attemptStart = time.perf_counter()
+                    FETCHES_IN_FLIGHT.inc(1, "async")
+                    try:
+                        body, sizeLimitHit, startTime, headers, status = await self._download(req, proxy)
+                    finally:
+                        FETCHES_IN_FLIGHT.dec(1, "async")
+                        latencyMs = (time.perf_counter() - attemptStart) * 1000
+                        FETCH_SECONDS.observe(latencyMs / 1000, req.host)
+                result = await loop.run_in_executor(None, processBody, req, body, sizeLimitHit, startTime, headers,
+                                                    status)
+            except RETRYABLE_ERRORS + retryOn as e:
+                errorClass = classifyError(e)
+                FETCH_ERRORS.inc(1, errorClass)
+                self._scheduler.report(req.host, errorClass)
+                if proxy is not None:
+                    self._feedback(proxyPool, proxy, -1, errorClass=errorClass)
+                failures[errorClass] = failures.get(errorClass, 0) + 1
+                # exceptions from retryOn that classifyError doesn't know are retried right away
+                policy = self.retryPolicies[errorClass] if errorClass != "other" else RetryPolicy(maxAttempts)
+                if failures[errorClass] >= policy.maxAttempts:
+                    break
+                await asyncio.sleep(policy.delay(failures[errorClass]))
+                continue
+            except Exception:
+                print("encountered exception on url %s: %s" % (req.key, traceback.format_exc()))
+                return
+            self._scheduler.report(req.host)
+            if proxy is not None:
+                self._feedback(proxyPool, proxy, 1, latencyMs)
+                PROXY_FETCH_SECONDS.observe(latencyMs / 1000, proxy)
+            try:
+                if onResult is not None:
+                    await loop.run_in_executor(resultExecutor, onResult, req, result)
+                    result = None  # handed over, don't keep every page of a huge batch in memory
+                results[req.key] = result
+            except Exception:
+                print("could not hand over the result for url %s: %s" % (req.key, traceback.format_exc()))
+            return
+        print("I'm giving up fetching URL %s after %s attempts" % (req.key, attempt + 1))
+
+    @staticmethod
+    def _feedback(proxyPool, proxy, counter, latencyMs=None, errorClass=None):
+        try:
+            proxyPool.feedback(proxy, counter, latencyMs, errorClass=errorClass)
+        except Exception as e:
+            print("could not give feedback on proxy %s: %s" % (proxy, e))
+
+    async def _download(self, req, proxy):
+        downloadStartTime = datetime.now()
+        async with self._session.request(req.method, req.url, data=json.loads(req.urlTuple[1]), headers=req.headers,
+                                         proxy=proxy) as resp:
+            # compressing is left to processBody: it runs on a worker thread, not on the event loop
+            body = PageBuffer(self.maxBytes, expectedLength(resp.headers))
+            if body.tooLarge:
+                return body, True, downloadStartTime, resp.headers, resp.status
+            async for chunk in resp.content.iter_any():
+                if not body.write(chunk):
+                    break
+            return body, body.truncated, downloadStartTime, resp.headers, resp.status
@@ -0,0 +1,32 @@
+import asyncio
+
+import aiohttp
+import requests.exceptions
+import urllib3.exceptions
+
+from captcha_exception import CaptchaError
+
+ERROR_CLASSES = ["captcha", "timeout", "ssl", "proxy", "connection", "other"]
+
+
+def classifyError(error: BaseException) -> str:
+    '''
+    maps the exceptions of a failed fetch attempt, from requests as well as from aiohttp, to one of ERROR_CLASSES.
+    Reading a streamed requests response raises the urllib3 exceptions underneath, those are mapped as well
+    '''
+    if isinstance(error, CaptchaError):
+        return "captcha"
+    if isinstance(error, (asyncio.TimeoutError, requests.exceptions.Timeout, aiohttp.ServerTimeoutError,
+                          urllib3.exceptions.TimeoutError)):
+        return "timeout"
+    if isinstance(error, (requests.exceptions.SSLError, aiohttp.ClientSSLError, urllib3.exceptions.SSLError)):
+        return "ssl"
+    if isinstance(error, (requests.exceptions.ProxyError, aiohttp.ClientProxyConnectionError,
+                          aiohttp.ClientHttpProxyError, urllib3.exceptions.ProxyError)):
+        return "proxy"
+    # a body cut off or garbled on the way (ProtocolError, DecodeError, ...) may come through fine on another proxy
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                          requests.exceptions.ContentDecodingError, aiohttp.ClientError,
+                          urllib3.exceptions.HTTPError)):
+        return "connection"
+    return "other"
@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+
+# errors after which a host gets slower: captchas pause the host, connection trouble only lowers its rate
+PAUSING_ERRORS = {"captcha"}
+SLOWING_ERRORS = {"captcha", "connection", "timeout"}
+
+
+class HostPolicy:
+    '''
+    politeness limits for one host
+
+    :param requestsPerSecond: maximal rate of request starts
+    :param concurrency: maximal number of requests in flight
+    :param minRequestsPerSecond: the adaptive rate never drops below this
+    :param baseBackoff: pause after the first captcha in a row, doubled for every further one up to maxBackoff
+    '''
+
+    def __init__(self, requestsPerSecond: float = 20, concurrency: int = 100, minRequestsPerSecond: float = 0.2,
+                 baseBackoff: float = 2.0, maxBackoff: float = 120.0):
+        self.requestsPerSecond = requestsPerSecond
+        self.concurrency = concurrency
+        self.minRequestsPerSecond = minRequestsPerSecond
+        self.baseBackoff = baseBackoff
+        self.maxBackoff = maxBackoff
+
+
+class HostState:
+    def __init__(self, policy: HostPolicy):
+        self.policy = policy
+        self.rate = policy.requestsPerSecond
+        self.slots = asyncio.Semaphore(policy.concurrency)
+        self.nextStart = 0.0
+        self.pausedUntil = 0.0
+        self.failureStreak = 0
+        self.inFlight = 0
+        self.requests = 0
+        self.backoffs = 0
+
+
+class HostSlot:
+    def __init__(self, scheduler, host):
+        self.scheduler = scheduler
+        self.host = host
+
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.host)
+        return self
+
+    async def __aexit__(self, *args):
+        self.scheduler.release(self.host)
+
+
+class HostScheduler:
+    '''
+    keeps a queue per host in front of the downloads. Every host is limited to its policy's concurrency and request
+    rate, independently of all other hosts, so a slow or throttled host only delays its own requests. The rate adapts:
+    it halves on captchas and connection errors (captchas also pause the host with exponential backoff) and grows
+    back by a tenth of the configured rate with every success.
+
+    must be used from the event loop that created it.
+    '''
+
+    def __init__(self, defaultPolicy: HostPolicy = None, hostPolicies: dict = None):
+        self.defaultPolicy = defaultPolicy or HostPolicy()
+        self.hostPolicies = hostPolicies or {}
+        self._hosts = {}
+
+    def slot(self, host) -> HostSlot:
+        return HostSlot(self, host)
+
+    def _state(self, host) -> HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = HostState(self.hostPolicies.get(host, self.defaultPolicy))
+        return state
+
+    async def acquire(self, host):
+        state = self._state(host)
+        await state.slots.acquire()
+        now = time.monotonic()
+        start = max(now, state.nextStart, state.pausedUntil)
+        state.nextStart = start + 1 / state.rate
+        state.inFlight += 1
+        state.requests += 1
+        if start > now:
+            try:
+                await asyncio.sleep(start - now)
+            except BaseException:
+                self.release(host)
+                raise
+
+    def release(self, host):
+        state = self._hosts[host]
+        state.inFlight -= 1
+        state.slots.release()
+
+    def report(self, host, errorClass=None):
+        '''
+        :param errorClass: None for a successful request, else see fetcherrors.ERROR_CLASSES
+        '''
+        state = self._state(host)
+        policy = state.policy
+        if errorClass is None:
+            state.failureStreak = 0
+            state.rate = min(policy.requestsPerSecond, state.rate + policy.requestsPerSecond / 10)
+            return
+        if errorClass in PAUSING_ERRORS and time.monotonic() < state.pausedUntil:
+            return  # answer to a request started before the pause, the backoff already accounts for it
+        if errorClass in SLOWING_ERRORS:
+            state.rate = max(policy.minRequestsPerSecond, state.rate / 2)
+        if errorClass in PAUSING_ERRORS:
+            state.failureStreak += 1
+            state.backoffs += 1
+            backoff = min(policy.maxBackoff, policy.baseBackoff * 2 ** (state.failureStreak - 1))
+            state.pausedUntil = max(state.pausedUntil, time.monotonic() + backoff * random.uniform(0.5, 1.0))
+
+    def stats(self):
+        return {host: {"rate": round(state.rate, 3), "in_flight": state.inFlight, "requests": state.requests,
+                       "backoffs": state.backoffs, "paused_s": round(max(0.0, state.pausedUntil - time.monotonic()), 1)}
+                for host, state in list(self._hosts.items())}
@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+CONTENT_FIELDS = ["content_raw", "content_raw_bz2", "content_bz2"]
+ENTRY_OVERHEAD_BYTES = 512
+
+
+class HotCache:
+    '''
+    in-process LRU cache of page documents keyed by (urlKey, format). Bounded by the compressed bytes it holds and by
+    a TTL, so pages that another process refreshed in Mongo are picked up again after ttlSeconds at the latest.
+    '''
+
+    def __init__(self, maxBytes: int, ttlSeconds: float = 600):
+        self.maxBytes = maxBytes
+        self.ttlSeconds = ttlSeconds
+        self.currentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxBytes > 0
+
+    def get(self, urlKey, output, maxAgeDays):
+        '''
+        :return: a copy of the cached document or None if it is unknown, expired or older than maxAgeDays
+        '''
+        if not self.enabled:
+            return None
+        key = (urlKey, output)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            doc, size, insertedAt = entry
+            if time.monotonic() - insertedAt > self.ttlSeconds:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if doc["creation_date"] <= datetime.now() - timedelta(days=maxAgeDays):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(doc)
+
+    def put(self, doc):
+        if not self.enabled or "format" not in doc or "creation_date" not in doc:
+            return
+        if not any(doc.get(field) for field in CONTENT_FIELDS):
+            return  # a page sent as a blob reference, its content is not at hand
+        doc = {field: value for field, value in doc.items() if field != "_id"}
+        size = ENTRY_OVERHEAD_BYTES + sum(len(doc[field]) for field in CONTENT_FIELDS if doc.get(field))
+        if size > self.maxBytes:
+            return
+        key = (doc["urlKey"], doc["format"])
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (doc, size, time.monotonic())
+            self.currentBytes += size
+            while self.currentBytes > self.maxBytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.currentBytes -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "bytes": self.currentBytes, "max_bytes": self.maxBytes,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "expirations": self.expirations, "hit_ratio": self.hits / lookups if lookups else 0.0}
@@ -0,0 +1,246 @@
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta
+
+import pymongo
+
+from storage import getDB
+
+JOB_CHUNK_SIZE = 500
+JOB_WORKERS = 8
+JOB_LEASE_S = 300
+JOB_IDLE_POLL_S = 2.0
+JOB_RETENTION_DAYS = 7
+JOB_INSERT_BATCH_SIZE = 10000
+JOB_MAX_CHUNK_ERRORS = 5  # chunks of a job that may raise before the urls of a failing chunk are given up
+URL_STATES = ["pending", "cached", "fetched", "failed"]
+
+
+class JobStore:
+    '''
+    fetch jobs persisted in Mongo, so they survive restarts of the service. Every job has a document in fetch_jobs with
+    its parameters, state and the number of urls per state, and every unique url key of a job a document in
+    fetch_job_urls with its state and its position (seq) in the job. Finished jobs and their urls are deleted after
+    JOB_RETENTION_DAYS.
+
+    job states: "submitting" while its urls are inserted, "pending" until a worker first claims it, "running" and
+    finally "done".
+    '''
+
+    def __init__(self, collectionName: str = "fetch_jobs", urlCollectionName: str = "fetch_job_urls",
+                 leaseSeconds: float = JOB_LEASE_S):
+        self.collectionName = collectionName
+        self.urlCollectionName = urlCollectionName
+        self.leaseSeconds = leaseSeconds
+
+    @property
+    def jobs(self):
+        return getDB()[self.collectionName]
+
+    @property
+    def urls(self):
+        return getDB()[self.urlCollectionName]
+
+    def ensureIndexes(self):
+        self.jobs.create_index([("state", pymongo.ASCENDING), ("lastRunAt", pymongo.ASCENDING)])
+        self.jobs.create_index([("expireAt", pymongo.ASCENDING)], expireAfterSeconds=0)
+        self.urls.create_index([("job", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)], unique=True)
+        self.urls.create_index([("job", pymongo.ASCENDING), ("status", pymongo.ASCENDING), ("seq", pymongo.ASCENDING)])
+        self.urls.create_index([("job", pymongo.ASCENDING), ("urlKey", pymongo.ASCENDING)])
+        self.urls.create_index([("expireAt", pymongo.ASCENDING)], expireAfterSeconds=0)
+
+    def submit(self, urlsByKey: dict, method: str, maxAgeDays: int, category: str, output: str) -> str:
+        '''
+        :param urlsByKey: dict of url key -> url tuple, in the order the results should be served
+        :return: job id
+        '''
+        jobId = uuid.uuid4().hex
+        now = datetime.now()
+        self.jobs.insert_one({"_id": jobId, "state": "submitting", "method": method, "maxAgeDays": maxAgeDays,
+                              "category": category, "output": output, "total": len(urlsByKey),
+                              "counts": dict.fromkeys(URL_STATES, 0), "created": now, "lastRunAt": now,
+                              "leaseUntil": None})
+        urlDocs = [{"job": jobId, "seq": seq, "urlKey": urlKey, "urlTuple": urlTuple, "status": "pending"}
+                   for seq, (urlKey, urlTuple) in enumerate(urlsByKey.items(), 1)]
+        for start in range(0, len(urlDocs), JOB_INSERT_BATCH_SIZE):
+            self.urls.insert_many(urlDocs[start:start + JOB_INSERT_BATCH_SIZE], ordered=False)
+        self.jobs.update_one({"_id": jobId}, {"$set": {"state": "pending", "counts.pending": len(urlDocs)}})
+        return jobId
+
+    def get(self, jobId: str):
+        return self.jobs.find_one({"_id": jobId, "state": {"$ne": "submitting"}})
+
+    def claim(self, worker: str):
+        '''
+        leases the runnable job that waited longest to worker. Jobs whose lease ran out (their worker died with the
+        service) are runnable again.
+
+        :return: job document or None if there is none
+        '''
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {"state": {"$in": ["pending", "running"]}, "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lt": now}}]},
+            {"$set": {"state": "running", "worker": worker, "leaseUntil": now + timedelta(seconds=self.leaseSeconds)}},
+            sort=[("lastRunAt", pymongo.ASCENDING)], return_document=pymongo.ReturnDocument.AFTER)
+
+    def renew(self, jobId: str, worker: str):
+        self.jobs.update_one({"_id": jobId, "worker": worker},
+                             {"$set": {"leaseUntil": datetime.now() + timedelta(seconds=self.leaseSeconds)}})
+
+    def release(self, jobId: str, worker: str):
+        self.jobs.update_one({"_id": jobId, "worker": worker},
+                             {"$set": {"leaseUntil": None, "lastRunAt": datetime.now()}})
+
+    def finish(self, jobId: str):
+        now = datetime.now()
+        expireAt = now + timedelta(days=JOB_RETENTION_DAYS)
+        self.jobs.update_one({"_id": jobId}, {"$set": {"state": "done", "finished": now, "leaseUntil": None,
+                                                       "expireAt": expireAt}})
+        self.urls.update_many({"job": jobId}, {"$set": {"expireAt": expireAt}})
+
+    def countChunkError(self, jobId: str) -> int:
+        '''
+        :return: number of chunks of the job that raised so far, including this one
+        '''
+        job = self.jobs.find_one_and_update({"_id": jobId}, {"$inc": {"chunkErrors": 1}}, {"chunkErrors": 1},
+                                            return_document=pymongo.ReturnDocument.AFTER)
+        return job["chunkErrors"] if job is not None else JOB_MAX_CHUNK_ERRORS
+
+    def pendingURLs(self, jobId: str, limit: int):
+        return list(self.urls.find({"job": jobId, "status": "pending"}, {"urlKey": 1, "urlTuple": 1})
+                    .sort("seq", pymongo.ASCENDING).limit(limit))
+
+    def record(self, jobId: str, states: dict):
+        '''
+        :param states: dict of url key -> new state. Only urls still pending change, so a chunk that two workers ran
+            after a lease ran out is counted once
+        '''
+        keysByState = {}
+        for urlKey, state in states.items():
+            keysByState.setdefault(state, []).append(urlKey)
+        counts = {}
+        for state, urlKeys in keysByState.items():
+            counts[state] = self.urls.update_many({"job": jobId, "urlKey": {"$in": urlKeys}, "status": "pending"},
+                                                  {"$set": {"status": state}}).modified_count
+        changed = sum(counts.values())
+        if changed:
+            self.jobs.update_one({"_id": jobId}, {"$inc": dict({"counts.%s" % state: count
+                                                                for state, count in counts.items()},
+                                                               **{"counts.pending": -changed})})
+
+    def completedURLs(self, jobId: str, after: int = 0, limit: int = 1000):
+        '''
+        :return: url documents with seq > after in seq order, up to the first url of the job that is still pending.
+            Results are only served in that order, so paging on seq never skips a url that completes later
+        '''
+        firstPending = next(iter(self.urls.find({"job": jobId, "status": "pending"}, {"seq": 1})
+                                 .sort("seq", pymongo.ASCENDING).limit(1)), None)
+        seqRange = {"$gt": after} if firstPending is None else {"$gt": after, "$lt": firstPending["seq"]}
+        return list(self.urls.find({"job": jobId, "seq": seqRange},
+                                   {"_id": 0, "seq": 1, "urlKey": 1, "urlTuple": 1, "status": 1})
+                    .sort("seq", pymongo.ASCENDING).limit(limit))
+
+
+class JobRunner:
+    '''
+    worker threads moving the fetch jobs forward one chunk at a time: a worker claims the job that waited longest,
+    fetches its next chunkSize pending urls and hands the job back, so every job keeps making progress however many
+    there are. A claim is a lease that the worker renews while it works; jobs of a service that stopped are taken up
+    again once their lease ran out.
+
+    :param fetchChunk: callable(job document, list of url tuples) -> iterable of page records, error records for urls
+        that could not be obtained
+    '''
+
+    def __init__(self, store: JobStore, fetchChunk, numWorkers: int = JOB_WORKERS, chunkSize: int = JOB_CHUNK_SIZE):
+        self.store = store
+        self.fetchChunk = fetchChunk
+        self.numWorkers = numWorkers
+        self.chunkSize = chunkSize
+        self.chunksRun = 0
+        self._wakeUp = threading.Event()
+        self._stopped = threading.Event()
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._stopped.clear()
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            for i in range(len(self._workers), self.numWorkers):
+                worker = threading.Thread(target=self._work, name="job-worker-%s" % i, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def wake(self):
+        self._wakeUp.set()
+
+    def stop(self):
+        '''
+        lets the workers finish the chunk they are running and waits for them
+        '''
+        with self._lock:
+            self._stopped.set()
+            self._wakeUp.set()
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.join()
+
+    def _work(self):
+        workerId = "%s-%s" % (uuid.uuid4().hex[:8], threading.current_thread().name)
+        while not self._stopped.is_set():
+            try:
+                job = self.store.claim(workerId)
+            except pymongo.errors.PyMongoError as e:
+                print("could not claim a fetch job: %s" % e)
+                job = None
+            if job is None:
+                self._wakeUp.wait(JOB_IDLE_POLL_S)
+                self._wakeUp.clear()
+                continue
+            try:
+                self.runChunk(job, workerId)
+            except Exception:
+                print("fetch job %s failed a chunk: %s" % (job["_id"], traceback.format_exc()))
+            finally:
+                self.store.release(job["_id"], workerId)
+
+    def runChunk(self, job, workerId):
+        urlDocs = self.store.pendingURLs(job["_id"], self.chunkSize)
+        if not urlDocs:
+            self.store.finish(job["_id"])
+            return
+        chunkStart = datetime.now()
+        lastRenewal = time.monotonic()
+        states = {}
+        try:
+            for page in self.fetchChunk(job, [tuple(doc["urlTuple"]) for doc in urlDocs]):
+                if "error" in page:
+                    states[page["urlKey"]] = "failed"
+                else:
+                    states[page["urlKey"]] = "fetched" if page.get("creation_date", chunkStart) >= chunkStart \
+                        else "cached"
+                if time.monotonic() - lastRenewal > self.store.leaseSeconds / 3:
+                    self.store.renew(job["_id"], workerId)
+                    lastRenewal = time.monotonic()
+        except Exception:
+            # keep what the chunk got, the rest stays pending for the next run unless the job keeps failing
+            self.store.record(job["_id"], states)
+            if self.store.countChunkError(job["_id"]) < JOB_MAX_CHUNK_ERRORS:
+                raise
+            print("fetch job %s keeps failing, giving up %s urls: %s" % (job["_id"], len(urlDocs) - len(states),
+                                                                         traceback.format_exc()))
+        # error records aside, whatever the chunk did not yield could not be obtained either
+        states.update({doc["urlKey"]: "failed" for doc in urlDocs if doc["urlKey"] not in states})
+        self.store.record(job["_id"], states)
+        with self._lock:
+            self.chunksRun += 1
+        if len(urlDocs) < self.chunkSize:
+            self.store.finish(job["_id"])
+
+    def stats(self):
+        with self._lock:
+            return {"workers": len([worker for worker in self._workers if worker.is_alive()]),
+                    "chunks_run": self.chunksRun}
@@ -0,0 +1,112 @@
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pymongo
+
+from storage import getDB
+
+LEASE_TTL_S = 120
+RENEW_INTERVAL_S = 30
+
+
+class FetchLeases:
+    '''
+    single-flight coordination of page fetches across threads and worker processes. Whoever inserts the lease document
+    for a (urlKey, format) first fetches the page, everybody else waits for its result. Leases of live owners are
+    renewed in the background; a crashed owner's leases expire after LEASE_TTL_S and can be taken over.
+    '''
+
+    def __init__(self, collectionName: str = "fetch_leases", ttlSeconds: float = LEASE_TTL_S):
+        self.collectionName = collectionName
+        self.ttlSeconds = ttlSeconds
+        self.acquired = 0
+        self.coalesced = 0
+        self._owners = set()
+        self._lock = threading.Lock()
+        self._renewer = None
+
+    @property
+    def collection(self):
+        return getDB()[self.collectionName]
+
+    @staticmethod
+    def leaseId(urlKey, output):
+        return hashlib.sha1(("%s|%s" % (output, urlKey)).encode()).hexdigest()
+
+    def acquire(self, urlKeys, output):
+        '''
+        :return: tuple(owner id, list of url keys this caller has to fetch, list of url keys someone else is fetching)
+        '''
+        owner = uuid.uuid4().hex
+        if not urlKeys:
+            return owner, [], []
+        now = datetime.now()
+        expires = now + timedelta(seconds=self.ttlSeconds)
+        leaseIds = {self.leaseId(urlKey, output): urlKey for urlKey in urlKeys}
+        try:
+            self.collection.insert_many([{"_id": leaseId, "urlKey": urlKey, "owner": owner, "expires": expires}
+                                         for leaseId, urlKey in leaseIds.items()], ordered=False)
+        except pymongo.errors.BulkWriteError:
+            pass  # duplicate keys: leases held by someone else, resolved below
+        held = {lease["_id"]: lease for lease in self.collection.find({"_id": {"$in": list(leaseIds)}})}
+        mine, others = [], []
+        for leaseId, urlKey in leaseIds.items():
+            lease = held.get(leaseId)
+            if lease is not None and lease["owner"] != owner and lease["expires"] < now:
+                lease = self.collection.find_one_and_update(
+                    {"_id": leaseId, "expires": {"$lt": now}}, {"$set": {"owner": owner, "expires": expires}},
+                    return_document=pymongo.ReturnDocument.AFTER)
+            if lease is None:
+                # released between our insert and find: the page is stored now, waiting picks it up
+                others.append(urlKey)
+            elif lease["owner"] == owner:
+                mine.append(urlKey)
+            else:
+                others.append(urlKey)
+        with self._lock:
+            self.acquired += len(mine)
+            self.coalesced += len(others)
+            if mine:
+                self._owners.add(owner)
+                self._ensureRenewer()
+        return owner, mine, others
+
+    def release(self, owner, urlKeys, output):
+        with self._lock:
+            self._owners.discard(owner)
+        if urlKeys:
+            self.collection.delete_many({"_id": {"$in": [self.leaseId(urlKey, output) for urlKey in urlKeys]},
+                                         "owner": owner})
+
+    def heldByOthers(self, urlKeys, output):
+        '''
+        :return: set of url keys with a live lease
+        '''
+        leaseIds = {self.leaseId(urlKey, output): urlKey for urlKey in urlKeys}
+        return {leaseIds[lease["_id"]] for lease in self.collection.find(
+            {"_id": {"$in": list(leaseIds)}, "expires": {"$gt": datetime.now()}}, {"_id": 1})}
+
+    def stats(self):
+        with self._lock:
+            return {"acquired": self.acquired, "coalesced": self.coalesced, "active_owners": len(self._owners)}
+
+    def _ensureRenewer(self):
+        if self._renewer is None or not self._renewer.is_alive():
+            self._renewer = threading.Thread(target=self._renewPeriodically, name="lease-renewer", daemon=True)
+            self._renewer.start()
+
+    def _renewPeriodically(self):
+        while True:
+            time.sleep(min(RENEW_INTERVAL_S, self.ttlSeconds / 3))
+            with self._lock:
+                owners = list(self._owners)
+            if not owners:
+                continue
+            try:
+                self.collection.update_many({"owner": {"$in": owners}}, {
+                    "$set": {"expires": datetime.now() + timedelta(seconds=self.ttlSeconds)}})
+            except pymongo.errors.PyMongoError as e:
+                print("could not renew fetch leases: %s" % e)
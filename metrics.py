@@ -0,0 +1,324 @@
+import bisect
+import math
+import threading
+import time
+from collections import deque
+
+from pymongo import monitoring
+
+MAX_SERIES = 500  # label combinations per metric, the ones over it are counted under OVERFLOW_LABEL
+OVERFLOW_LABEL = "_other"
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TRACE_HISTORY = 100
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _formatValue(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    '''
+    base of the metrics in the Prometheus text format. Series are keyed by the tuple of their label values, at most
+    MAX_SERIES of them: proxies and hosts come and go, the labels they leave behind must not grow without bound.
+    '''
+    type = None
+
+    def __init__(self, name: str, help: str, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labelValues):
+        if labelValues in self._series or len(self._series) < MAX_SERIES:
+            return labelValues
+        return (OVERFLOW_LABEL,) * len(self.labelNames)
+
+    def _labels(self, labelValues, extra=()) -> str:
+        pairs = list(zip(self.labelNames, labelValues)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        with self._lock:
+            series = list(self._series.items())
+        for labelValues, value in series:
+            lines.extend(self._renderSeries(labelValues, value))
+        return lines
+
+    def _renderSeries(self, labelValues, value):
+        return ["%s%s %s" % (self.name, self._labels(labelValues), _formatValue(value))]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, *labelValues):
+        with self._lock:
+            key = self._key(labelValues)
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, *labelValues):
+        with self._lock:
+            self._series[self._key(labelValues)] = value
+
+    def inc(self, amount=1, *labelValues):
+        with self._lock:
+            key = self._key(labelValues)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount=1, *labelValues):
+        self.inc(-amount, *labelValues)
+
+
+class Histogram(Metric):
+    '''
+    every series keeps one count per bucket and the sum; the cumulative counts Prometheus wants are built on render
+    '''
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelNames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelValues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labelValues)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def time(self, *labelValues):
+        return _Timer(self, labelValues)
+
+    def count(self) -> int:
+        '''
+        :return: number of observations over all series
+        '''
+        with self._lock:
+            return sum(sum(counts) for counts, _ in self._series.values())
+
+    def _renderSeries(self, labelValues, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append("%s_bucket%s %s" % (self.name, self._labels(labelValues, [("le", _formatValue(bound))]),
+                                             cumulative))
+        lines.append("%s_sum%s %s" % (self.name, self._labels(labelValues), _formatValue(total)))
+        lines.append("%s_count%s %s" % (self.name, self._labels(labelValues), cumulative))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labelValues):
+        self.histogram = histogram
+        self.labelValues = labelValues
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labelValues)
+
+
+class StatsGauges(Metric):
+    '''
+    gauges read from the stats() dict a component keeps anyway, when the metrics are scraped: every number in it
+    becomes the gauge <name>_<key>
+    '''
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, statsFunction):
+        super().__init__(name, help)
+        self.statsFunction = statsFunction
+
+    def render(self):
+        try:
+            stats = self.statsFunction()
+        except Exception as e:
+            print("could not read the stats for metric %s: %s" % (self.name, e))
+            return []
+        lines = []
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                name = "%s_%s" % (self.name, key)
+                lines += ["# HELP %s %s: %s" % (name, self.help, key), "# TYPE %s gauge" % name,
+                          "%s %s" % (name, _formatValue(value))]
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("metric %s is registered already" % metric.name)
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelNames=()) -> Counter:
+        return self.register(Counter(name, help, labelNames))
+
+    def gauge(self, name, help, labelNames=()) -> Gauge:
+        return self.register(Gauge(name, help, labelNames))
+
+    def histogram(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelNames, buckets))
+
+    def statsGauges(self, name, help, statsFunction) -> StatsGauges:
+        return self.register(StatsGauges(name, help, statsFunction))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.histogram("webcache_fetch_seconds", "duration of fetch attempts per host", ["host"])
+PROXY_FETCH_SECONDS = REGISTRY.histogram("webcache_proxy_fetch_seconds", "duration of successful fetch attempts per "
+                                         "proxy", ["proxy"])
+FETCH_ERRORS = REGISTRY.counter("webcache_fetch_errors_total", "failed fetch attempts per error class",
+                                ["error_class"])
+FETCHES_IN_FLIGHT = REGISTRY.gauge("webcache_fetches_in_flight", "fetch attempts in progress", ["engine"])
+DOWNLOADED_BYTES = REGISTRY.counter("webcache_downloaded_bytes_total", "bytes of page bodies downloaded")
+STORED_BYTES = REGISTRY.counter("webcache_stored_bytes_total", "bytes of compressed page bodies handed to storage, "
+                                "identical bodies are written once")
+PAGE_STAGE_SECONDS = REGISTRY.histogram("webcache_page_stage_seconds", "time spent per page in a processing stage",
+                                        ["stage"])
+PAGES_SERVED = REGISTRY.counter("webcache_pages_served_total", "pages served per source: hot_cache, mongo, fetched, "
+                                "coalesced (fetched by another request) or failed", ["source"])
+MONGO_COMMAND_SECONDS = REGISTRY.histogram("webcache_mongo_command_seconds", "duration of Mongo commands",
+                                           ["command"])
+MONGO_COMMAND_FAILURES = REGISTRY.counter("webcache_mongo_command_failures_total", "failed Mongo commands",
+                                          ["command"])
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("webcache_http_request_seconds", "duration of requests per endpoint, of "
+                                          "streamed responses until their last chunk went out", ["endpoint"])
+HTTP_REQUESTS_IN_FLIGHT = REGISTRY.gauge("webcache_http_requests_in_flight", "requests being handled",
+                                         ["endpoint"])
+STAGE_SECONDS = REGISTRY.histogram("webcache_request_stage_seconds", "time spent in the stages of serving a batch",
+                                   ["stage"])
+
+
+class CommandMetrics(monitoring.CommandListener):
+    '''
+    times Mongo commands, started and finished events of a command share its request id
+    '''
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        MONGO_COMMAND_FAILURES.inc(1, event.command_name)
+
+
+class Trace:
+    '''
+    spans of one request, as (name, start offset s, duration s) tuples
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.spans = []
+
+    def record(self, name, start, duration, attributes):
+        self.spans.append(dict(attributes, name=name, start_ms=round((start - self._start) * 1000, 3),
+                               duration_ms=round(duration * 1000, 3)))
+
+    def asDict(self):
+        return {"name": self.name, "started": self.started,
+                "duration_ms": round((time.perf_counter() - self._start) * 1000, 3), "spans": self.spans}
+
+
+_local = threading.local()
+recentTraces = deque(maxlen=TRACE_HISTORY)
+
+
+def startTrace(name: str) -> Trace:
+    '''
+    starts recording the spans of the current thread, until finishTrace
+    '''
+    _local.trace = Trace(name)
+    return _local.trace
+
+
+def finishTrace():
+    '''
+    :return: the trace of the current thread, None if there is none. It is kept in recentTraces
+    '''
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    if trace is not None:
+        recentTraces.append(trace.asDict())
+    return trace
+
+
+class span:
+    '''
+    context manager timing a stage of serving a batch into STAGE_SECONDS, and into the trace of the thread if one is
+    being recorded. Cheap enough to leave in hot paths: two clock reads and a histogram update. A stage that yields
+    pages leaves the time its consumer takes for them out with paused().
+    '''
+
+    def __init__(self, name: str, **attributes):
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.pausedSeconds = 0.0
+        return self
+
+    def __exit__(self, *args):
+        duration = time.perf_counter() - self.start - self.pausedSeconds
+        STAGE_SECONDS.observe(duration, self.name)
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace.record(self.name, self.start, duration, self.attributes)
+
+    def paused(self):
+        '''
+        :return: context manager whose block does not count towards the span, e.g. the yield of a page
+        '''
+        return _Pause(self)
+
+
+class _Pause:
+    def __init__(self, span):
+        self.span = span
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.span.pausedSeconds += time.perf_counter() - self.start
@@ -0,0 +1,162 @@
+import bz2
+import hashlib
+import lzma
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class UnknownCodecError(ValueError):
+    def __init__(self, codecName, dictId=None):
+        super(UnknownCodecError, self).__init__("unknown compression codec %s" % codecName)
+        self.codecName = codecName
+        self.dictId = dictId
+
+
+class Codec:
+    def __init__(self, name, compress, decompress, compressor=None):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.compressor = compressor
+
+
+CODECS = {}
+DICTIONARIES = {}
+DICTIONARY_CODECS = ["zstd", "zlib"]
+
+
+def registerCodec(name, compress, decompress, compressor=None):
+    '''
+    :param compressor: optional callable(size) -> object with compress(data) and flush() whose output decompress
+        reads, see streamCompressor. May return None if it can't compress data of that size (None: unknown) in chunks
+    '''
+    CODECS[name] = Codec(name, compress, decompress, compressor)
+
+
+def perThread(factory, methodName):
+    '''
+    zstd (de)compressor objects must not be used by two threads at once, every thread gets its own one
+    '''
+    local = threading.local()
+
+    def call(data):
+        if not hasattr(local, "instance"):
+            local.instance = factory()
+        return getattr(local.instance, methodName)(data)
+
+    return call
+
+
+def zstdCompressor(dictionary=None):
+    '''
+    zstd frames written in chunks only state their content size if it is given up front, and the one-shot
+    decompressor (and every client out there) needs it: no streaming compressor for data of unknown size
+    '''
+    def compressor(size):
+        if size is None:
+            return None
+        return zstandard.ZstdCompressor(level=3, dict_data=dictionary).compressobj(size=size)
+
+    return compressor
+
+
+registerCodec("bz2", bz2.compress, bz2.decompress, lambda size: bz2.BZ2Compressor())
+registerCodec("zlib", lambda data: zlib.compress(data, 6), zlib.decompress, lambda size: zlib.compressobj(6))
+registerCodec("lzma", lzma.compress, lzma.decompress, lambda size: lzma.LZMACompressor())
+if zstandard is not None:
+    registerCodec("zstd", perThread(lambda: zstandard.ZstdCompressor(level=3), "compress"),
+                  perThread(zstandard.ZstdDecompressor, "decompress"), zstdCompressor())
+if lz4 is not None:
+    registerCodec("lz4", lz4.frame.compress, lz4.frame.decompress)
+
+# every client can read zlib pages, zstd and lz4 ones only if it has the package too. Pages are served in the codec they
+# were stored in, so a service stores zstd pages (WEBCACHE_CODEC=zstd) only if all its clients have zstandard
+DEFAULT_CODEC = "zlib"
+
+
+def compress(data: bytes, codecName: str = DEFAULT_CODEC) -> bytes:
+    return getCodec(codecName).compress(data)
+
+
+def decompress(blob: bytes, codecName: str = "bz2") -> bytes:
+    '''
+    :param codecName: codec the blob was compressed with. Entries stored without a codec field are bz2
+    '''
+    return getCodec(codecName).decompress(blob)
+
+
+def streamCompressor(codecName: str, size: int = None):
+    '''
+    :param size: length of the data to compress if it is known
+    :return: object with compress(data) -> bytes and flush() -> bytes that together give a blob decompress(blob,
+        codecName) reads, None if the codec can't compress that data in chunks
+    '''
+    codec = getCodec(codecName)
+    return codec.compressor(size) if codec.compressor is not None else None
+
+
+def getCodec(codecName: str) -> Codec:
+    if codecName in CODECS:
+        return CODECS[codecName]
+    baseName, _, dictId = codecName.partition(":")
+    if dictId and baseName in DICTIONARY_CODECS:
+        raise UnknownCodecError(codecName, dictId)
+    raise UnknownCodecError(codecName)
+
+
+def registerDictionary(dictionary: bytes) -> str:
+    '''
+    registers codecs "<codec>:<dictId>" that compress with a shared dictionary. Small pages compress much better when
+    the compressor already knows the boilerplate they share.
+
+    :return: dictId, derived from the dictionary content
+    '''
+    dictId = hashlib.sha1(dictionary).hexdigest()[:12]
+    if dictId in DICTIONARIES:
+        return dictId
+    DICTIONARIES[dictId] = dictionary
+
+    def zlibCompress(data):
+        compressor = zlib.compressobj(6, zdict=dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def zlibDecompress(blob):
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        return decompressor.decompress(blob) + decompressor.flush()
+
+    registerCodec("zlib:%s" % dictId, zlibCompress, zlibDecompress, lambda size: zlib.compressobj(6, zdict=dictionary))
+    if zstandard is not None:
+        zstdDict = zstandard.ZstdCompressionDict(dictionary)
+        registerCodec("zstd:%s" % dictId,
+                      perThread(lambda: zstandard.ZstdCompressor(level=3, dict_data=zstdDict), "compress"),
+                      perThread(lambda: zstandard.ZstdDecompressor(dict_data=zstdDict), "decompress"),
+                      zstdCompressor(zstdDict))
+    return dictId
+
+
+def trainDictionary(samples, size: int = 64 * 1024) -> bytes:
+    '''
+    builds a shared dictionary from sample pages. Uses zstd's trainer where available and falls back to the tails
+    of the samples, which is what zlib's preset dictionary can make use of.
+    '''
+    if zstandard is not None and len(samples) >= 8:
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            pass
+    dictionary = b""
+    for sample in samples:
+        if len(dictionary) >= size:
+            break
+        dictionary += sample[-1024:]
+    return dictionary[-size:]
@@ -0,0 +1,133 @@
+import hashlib
+
+import pagecodecs
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+INITIAL_BUFFER_SIZE = 64 * 1024
+SNIFF_OVERLAP = 4096  # bytes searched again with every chunk, so a match cut in two by a chunk border is found
+
+
+def expectedLength(headers):
+    '''
+    :return: body length announced in the Content-Length header, None if there is none or if the body is encoded:
+        the header then counts the encoded bytes, not the ones we get to read
+    '''
+    if headers is None or headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    try:
+        length = int(headers.get("Content-Length"))
+    except (TypeError, ValueError):
+        return None
+    return length if length >= 0 else None
+
+
+class PageBuffer:
+    '''
+    download buffer of one page body. Bytes are written into a bytearray allocated at the announced length (doubling
+    if there is none) and never copied again: the finished body is handed on as a memoryview. While the body arrives
+    it is hashed, searched for sniffPattern and, once it is larger than streamAbove, fed to a streaming compressor of
+    codecName, so hardly any work is left when the last chunk came in.
+
+    :param maxBytes: the body is cut off after this many bytes, see truncated
+    :param expectedLength: length of the body if known, see expectedLength()
+    :param codecName: codec to compress the body with while it arrives. None -> compressed when it is complete
+    :param streamAbove: bodies up to this size are compressed once complete, they may still get a dictionary codec
+    :param sniffPattern: compiled bytes regex searched in the body as it arrives, see sniffed
+    '''
+
+    def __init__(self, maxBytes: float, expectedLength: int = None, codecName: str = None, streamAbove: int = 0,
+                 sniffPattern=None):
+        self.maxBytes = int(maxBytes)
+        self.expectedLength = expectedLength
+        self.codecName = codecName
+        self.streamAbove = streamAbove
+        self.sniffPattern = sniffPattern
+        self.size = 0
+        self.truncated = False
+        self.sniffed = False
+        self._buffer = bytearray(min(INITIAL_BUFFER_SIZE if expectedLength is None else expectedLength, self.maxBytes))
+        self._hash = hashlib.sha256()
+        self._sniffedUpTo = 0
+        self._compressor = None
+        self._compressedParts = []
+        self._streamable = codecName is not None
+
+    @property
+    def tooLarge(self) -> bool:
+        '''
+        whether the announced length is over maxBytes: nothing needs to be downloaded to know the body gets cut off
+        '''
+        return self.expectedLength is not None and self.expectedLength > self.maxBytes
+
+    @property
+    def chunkSize(self) -> int:
+        '''
+        size of the next read: the rest of the body if its length is known, otherwise as much as was read so far, so
+        small pages take few small reads and large ones few large reads
+        '''
+        wanted = self.expectedLength - self.size if self.expectedLength is not None else self.size
+        return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, wanted, self.maxBytes - self.size + 1))
+
+    def write(self, chunk) -> bool:
+        '''
+        :return: False once the body reached maxBytes. The part of chunk over it is dropped and truncated is set
+        '''
+        room = self.maxBytes - self.size
+        if len(chunk) > room:
+            chunk = memoryview(chunk)[:room]
+            self.truncated = True
+        end = self.size + len(chunk)
+        if end > len(self._buffer):
+            self._buffer.extend(bytes(max(end, min(2 * len(self._buffer), self.maxBytes)) - len(self._buffer)))
+        self._buffer[self.size:end] = chunk
+        self._hash.update(chunk)
+        start, self.size = self.size, end
+        self._sniff()
+        self._compress(start)
+        return not self.truncated
+
+    def _sniff(self):
+        if self.sniffPattern is None or self.sniffed:
+            return
+        self.sniffed = self.sniffPattern.search(self._buffer, max(0, self._sniffedUpTo - SNIFF_OVERLAP),
+                                                self.size) is not None
+        self._sniffedUpTo = self.size
+
+    def _compress(self, start):
+        if not self._streamable or self.size <= self.streamAbove:
+            return
+        if self._compressor is None:
+            self._compressor = pagecodecs.streamCompressor(self.codecName, self.expectedLength)
+            if self._compressor is None:
+                self._streamable = False
+                return
+            start = 0  # the bytes that came before the body got large
+        with memoryview(self._buffer) as view:
+            self._compressedParts.append(self._compressor.compress(view[start:self.size]))
+
+    def view(self) -> memoryview:
+        '''
+        :return: the body without a copy. Write nothing more once it was taken
+        '''
+        return memoryview(self._buffer)[:self.size]
+
+    def contentHash(self) -> str:
+        return self._hash.hexdigest()
+
+    def matches(self, pattern) -> bool:
+        '''
+        :return: whether pattern occurs in the body. Free for sniffPattern, it was searched while the body arrived
+        '''
+        if pattern is self.sniffPattern:
+            return self.sniffed
+        return pattern.search(self._buffer, 0, self.size) is not None
+
+    def compressed(self, codecName: str) -> bytes:
+        '''
+        :return: the body compressed with codecName. Finishes the streaming compressor if it ran with that codec, and
+            compresses the body at once otherwise. Call it once the body is complete, and only once
+        '''
+        if self._compressor is not None and codecName == self.codecName and self.expectedLength in (None, self.size):
+            return b"".join(self._compressedParts) + self._compressor.flush()
+        return pagecodecs.compress(self.view(), codecName)
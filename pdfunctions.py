@@ -4,5 +4,7 @@ class SkipURL(Exception):
     pass
 
 def timeDiffToNow(previousTime):
-    diff = (datetime.datetime.now() - previousTime)
-    return diff.microseconds + diff.seconds*10**6
\ No newline at end of file
+    '''
+    :return: milliseconds since previousTime
+    '''
+    return (datetime.datetime.now() - previousTime) / datetime.timedelta(milliseconds=1)
\ No newline at end of file
@@ -0,0 +1,93 @@
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL_S = 0.01
+PROFILE_MAX_DURATION_S = 300
+PROFILE_MAX_DEPTH = 64
+
+
+class SamplingProfiler:
+    '''
+    statistical profiler that can be switched on and off in a running service: while it runs, a thread looks at the
+    stack of every other thread each interval and counts the stacks it saw. Costs nothing while it is off, and about a
+    stack walk per thread and interval while it is on. The result is in the folded format flame graph tools read:
+    one "thread;outermost frame;...;innermost frame count" line per stack.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._stacks = {}
+        self.samples = 0
+        self.interval = None
+        self.started = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = PROFILE_INTERVAL_S, maxDuration: float = PROFILE_MAX_DURATION_S) -> bool:
+        '''
+        :param maxDuration: the profiler stops by itself after so many seconds, in case nobody stops it
+        :return: False if the profiler was running already
+        '''
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks = {}
+            self.samples = 0
+            self.interval = interval
+            self.started = time.time()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, args=(interval, maxDuration), name="profiler",
+                                            daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self) -> str:
+        '''
+        :return: the stacks sampled since start in folded format
+        '''
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+        return self.folded()
+
+    def folded(self) -> str:
+        with self._lock:
+            stacks = sorted(self._stacks.items(), key=lambda item: -item[1])
+        return "".join("%s %s\n" % (stack, count) for stack, count in stacks)
+
+    def stats(self):
+        return {"running": self.running, "samples": self.samples, "interval_s": self.interval,
+                "started": self.started, "stacks": len(self._stacks)}
+
+    def _sample(self, interval, maxDuration):
+        ownId = threading.get_ident()
+        deadline = time.monotonic() + maxDuration
+        while not self._stop.wait(interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            with self._lock:
+                for threadId, frame in frames.items():
+                    if threadId == ownId:
+                        continue
+                    key = ";".join([names.get(threadId, str(threadId))] + _frameNames(frame))
+                    self._stacks[key] = self._stacks.get(key, 0) + 1
+                self.samples += 1
+
+
+def _frameNames(frame):
+    names = []
+    while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+        code = frame.f_code
+        names.append("%s:%s" % (code.co_name, code.co_filename.rsplit("/", 1)[-1]))
+        frame = frame.f_back
+    names.reverse()
+    return names
+
+
+profiler = SamplingProfiler()
@@ -1,17 +1,22 @@
 import requests
 import re, bs4, math
 from joblib import Parallel, delayed
+import os
 import random
-from pymongo import InsertOne, DeleteOne, ReplaceOne
+import threading
+import time
+from pymongo import InsertOne, DeleteOne, ReplaceOne, UpdateOne
 import pymongo
 
+from storage import getDB
+
 
 class DBProxyHandler:
     db = None
     proxies = []
 
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, db=None):
+        self.db = db if db is not None else getDB()
 
     def upload(self, proxyList):
         cleanedList = [item.replace("\n", "") for item in proxyList]
@@ -51,10 +56,287 @@ class DBProxyHandler:
             return
 
         try:
-            proxy = self.db.proxies.find_one({"address": address})
-            self.db.proxies.update_one({"address": address}, {
-                "$set": {"successful_job_completion": proxy.get("successful_job_completion", 0) if proxy is not None else 0
-                                                           + counter}}, upsert=True)  # allow max 15 plus points. if proxy goes offline, max 45 req will drop it
+            self.db.proxies.update_one({"address": address}, clampedScoreUpdate(counter), upsert=True)
         except pymongo.errors.AutoReconnect:
             print("pymongo error in feedback: could not autoreconnect")
             self.feedback(address, counter, nTries-1)
+
+
+MIN_SCORE = -30  # proxies at or below this score are not used any more
+# allow max 15 plus points. if proxy goes offline, max 45 req will drop it
+SCORE_BOUNDS = (MIN_SCORE - 15, 15)
+MAX_PROXIES = 10000
+LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def proxyWeight(score, meanLatencyMs=None):
+    # strategy: proxies that work well are reused more often, but every usable proxy keeps a positive weight. Slow
+    # proxies are picked less often
+    weight = min(max(score, -5), 5) + 6
+    if meanLatencyMs is not None:
+        weight /= 1 + meanLatencyMs / 1000
+    return weight
+
+
+def clampedScoreUpdate(delta, counters=None):
+    '''
+    update pipeline adding delta to the score of a proxy and clamping it to SCORE_BOUNDS on the server. counters
+    (field -> increment) are added in the same update, so the whole feedback of a proxy is applied atomically.
+    '''
+    newScore = {"$add": [{"$ifNull": ["$successful_job_completion", 0]}, delta]}
+    fields = {"successful_job_completion": {"$max": [SCORE_BOUNDS[0], {"$min": [SCORE_BOUNDS[1], newScore]}]}}
+    for field, increment in (counters or {}).items():
+        fields[field] = {"$add": [{"$ifNull": ["$%s" % field, 0]}, increment]}
+    return [{"$set": fields}]
+
+
+def latencyBucket(latencyMs):
+    for bound in LATENCY_BUCKETS_MS:
+        if latencyMs <= bound:
+            return "le_%s" % bound
+    return "le_inf"
+
+
+class ProxyStats:
+    def __init__(self):
+        self.score = 0
+        self.successes = 0
+        self.failures = 0
+        self.latencyCount = 0
+        self.latencyTotalMs = 0.0
+        self.latencyHistogram = {}
+        self.errors = {}
+
+    def merge(self, other):
+        self.score += other.score
+        self.successes += other.successes
+        self.failures += other.failures
+        self.latencyCount += other.latencyCount
+        self.latencyTotalMs += other.latencyTotalMs
+        for bucket, count in other.latencyHistogram.items():
+            self.latencyHistogram[bucket] = self.latencyHistogram.get(bucket, 0) + count
+        for errorClass, count in other.errors.items():
+            self.errors[errorClass] = self.errors.get(errorClass, 0) + count
+
+    def update(self, address):
+        counters = {"successes": self.successes, "failures": self.failures, "latency_count": self.latencyCount,
+                    "latency_total_ms": self.latencyTotalMs}
+        counters.update({"latency_ms_histogram.%s" % bucket: count for bucket, count in self.latencyHistogram.items()})
+        counters.update({"errors.%s" % errorClass: count for errorClass, count in self.errors.items()})
+        counters = {field: value for field, value in counters.items() if value}
+        return UpdateOne({"address": address}, clampedScoreUpdate(self.score, counters), upsert=True)
+
+
+class FeedbackAggregator:
+    '''
+    sums up proxy feedback in memory and writes it as one unordered bulk_write with one atomic update per proxy,
+    instead of a read and a write per fetch attempt. Thread-safe; nothing is lost when a flush fails, the deltas are merged
+    back and go out with the next one.
+    '''
+
+    def __init__(self, db=None):
+        self._db = db
+        self.flushes = 0
+        self.failedFlushes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        os.register_at_fork(after_in_child=self._resetAfterFork)
+
+    @property
+    def db(self):
+        return self._db if self._db is not None else getDB()
+
+    def add(self, address, counter=1, latencyMs=None, errorClass=None):
+        with self._lock:
+            stats = self._pending.get(address)
+            if stats is None:
+                stats = self._pending[address] = ProxyStats()
+            stats.score += counter
+            if counter > 0:
+                stats.successes += 1
+            elif counter < 0:
+                stats.failures += 1
+            if latencyMs is not None:
+                stats.latencyCount += 1
+                stats.latencyTotalMs += latencyMs
+                bucket = latencyBucket(latencyMs)
+                stats.latencyHistogram[bucket] = stats.latencyHistogram.get(bucket, 0) + 1
+            if errorClass is not None:
+                stats.errors[errorClass] = stats.errors.get(errorClass, 0) + 1
+
+    def pendingScore(self, address):
+        with self._lock:
+            stats = self._pending.get(address)
+            return stats.score if stats is not None else 0
+
+    def flush(self):
+        with self._flushLock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            try:
+                self.db.proxies.bulk_write([stats.update(address) for address, stats in pending.items()],
+                                           ordered=False)
+                self.flushes += 1
+            except pymongo.errors.PyMongoError as e:
+                print("pymongo error in proxy feedback flush: %s" % e)
+                self.failedFlushes += 1
+                with self._lock:
+                    for address, stats in pending.items():
+                        if address in self._pending:
+                            stats.merge(self._pending[address])
+                        self._pending[address] = stats
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"pending_proxies": pending, "flushes": self.flushes, "failed_flushes": self.failedFlushes}
+
+    def _resetAfterFork(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+
+
+class FenwickTree:
+    '''
+    prefix sums over proxy weights: weighted sampling and weight updates in O(log n)
+    '''
+
+    def __init__(self, weights):
+        self.size = len(weights)
+        self.tree = [0.0] + list(weights)
+        for i in range(1, self.size + 1):
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def update(self, index, delta):
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        total, i = 0.0, self.size
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        '''
+        :return: index of the element whose weight interval contains value, 0 <= value < total()
+        '''
+        position, step = 0, 1 << self.size.bit_length()
+        while step > 0:
+            nextPosition = position + step
+            if nextPosition <= self.size and self.tree[nextPosition] <= value:
+                position = nextPosition
+                value -= self.tree[nextPosition]
+            step >>= 1
+        return min(position, self.size - 1)
+
+
+class ProxyPool:
+    '''
+    in-memory pool of the proxies in Mongo. Picking is weighted by success score and needs no database round trip;
+    feedback changes the weights right away and is written back to Mongo in batches. A background thread flushes
+    the feedback and reloads the pool every refreshInterval seconds.
+    '''
+
+    def __init__(self, db=None, refreshInterval: float = 60, maxProxies: int = MAX_PROXIES):
+        self._db = db
+        self.refreshInterval = refreshInterval
+        self.maxProxies = maxProxies
+        self.addresses = []
+        self.scores = []
+        self.meanLatencies = []
+        self._index = {}
+        self._tree = FenwickTree([])
+        self.aggregator = FeedbackAggregator(db)
+        self._lock = threading.Lock()
+        self._refresher = None
+        os.register_at_fork(after_in_child=self._resetAfterFork)
+
+    @property
+    def db(self):
+        return self._db if self._db is not None else getDB()
+
+    def pick(self, n=1, refreshIfEmpty=True):
+        '''
+        :param refreshIfEmpty: load the pool from Mongo first if it is empty. False for callers that must not block,
+            they call loadIfEmpty beforehand
+        '''
+        if n < 1:
+            raise ValueError("you must at least one proxy")
+        self._ensureRefresher()
+        if refreshIfEmpty:
+            self.loadIfEmpty()
+        with self._lock:
+            total = self._tree.total()
+            if self._tree.size == 0 or total <= 0:
+                raise ValueError("no proxies available!")
+            chosen = [self.addresses[self._tree.find(random.random() * total)] for _ in range(n)]
+        return chosen[0] if n == 1 else chosen
+
+    def loadIfEmpty(self):
+        with self._lock:
+            empty = self._tree.size == 0
+        if empty:
+            self.refresh()
+
+    def feedback(self, address, counter=1, latencyMs=None, errorClass=None):
+        '''
+        :param counter: +1 for a successful attempt, -1 for a failed one
+        :param latencyMs: duration of the attempt, if known
+        :param errorClass: see fetcherrors.ERROR_CLASSES, for failed attempts
+        '''
+        self.aggregator.add(address, counter, latencyMs, errorClass)
+        with self._lock:
+            i = self._index.get(address)
+            if i is None:
+                return
+            oldWeight = self._weight(i)
+            self.scores[i] = min(max(self.scores[i] + counter, SCORE_BOUNDS[0]), SCORE_BOUNDS[1])
+            self._tree.update(i, self._weight(i) - oldWeight)
+
+    def flush(self):
+        self.aggregator.flush()
+
+    def refresh(self):
+        proxies = list(self.db.proxies.find({"successful_job_completion": {"$gt": MIN_SCORE}},
+                                            {"address": 1, "successful_job_completion": 1, "latency_count": 1,
+                                             "latency_total_ms": 1}).limit(self.maxProxies))
+        with self._lock:
+            # feedback that is not flushed yet is not in Mongo, keep it in the scores
+            self.addresses = [proxy["address"] for proxy in proxies]
+            self.scores = [proxy.get("successful_job_completion", 0) + self.aggregator.pendingScore(proxy["address"])
+                           for proxy in proxies]
+            self.meanLatencies = [proxy["latency_total_ms"] / proxy["latency_count"] if proxy.get("latency_count")
+                                  else None for proxy in proxies]
+            self._index = {address: i for i, address in enumerate(self.addresses)}
+            self._tree = FenwickTree([self._weight(i) for i in range(len(self.addresses))])
+
+    def _weight(self, i):
+        return proxyWeight(self.scores[i], self.meanLatencies[i]) if self.scores[i] > MIN_SCORE else 0
+
+    def _ensureRefresher(self):
+        if self._refresher is None or not self._refresher.is_alive():
+            self._refresher = threading.Thread(target=self._refreshPeriodically, name="proxy-pool", daemon=True)
+            self._refresher.start()
+
+    def _refreshPeriodically(self):
+        while True:
+            time.sleep(self.refreshInterval)
+            try:
+                self.flush()
+                self.refresh()
+            except Exception as e:
+                print("could not refresh proxy pool: %s" % e)
+
+    def _resetAfterFork(self):
+        self._lock = threading.Lock()
+        self._refresher = None
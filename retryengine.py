@@ -0,0 +1,230 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+import traceback
+
+from fetcherrors import classifyError
+from metrics import FETCH_ERRORS, FETCH_SECONDS, FETCHES_IN_FLIGHT, PROXY_FETCH_SECONDS
+
+DEFAULT_WORKERS = 100
+DEFAULT_MAX_ATTEMPTS = 20
+
+
+class RetryPolicy:
+    '''
+    how to retry after a failed attempt of one error class
+
+    :param maxAttempts: failures of this class after which the URL is given up. 1 -> never retried
+    :param baseDelay: backoff before the first retry in seconds, doubled for every further failure of the class
+    :param maxDelay: upper bound of the backoff
+    '''
+
+    def __init__(self, maxAttempts: int = DEFAULT_MAX_ATTEMPTS, baseDelay: float = 0.0, maxDelay: float = 30.0):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+
+    def delay(self, failures: int) -> float:
+        '''
+        jittered exponential backoff: somewhere between half and all of baseDelay * 2 ^ (failures - 1)
+        '''
+        delay = min(self.maxDelay, self.baseDelay * 2 ** (failures - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+
+# keys are fetcherrors.ERROR_CLASSES. every attempt runs through another proxy, so proxy errors are retried right away
+# while captchas and timeouts give the site some air
+DEFAULT_RETRY_POLICIES = {
+    "captcha": RetryPolicy(baseDelay=1.0, maxDelay=30.0),
+    "timeout": RetryPolicy(maxAttempts=6, baseDelay=0.5, maxDelay=10.0),
+    "ssl": RetryPolicy(maxAttempts=3),
+    "proxy": RetryPolicy(),
+    "connection": RetryPolicy(baseDelay=0.2, maxDelay=5.0),
+    "other": RetryPolicy(maxAttempts=1),
+}
+
+
+class AttemptCancelled(Exception):
+    '''
+    raised by an attempt function that noticed its cancellation event, because a hedged attempt won
+    '''
+
+
+class RetryJob:
+    def __init__(self, req):
+        self.req = req
+        self.attempts = 0
+        self.inFlight = 0
+        self.failures = {}
+        self.done = False
+        self.cancelled = threading.Event()
+
+
+class RetryEngine:
+    '''
+    fetches with a fixed number of worker threads taking attempts from a priority queue ordered by the time an attempt
+    may start. Failed attempts go back into the queue after their error class' backoff, so neither threads nor memory
+    grow with the number of failing proxies. Every URL has a hard budget of maxAttempts, hedged attempts included.
+
+    :param policies: dict of error class -> RetryPolicy overriding DEFAULT_RETRY_POLICIES
+    :param hedgeAfter: seconds after which a second attempt through another proxy is started if the first one hasn't
+        finished. The first to succeed wins, the other one is cancelled. At most two attempts per URL run at the same
+        time. None -> no hedging
+    '''
+
+    def __init__(self, numWorkers: int = DEFAULT_WORKERS, maxAttempts: int = DEFAULT_MAX_ATTEMPTS,
+                 policies: dict = None, hedgeAfter: float = None):
+        self.numWorkers = numWorkers
+        self.maxAttempts = maxAttempts
+        self.policies = dict(DEFAULT_RETRY_POLICIES, **(policies or {}))
+        self.hedgeAfter = hedgeAfter
+
+    def fetch(self, fetchRequests, attempt, proxyPool=None, onResult=None):
+        '''
+        runs attempts until each request succeeded or used up its budget, and blocks until then.
+
+        :param fetchRequests: list of fetchengine.FetchRequest
+        :param attempt: callable(request, proxy, cancelled: threading.Event) -> result. raises on failure; should check
+            the event while downloading and raise AttemptCancelled once it is set
+        :param proxyPool: picks a proxy for every attempt and gets feedback on it, see proxyhandling.ProxyPool
+        :param onResult: optional callable(request, result), called by the worker as soon as a result is ready
+        :return: dict of request key -> result for all successful requests, None for those handed to onResult
+        '''
+        run = RetryRun(self, attempt, proxyPool, onResult)
+        with run._condition:
+            for req in fetchRequests:
+                run.schedule(RetryJob(req), 0.0)
+            run.pending = len(fetchRequests)
+        attemptsInFlight = len(fetchRequests) * (2 if self.hedgeAfter is not None else 1)
+        workers = [threading.Thread(target=run.work, name="retry-worker-%s" % i, daemon=True)
+                   for i in range(min(self.numWorkers, attemptsInFlight))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return run.results
+
+
+class RetryRun:
+    '''
+    state of one RetryEngine.fetch call, shared by its workers
+    '''
+
+    def __init__(self, engine, attempt, proxyPool, onResult):
+        self.engine = engine
+        self.attempt = attempt
+        self.proxyPool = proxyPool
+        self.onResult = onResult
+        self.results = {}
+        self.pending = 0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def schedule(self, job, delay, hedge=False):
+        # retries line up behind fresh requests that became ready at the same time
+        heapq.heappush(self._queue, (time.monotonic() + delay, job.attempts, next(self._sequence), job, hedge))
+        self._condition.notify()
+
+    def work(self):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    if self.pending == 0:
+                        self._condition.notify_all()
+                        return
+                    if not self._queue:
+                        self._condition.wait()
+                        continue
+                    readyAt, attempts, _, candidate, hedge = self._queue[0]
+                    wait = readyAt - time.monotonic()
+                    if wait > 0:
+                        self._condition.wait(wait)
+                        continue
+                    heapq.heappop(self._queue)
+                    if candidate.done or (hedge and (candidate.attempts != attempts or candidate.inFlight != 1)):
+                        continue  # stale hedge: the attempt it should back up has already finished
+                    job = candidate
+                job.attempts += 1
+                job.inFlight += 1
+                if self.engine.hedgeAfter is not None and job.inFlight == 1 and job.attempts < self.engine.maxAttempts:
+                    self.schedule(job, self.engine.hedgeAfter, hedge=True)
+            self._runAttempt(job)
+
+    def _runAttempt(self, job):
+        req = job.req
+        proxy = None
+        attemptStart = time.perf_counter()
+        FETCHES_IN_FLIGHT.inc(1, "threads")
+        try:
+            proxy = self.proxyPool.pick() if self.proxyPool is not None else None
+            result = self.attempt(req, proxy, job.cancelled)
+        except AttemptCancelled:
+            with self._condition:
+                job.inFlight -= 1
+            return
+        except Exception as e:
+            self._failed(job, proxy, e)
+            return
+        finally:
+            FETCHES_IN_FLIGHT.dec(1, "threads")
+            latencyMs = (time.perf_counter() - attemptStart) * 1000
+            FETCH_SECONDS.observe(latencyMs / 1000, req.host)
+        with self._condition:
+            job.inFlight -= 1
+            won = not job.done
+            job.done = True
+        if self.proxyPool is not None:
+            PROXY_FETCH_SECONDS.observe(latencyMs / 1000, proxy)
+            self._feedback(proxy, 1, latencyMs)
+        if not won:
+            return  # a hedged attempt got there first
+        job.cancelled.set()
+        # the job is settled: whatever onResult raises, fetch must not wait for it forever
+        try:
+            if self.onResult is not None:
+                self.onResult(req, result)
+                result = None
+            self.results[req.key] = result
+        except Exception:
+            print("could not hand over the result for url %s: %s" % (req.key, traceback.format_exc()))
+        finally:
+            self._finished()
+
+    def _failed(self, job, proxy, error):
+        errorClass = classifyError(error)
+        FETCH_ERRORS.inc(1, errorClass)
+        policy = self.engine.policies[errorClass]
+        givenUp = False
+        with self._condition:
+            job.inFlight -= 1
+            job.failures[errorClass] = job.failures.get(errorClass, 0) + 1
+            if not job.done and job.inFlight == 0:  # otherwise the result is up to the attempt still running
+                if job.failures[errorClass] < policy.maxAttempts and job.attempts < self.engine.maxAttempts:
+                    self.schedule(job, policy.delay(job.failures[errorClass]))
+                else:
+                    job.done = givenUp = True
+        if self.proxyPool is not None and proxy is not None:
+            self._feedback(proxy, -1, errorClass=errorClass)
+        if not givenUp:
+            return
+        if errorClass == "other":
+            print("encountered exception on url %s: %s" % (job.req.key, traceback.format_exc()))
+        else:
+            print("I'm giving up fetching URL %s after %s attempts" % (job.req.key, job.attempts))
+        self._finished()
+
+    def _feedback(self, proxy, counter, latencyMs=None, errorClass=None):
+        try:
+            self.proxyPool.feedback(proxy, counter, latencyMs, errorClass=errorClass)
+        except Exception as e:
+            print("could not give feedback on proxy %s: %s" % (proxy, e))
+
+    def _finished(self):
+        with self._condition:
+            self.pending -= 1
+            if self.pending == 0:
+                self._condition.notify_all()
@@ -0,0 +1,46 @@
+import threading
+
+# response header -> field of the stored page, and the request header that sends it back
+VALIDATORS = [("ETag", "etag", "If-None-Match"), ("Last-Modified", "last_modified", "If-Modified-Since")]
+VALIDATOR_FIELDS = [field for _, field, _ in VALIDATORS]
+
+
+def validatorFields(responseHeaders):
+    '''
+    :return: dict of the validator fields to store with a page, for the validators the response came with
+    '''
+    if responseHeaders is None:
+        return {}
+    return {field: responseHeaders[header] for header, field, _ in VALIDATORS if responseHeaders.get(header)}
+
+
+def conditionalHeaders(stalePage):
+    '''
+    :param stalePage: stored page (or its validator fields) that went stale, None if there is none
+    :return: dict of request headers asking the origin to answer 304 if the page did not change
+    '''
+    if not stalePage:
+        return {}
+    return {requestHeader: stalePage[field] for _, field, requestHeader in VALIDATORS if stalePage.get(field)}
+
+
+class RevalidationStats:
+    def __init__(self):
+        self.conditionalRequests = 0
+        self.notModified = 0
+        self.bytesSaved = 0
+        self._lock = threading.Lock()
+
+    def requested(self, count=1):
+        with self._lock:
+            self.conditionalRequests += count
+
+    def notModifiedPage(self, size):
+        with self._lock:
+            self.notModified += 1
+            self.bytesSaved += size or 0
+
+    def stats(self):
+        with self._lock:
+            return {"conditional_requests": self.conditionalRequests, "not_modified": self.notModified,
+                    "bytes_saved": self.bytesSaved}
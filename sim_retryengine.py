@@ -0,0 +1,128 @@
+'''
+checks the retry engine of the "process" fetch path:
+
+- failing proxies: half of the proxies refuse connections. Every page must still arrive, no URL may use more than
+  its attempt budget and the number of worker threads must stay at the configured bound
+- dead URLs: a URL that fails on every proxy is given up after exactly maxAttempts attempts
+- hedging: stalling first attempts get a hedged second attempt, the first success wins and the stalled
+  attempt is cancelled
+
+No Mongo needed.
+
+usage: python sim_retryengine.py [numURLs]
+'''
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+import data_service
+from fetchengine import FetchRequest
+from retryengine import AttemptCancelled, RetryEngine
+from stuborigin import StubOrigin, StubProxy
+
+NUM_WORKERS = 20
+MAX_ATTEMPTS = 20
+DEAD_PROXY = "http://127.0.0.1:1"
+
+
+class FlakyProxyPool:
+    '''
+    hands out a working proxy with probability `healthy`, a dead one otherwise
+    '''
+
+    def __init__(self, proxy, healthy):
+        self.proxy = proxy
+        self.healthy = healthy
+        self.feedbacks = Counter()
+        self._lock = threading.Lock()
+
+    def pick(self):
+        return self.proxy if random.random() < self.healthy else DEAD_PROXY
+
+    def feedback(self, address, counter, latencyMs=None, errorClass=None):
+        with self._lock:
+            self.feedbacks[counter] += 1
+
+
+def countingAttempt(attempts, maxThreads, fail=lambda req: False):
+    lock = threading.Lock()
+
+    def attempt(req, proxy, cancelled):
+        with lock:
+            attempts[req.key] += 1
+            workers = sum(1 for thread in threading.enumerate() if thread.name.startswith("retry-worker"))
+            maxThreads[0] = max(maxThreads[0], workers)
+        if fail(req):
+            proxy = DEAD_PROXY
+        return data_service.obtainPage(req.urlTuple, "GET", "json", proxy, cancelled)
+
+    return attempt
+
+
+def checkFailingProxies(numURLs):
+    with StubOrigin(latency=0.01) as origin, StubProxy() as proxy:
+        engine = RetryEngine(NUM_WORKERS, MAX_ATTEMPTS)
+        pool = FlakyProxyPool(proxy.address, healthy=0.5)
+        attempts, maxThreads = Counter(), [0]
+        urls = ["%s/page/%s" % (origin.baseURL, i) for i in range(numURLs)]
+        results = engine.fetch([FetchRequest(url, (url, "{}")) for url in urls],
+                               countingAttempt(attempts, maxThreads), pool)
+        print("failing proxies: fetched %s/%s pages in %s attempts, max %s attempts per url, %s worker threads" % (
+            len(results), numURLs, sum(attempts.values()), max(attempts.values()), maxThreads[0]))
+        assert len(results) == numURLs
+        assert max(attempts.values()) <= MAX_ATTEMPTS
+        assert maxThreads[0] <= NUM_WORKERS
+        assert pool.feedbacks[1] == numURLs and pool.feedbacks[-1] == sum(attempts.values()) - numURLs
+
+
+def checkDeadURLs():
+    with StubOrigin() as origin:
+        engine = RetryEngine(NUM_WORKERS, MAX_ATTEMPTS)
+        attempts, maxThreads = Counter(), [0]
+        urls = ["%s/page/%s" % (origin.baseURL, i) for i in range(10)]
+        start = time.perf_counter()
+        results = engine.fetch([FetchRequest(url, (url, "{}")) for url in urls],
+                               countingAttempt(attempts, maxThreads, fail=lambda req: req.url.endswith("/0")),
+                               FlakyProxyPool(None, healthy=1))
+        print("dead url: %s attempts, the others %s, %.1fs" % (
+            attempts[urls[0]], max(attempts[url] for url in urls[1:]), time.perf_counter() - start))
+        assert len(results) == 9 and urls[0] not in results
+        assert attempts[urls[0]] == MAX_ATTEMPTS
+
+
+def checkHedging():
+    stalls, cancellations = Counter(), Counter()
+
+    def attempt(req, proxy, cancelled):
+        if stalls[req.key] == 0:  # the first attempt of every url hangs
+            stalls[req.key] += 1
+            if cancelled.wait(30):
+                cancellations[req.key] += 1
+                raise AttemptCancelled()
+            raise AssertionError("stalled attempt was never cancelled")
+        return req.key
+
+    engine = RetryEngine(NUM_WORKERS, MAX_ATTEMPTS, hedgeAfter=0.2)
+    start = time.perf_counter()
+    results = engine.fetch([FetchRequest(i, ("http://example.com/%s" % i, "{}")) for i in range(10)], attempt,
+                           FlakyProxyPool(None, healthy=1))
+    duration = time.perf_counter() - start
+    while sum(cancellations.values()) < sum(stalls.values()) and time.perf_counter() - start < 5:
+        time.sleep(0.01)
+    print("hedging: %s pages in %.2fs, %s stalled attempts, %s of them cancelled" % (
+        len(results), duration, sum(stalls.values()), sum(cancellations.values())))
+    assert results == {i: i for i in range(10)}
+    assert duration < 1
+    assert sum(cancellations.values()) == sum(stalls.values()) == 10
+
+
+def run(numURLs=300):
+    checkFailingProxies(numURLs)
+    checkDeadURLs()
+    checkHedging()
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,279 @@
+import os
+import threading
+import time
+
+import pymongo
+from pymongo import monitoring
+
+from metrics import CommandMetrics
+
+MONGO_LOCATION = "127.0.0.1"
+MONGO_DATABASE = "webdata"
+MAX_POOL_SIZE = 200
+WAIT_QUEUE_TIMEOUT_MS = 30000
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    '''
+    counts connections of the process-wide client. Wait time is measured between the start of a checkout and the
+    moment a connection was handed out.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def resetAfterFork(self):
+        # another thread may have held the lock at fork time, the child would wait for it forever
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.created = 0
+            self.closed = 0
+            self.checkedOut = 0
+            self.checkouts = 0
+            self.checkoutFailures = 0
+            self.totalWaitMs = 0.0
+            self.maxWaitMs = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {"connections_created": self.created, "connections_closed": self.closed,
+                    "connections_open": self.created - self.closed, "checked_out": self.checkedOut,
+                    "checkouts": self.checkouts, "checkout_failures": self.checkoutFailures,
+                    "avg_wait_ms": self.totalWaitMs / self.checkouts if self.checkouts else 0.0,
+                    "max_wait_ms": self.maxWaitMs}
+
+    def connection_check_out_started(self, event):
+        self._local.checkoutStart = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        waitMs = (time.perf_counter() - getattr(self._local, "checkoutStart", time.perf_counter())) * 1000
+        with self._lock:
+            self.checkedOut += 1
+            self.checkouts += 1
+            self.totalWaitMs += waitMs
+            self.maxWaitMs = max(self.maxWaitMs, waitMs)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkoutFailures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checkedOut -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+
+poolMetrics = PoolMetrics()
+commandMetrics = CommandMetrics()
+_client = None
+_clientPid = None
+_clientLock = threading.Lock()
+
+
+def getClient() -> pymongo.MongoClient:
+    '''
+    returns the pooled MongoClient of this process. A process forked from a parent that already had a client gets its
+    own one, pymongo clients must not be shared across a fork.
+    '''
+    global _client, _clientPid
+    if _client is not None and _clientPid == os.getpid():
+        return _client
+    with _clientLock:
+        if _client is None or _clientPid != os.getpid():
+            _client = pymongo.MongoClient(MONGO_LOCATION, maxPoolSize=MAX_POOL_SIZE,
+                                          waitQueueTimeoutMS=WAIT_QUEUE_TIMEOUT_MS, connect=False,
+                                          event_listeners=[poolMetrics, commandMetrics])
+            _clientPid = os.getpid()
+    return _client
+
+
+def getDB():
+    return getClient()[MONGO_DATABASE]
+
+
+def poolStats():
+    return poolMetrics.snapshot()
+
+
+def _forgetClientAfterFork():
+    global _client, _clientPid, _clientLock
+    _client, _clientPid = None, None
+    _clientLock = threading.Lock()
+    poolMetrics.resetAfterFork()
+
+
+os.register_at_fork(after_in_child=_forgetClientAfterFork)
+
+
+class BulkWriteBuffer:
+    '''
+    write-behind buffer for upserts into one collection. Documents are keyed by `keyField` (a later document for the
+    same key replaces the pending one) and written with one unordered bulk_write as soon as `maxSize` documents are
+    pending or `maxDelay` seconds passed. Documents of a failed flush go back into the buffer, so nothing is lost
+    when Mongo hiccups, and documents the bulk write rejected (e.g. a duplicate key from a concurrent upsert) are
+    written once more right away; call flush() before reading the collection to see everything that was added.
+    update() buffers a partial $set for a document that is already stored instead of a whole replacement.
+    '''
+
+    def __init__(self, collectionName: str, keyField: str, maxSize: int = 500, maxDelay: float = 1.0, nTries: int = 3):
+        self.collectionName = collectionName
+        self.keyField = keyField
+        self.maxSize = maxSize
+        self.maxDelay = maxDelay
+        self.nTries = nTries
+        self.flushes = 0
+        self.written = 0
+        self.failedFlushes = 0
+        self.retriedWrites = 0
+        self.failedWrites = 0
+        self._pending = {}
+        self._updates = {}
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._timer = None
+        os.register_at_fork(after_in_child=self._resetAfterFork)
+
+    def add(self, doc):
+        with self._lock:
+            self._pending[doc[self.keyField]] = doc
+            self._updates.pop(doc[self.keyField], None)
+            full = len(self._pending) + len(self._updates) >= self.maxSize
+            self._ensureTimer()
+        if full:
+            self.flush()
+
+    def update(self, key, fields: dict):
+        '''
+        sets `fields` on the stored document with this key, or on the pending one if it wasn't written yet
+        '''
+        with self._lock:
+            if key in self._pending:
+                self._pending[key].update(fields)
+                return
+            self._updates.setdefault(key, {}).update(fields)
+            full = len(self._pending) + len(self._updates) >= self.maxSize
+            self._ensureTimer()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flushLock:
+            with self._lock:
+                docs, self._pending = self._pending, {}
+                updates, self._updates = self._updates, {}
+            if not docs and not updates:
+                return
+            for nTry in range(self.nTries):
+                try:
+                    self._write(docs, updates)
+                    self.flushes += 1
+                    self.written += len(docs) + len(updates)
+                    return
+                except pymongo.errors.BulkWriteError as e:
+                    failedDocs, failedUpdates = self._rejected(docs, updates, e)
+                    self.flushes += 1
+                    self.written += len(docs) + len(updates) - len(failedDocs) - len(failedUpdates)
+                    self._retryRejected(failedDocs, failedUpdates)
+                    return
+                except pymongo.errors.AutoReconnect:
+                    print("pymongo error in bulk write: could not autoreconnect (try %s)" % nTry)
+                except Exception:
+                    self._requeue(docs, updates)
+                    raise
+            self._requeue(docs, updates)
+
+    def _rejected(self, docs, updates, error):
+        '''
+        :return: tuple(docs, updates) of the operations the bulk write error names, _write sends docs before updates
+        '''
+        keys = list(docs) + list(updates)
+        rejected = [keys[writeError["index"]] for writeError in error.details.get("writeErrors", [])]
+        return {key: docs[key] for key in rejected if key in docs}, \
+               {key: updates[key] for key in rejected if key not in docs}
+
+    def _retryRejected(self, docs, updates):
+        self.retriedWrites += len(docs) + len(updates)
+        try:
+            self._write(docs, updates)
+            self.written += len(docs) + len(updates)
+        except pymongo.errors.BulkWriteError as e:
+            failedDocs, failedUpdates = self._rejected(docs, updates, e)
+            failed = len(failedDocs) + len(failedUpdates)
+            self.written += len(docs) + len(updates) - failed
+            self.failedWrites += failed
+            print("bulk write into %s rejected %s documents twice, dropping them: %s" % (
+                self.collectionName, failed, e.details.get("writeErrors", [])[:3]))
+        except Exception:
+            self._requeue(docs, updates)
+            raise
+
+    def _write(self, docs, updates):
+        operations = [pymongo.ReplaceOne({self.keyField: key}, doc, upsert=True) for key, doc in docs.items()] + \
+                     [pymongo.UpdateOne({self.keyField: key}, {"$set": fields}) for key, fields in updates.items()]
+        getDB()[self.collectionName].bulk_write(operations, ordered=False)
+
+    def _requeue(self, docs, updates):
+        self.failedFlushes += 1
+        with self._lock:
+            for key, doc in docs.items():
+                self._pending.setdefault(key, doc)
+            for key, fields in updates.items():
+                if key not in self._pending:
+                    self._updates[key] = dict(fields, **self._updates.get(key, {}))
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending) + len(self._updates)
+        return {"pending": pending, "flushes": self.flushes, "written": self.written,
+                "failed_flushes": self.failedFlushes, "retried_writes": self.retriedWrites,
+                "failed_writes": self.failedWrites}
+
+    def _ensureTimer(self):
+        if self._timer is None or not self._timer.is_alive():
+            self._timer = threading.Thread(target=self._flushPeriodically, name="flush-%s" % self.collectionName,
+                                           daemon=True)
+            self._timer.start()
+
+    def _flushPeriodically(self):
+        while True:
+            time.sleep(self.maxDelay)
+            try:
+                self.flush()
+            except Exception as e:
+                print("periodic flush of %s failed: %s" % (self.collectionName, e))
+
+    def _resetAfterFork(self):
+        # the parent flushes what it buffered, the child only writes its own documents
+        self._pending = {}
+        self._updates = {}
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._timer = None
@@ -0,0 +1,256 @@
+import hashlib
+import http.client
+import json
+import threading
+import time
+from collections import deque
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class StubOriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        self._respond()
+
+    def _respond(self):
+        origin = self.server.origin
+        throttled = origin.countRequest(self.path)
+        if origin.latency:
+            time.sleep(origin.latency)
+        if origin.failsFirst(self.path, origin.errorRate, "error"):
+            self.close_connection = True  # hang up without an answer, like an overloaded server
+            return
+        throttled = throttled or origin.failsFirst(self.path, origin.captchaRate, "captcha")
+        body = CAPTCHA_PAGE if throttled else origin.body(self.path)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        if origin.validators and not throttled and origin.notModified(self.headers, etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        origin.countBytes(len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html" if throttled else "application/json")
+        if origin.validators and not throttled:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", formatdate(origin.lastModified, usegmt=True))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+CAPTCHA_PAGE = b'<html><body><script src="https://www.google.com/recaptcha/api.js"></script></body></html>'
+
+
+class StubOriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+class StubOrigin:
+    '''
+    local HTTP server standing in for the pages we cache. Serves a JSON document of roughly `size` bytes for every path
+    after waiting `latency` seconds, and counts how often each path was requested.
+
+    :param captchaAboveRps: if given, requests arriving while more than this many requests came in during the last
+        second get a recaptcha page instead, like a rate limiting site would serve
+    :param validators: send ETag and Last-Modified and answer conditional requests for unchanged pages with a 304.
+        Bump revisions[path] to change a page
+    :param ignoreQuery: serve the same body for every query string of a path, like pages with tracking parameters
+    :param errorRate: share of the paths whose first request is dropped without an answer
+    :param captchaRate: share of the paths whose first request gets a recaptcha page. Which paths fail is decided by
+        their hash, so every run with the same paths sees the same failures
+    '''
+
+    def __init__(self, latency: float = 0.0, size: int = 2048, host: str = "127.0.0.1", port: int = 0,
+                 captchaAboveRps: float = None, validators: bool = False, ignoreQuery: bool = False,
+                 errorRate: float = 0.0, captchaRate: float = 0.0):
+        self.latency = latency
+        self.size = size
+        self.captchaAboveRps = captchaAboveRps
+        self.errorRate = errorRate
+        self.captchaRate = captchaRate
+        self.validators = validators
+        self.ignoreQuery = ignoreQuery
+        self.lastModified = int(time.time()) - 3600
+        self.revisions = {}
+        self.requestCounts = {}
+        self.captchas = 0
+        self.errors = 0
+        self.notModifiedCount = 0
+        self.bytesSent = 0
+        self._recentRequests = deque()
+        self._lock = threading.Lock()
+        self._server = StubOriginServer((host, port), StubOriginHandler)
+        self._server.origin = self
+        self._thread = None
+
+    @property
+    def baseURL(self):
+        return "http://%s:%s" % self._server.server_address[:2]
+
+    def countRequest(self, path) -> bool:
+        '''
+        :return: whether the request exceeds captchaAboveRps and should get a captcha page
+        '''
+        now = time.monotonic()
+        with self._lock:
+            self.requestCounts[path] = self.requestCounts.get(path, 0) + 1
+            if self.captchaAboveRps is None:
+                return False
+            self._recentRequests.append(now)
+            while self._recentRequests[0] < now - 1:
+                self._recentRequests.popleft()
+            throttled = len(self._recentRequests) > self.captchaAboveRps
+            self.captchas += throttled
+            return throttled
+
+    def failsFirst(self, path, rate, kind) -> bool:
+        '''
+        :return: whether this is the first request of a path that fails with kind ("error" or "captcha") at rate
+        '''
+        if not rate:
+            return False
+        digest = hashlib.sha1(("%s:%s" % (kind, path)).encode()).digest()
+        if int.from_bytes(digest[:4], "big") >= rate * 2 ** 32:
+            return False
+        with self._lock:
+            if self.requestCounts.get(path) != 1:
+                return False
+            if kind == "error":
+                self.errors += 1
+            else:
+                self.captchas += 1
+        return True
+
+    def notModified(self, requestHeaders, etag) -> bool:
+        if "If-None-Match" in requestHeaders:
+            unchanged = etag in [tag.strip() for tag in requestHeaders["If-None-Match"].split(",")]
+        elif "If-Modified-Since" in requestHeaders:
+            unchanged = parsedate_to_datetime(requestHeaders["If-Modified-Since"]).timestamp() >= self.lastModified
+        else:
+            return False
+        if unchanged:
+            with self._lock:
+                self.notModifiedCount += 1
+        return unchanged
+
+    def countBytes(self, numBytes):
+        with self._lock:
+            self.bytesSent += numBytes
+
+    def body(self, path):
+        if self.ignoreQuery:
+            path = urlsplit(path).path
+        payload = {"path": path, "revision": self.revisions.get(path, 0), "padding": ""}
+        padding = max(0, self.size - len(json.dumps(payload)))
+        payload["padding"] = "x" * padding
+        return json.dumps(payload).encode()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class StubProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._forward()
+
+    def do_POST(self):
+        self._forward()
+
+    def _forward(self):
+        self.server.proxy.countRequest()
+        target = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else None
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+        try:
+            path = target.path + ("?%s" % target.query if target.query else "")
+            connection.request(self.command, path or "/", body=body, headers={
+                key: value for key, value in self.headers.items() if key.lower() not in HOP_BY_HOP_HEADERS})
+            response = connection.getresponse()
+            content = response.read()
+        except http.client.RemoteDisconnected:
+            self.close_connection = True  # pass the hang up on, a 502 would be stored as the page
+            return
+        except OSError as e:
+            self.send_error(502, str(e))
+            return
+        finally:
+            connection.close()
+        self.send_response(response.status)
+        for key, value in response.getheaders():
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != "content-length":
+                self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-connection", "proxy-authorization", "te", "trailers",
+                      "transfer-encoding", "upgrade"}
+
+
+class StubProxy:
+    '''
+    minimal forward proxy for plain HTTP, so fetches can run through "proxies" without leaving the machine
+    '''
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = StubOriginServer((host, port), StubProxyHandler)
+        self._server.proxy = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return "http://%s:%s" % self._server.server_address[:2]
+
+    def countRequest(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,98 @@
+import io
+import json
+import random
+from datetime import datetime, timedelta
+
+import pymongo
+
+import blobstore
+import pagecodecs
+import storage
+from stuborigin import StubOrigin
+from webcacheclient import FRAMES_MIMETYPE, readFrames, resolveContentRefs
+
+NUM_PATHS = 10
+VARIANTS_PER_PATH = 5
+
+
+def decompressed(pages):
+    return {page["urlKey"]: pagecodecs.decompress(page["content_raw"], page["codec"]) for page in pages}
+
+
+def fetchFrames(service, urls, **resolveArguments):
+    response = service.app.test_client().post("/fetch/1/test/json/GET", data={"urls": json.dumps(urls)},
+                                              headers={"Accept": FRAMES_MIMETYPE})
+    frames = list(readFrames(io.BytesIO(response.data)))
+    return frames, {pageData["urlKey"]: pagecodecs.decompress(blob, pageData["codec"])
+                    for pageData, blob in resolveContentRefs(frames, **resolveArguments)}
+
+
+def test_identical_bodies_are_stored_and_sent_once(service, mongo):
+    with StubOrigin(host="127.0.0.2", ignoreQuery=True) as origin:
+        urls = [("%s/page/%s?utm_source=%s" % (origin.baseURL, i, j), "{}")
+                for i in range(NUM_PATHS) for j in range(VARIANTS_PER_PATH)]
+        pages = decompressed(service.iterData(urls, "GET", 1, "test", "json"))
+        service.pageWriteBuffer.flush()
+        report = service.storageReport()
+        assert len(pages) == NUM_PATHS * VARIANTS_PER_PATH
+        assert report["blobs"] == NUM_PATHS and report["references"] == NUM_PATHS * VARIANTS_PER_PATH
+        assert report["inline_pages"] == 0 and report["dedup_ratio"] == VARIANTS_PER_PATH
+        assert mongo.webpages.count_documents({"content_raw": {"$exists": True}}) == 0
+
+        frames, framedPages = fetchFrames(service, urls)
+        assert framedPages == pages
+        assert sum(len(blob) for _, blob in frames) == report["stored_bytes"]
+
+        # the first path changes after it expired: its variants move to a new blob and the old one goes away
+        mongo.webpages.update_many({"urlKey": {"$regex": "/page/0/"}},
+                                   {"$set": {"creation_date": datetime.now() - timedelta(days=2)}})
+        origin.revisions["/page/0"] = 1
+        refetched = decompressed(service.iterData(urls[:VARIANTS_PER_PATH], "GET", 1, "test", "json"))
+        service.pageWriteBuffer.flush()
+    report = service.storageReport()
+    assert all(b'"revision": 1' in content for content in refetched.values())
+    assert report["blobs"] == NUM_PATHS and report["references"] == NUM_PATHS * VARIANTS_PER_PATH
+
+
+def test_references_stay_within_the_dedupe_window(service, mongo, monkeypatch):
+    monkeypatch.setattr(blobstore, "BLOB_BATCH_SIZE", 5)
+    monkeypatch.setattr(service, "CONTENT_REF_WINDOW", 3)
+    with StubOrigin(host="127.0.0.2", ignoreQuery=True) as origin:
+        rand = random.Random(0)
+        urls = [("%s/page/%s?utm_source=%s" % (origin.baseURL, rand.randrange(6), j), "{}") for j in range(60)]
+        pages = decompressed(service.iterData(urls, "GET", 1, "test", "json"))
+        service.pageWriteBuffer.flush()
+        frames, framedPages = fetchFrames(service, urls, window=3)
+    assert framedPages == pages
+    references = [pageData for pageData, blob in frames if not blob]
+    assert 0 < len(references) < len(frames) - 6  # more blobs went out than the 6 distinct ones
+
+
+def test_pages_written_next_to_a_rejected_one_release_their_blobs(mongo, monkeypatch):
+    buffer = blobstore.PageWriteBuffer(maxDelay=60)
+
+    def storeRevision(revision):
+        for key in "abc":
+            content = ("%s revision %s" % (key, revision)).encode()
+            buffer.add({"urlKey": key, "content_hash": blobstore.contentHash(content), "content_raw": content,
+                        "codec": "identity", "size": len(content)})
+        buffer.flush()
+
+    storeRevision(0)
+    write, rejections = storage.BulkWriteBuffer._write, ["b"]
+
+    def rejectOnce(self, docs, updates):
+        if not rejections or rejections[0] not in docs:
+            return write(self, docs, updates)
+        rejectedKey = rejections.pop()
+        write(self, {key: doc for key, doc in docs.items() if key != rejectedKey}, updates)
+        raise pymongo.errors.BulkWriteError({"writeErrors": [
+            {"index": list(docs).index(rejectedKey), "code": 11000, "errmsg": "E11000 duplicate key error"}]})
+
+    monkeypatch.setattr(storage.BulkWriteBuffer, "_write", rejectOnce)
+    storeRevision(1)
+    assert not rejections
+    report = blobstore.storageReport(mongo)
+    assert report["blobs"] == report["references"] == 3
+    assert sorted(page["content_hash"] for page in mongo.webpages.find()) == sorted(
+        blob["_id"] for blob in mongo.blobs.find())
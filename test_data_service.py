@@ -0,0 +1,71 @@
+import base64
+import bz2
+import gzip
+import json
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+import data_service
+from stuborigin import StubOrigin
+from webcacheclient import CODECS_HEADER
+
+
+def test_slow_reader_holds_back_the_fetch(service, monkeypatch):
+    monkeypatch.setattr(data_service, "FETCH_RESULT_QUEUE_SIZE", 5)
+    monkeypatch.setattr(data_service, "FETCH_MAX_PENDING", 10)
+    with StubOrigin(host="127.0.0.2") as origin:
+        urls = [("%s/page/%s" % (origin.baseURL, i), "{}") for i in range(300)]
+        pages = data_service.iterData(urls, "GET", 30, "test", "json")
+        first = next(pages)
+        time.sleep(1.5)
+        # without backpressure all 300 pages would be downloaded by now and wait in memory for the reader
+        assert sum(origin.requestCounts.values()) < 40
+        rest = list(pages)
+    assert len(rest) + 1 == 300
+    assert all("error" not in page for page in [first] + rest)
+
+
+def postGzipped(body, **headers):
+    return data_service.app.test_client().post("/fetch/1/test/json/GET", data=body, headers=dict(
+        {"Content-Encoding": "gzip", "Content-Type": "application/x-www-form-urlencoded"}, **headers))
+
+
+def test_gzipped_request_body_is_inflated(service):
+    response = postGzipped(gzip.compress(urlencode({"urls": "[]"}).encode()))
+    assert response.status_code == 200 and response.get_json() == {"response": []}
+
+
+@pytest.mark.parametrize("body", [b"no gzip at all", gzip.compress(b"urls=%5B%5D")[:-12]])
+def test_invalid_gzip_request_body_is_rejected(body):
+    response = postGzipped(body)
+    assert response.status_code == 400 and "gzip" in response.get_json()["error"]
+
+
+def test_gzip_bomb_is_rejected(monkeypatch):
+    monkeypatch.setattr(data_service.app.wsgi_app, "maxBytes", 1024)
+    response = postGzipped(gzip.compress(b"urls=" + b"x" * 10 ** 6))
+    assert response.status_code == 413
+
+
+def test_json_response_is_readable_by_clients_without_codecs(service):
+    with StubOrigin(host="127.0.0.2") as origin:
+        urls = ["%s/page/%s" % (origin.baseURL, i) for i in range(5)]
+        form = {"urls": json.dumps([(url, "{}") for url in urls])}
+        legacy = service.app.test_client().post("/fetch/1/test/json/GET", data=form).get_json()["response"]
+        current = service.app.test_client().post("/fetch/1/test/json/GET", data=form,
+                                                 headers={CODECS_HEADER: "zlib, zstd"}).get_json()["response"]
+    # what clients from before the codecs do with a page
+    contents = [json.loads(bz2.decompress(base64.b64decode(page["content_raw_bz2"][2:]))) for page in legacy]
+    assert sorted(content["path"] for content in contents) == sorted("/page/%s" % i for i in range(5))
+    assert not [page for page in legacy if "content_raw" in page or "codec" in page]
+    assert {page["codec"] for page in current} == {"zlib"} and not [page for page in current if "content_raw_bz2" in page]
+
+
+def test_download_duration_is_marked_as_milliseconds(service, mongo):
+    with StubOrigin(latency=0.2, host="127.0.0.2") as origin:
+        service.getData([("%s/page/0" % origin.baseURL, "{}")], "GET", 1, "test", "json")
+    service.pageWriteBuffer.flush()
+    page = mongo.webpages.find_one()
+    assert page["download_duration_unit"] == "ms" and 200 <= page["download_duration_ms"] < 10000
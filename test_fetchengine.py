@@ -0,0 +1,55 @@
+import pytest
+
+from fetchengine import AsyncFetchEngine, FetchRequest
+from hostscheduler import HostPolicy
+from proxyhandling import ProxyPool
+from stuborigin import StubOrigin, StubProxy
+
+
+@pytest.fixture
+def engine():
+    engine = AsyncFetchEngine(defaultHostPolicy=HostPolicy(requestsPerSecond=1e6, concurrency=1000))
+    try:
+        yield engine
+    finally:
+        engine.close()
+
+
+def processBody(req, body, sizeLimitHit, downloadStartTime, responseHeaders, status):
+    return status
+
+
+def requests(origin, n):
+    return [FetchRequest(i, ("%s/page/%s" % (origin.baseURL, i), "{}")) for i in range(n)]
+
+
+def test_empty_proxy_pool_fails_each_request(engine, mongo):
+    with StubOrigin(host="127.0.0.2") as origin:
+        assert engine.fetch(requests(origin, 20), processBody, ProxyPool(), maxAttempts=3) == {}
+        # the engine outlives the failed batch
+        assert engine.fetch(requests(origin, 20), processBody, maxAttempts=3) == {i: 200 for i in range(20)}
+
+
+class FeedbackDownPool(ProxyPool):
+    def feedback(self, address, counter=1, latencyMs=None, errorClass=None):
+        raise ConnectionError("feedback store is down")
+
+
+def test_raising_proxy_feedback_keeps_the_results(engine, mongo):
+    with StubOrigin(host="127.0.0.2") as origin, StubProxy() as proxy:
+        mongo.proxies.insert_one({"address": proxy.address, "successful_job_completion": 5})
+        results = engine.fetch(requests(origin, 20), processBody, FeedbackDownPool(), maxAttempts=3)
+    assert results == {i: 200 for i in range(20)}
+
+
+def test_fetch_returns_when_on_result_raises(engine):
+    handedOver = []
+
+    def onResult(req, result):
+        if req.key == 3:
+            raise ValueError("consumer went away")
+        handedOver.append(req.key)
+
+    with StubOrigin(host="127.0.0.2") as origin:
+        results = engine.fetch(requests(origin, 8), processBody, maxAttempts=3, onResult=onResult)
+    assert sorted(results) == sorted(handedOver) == [0, 1, 2, 4, 5, 6, 7]
@@ -0,0 +1,29 @@
+import asyncio
+
+import aiohttp
+import pytest
+import requests.exceptions
+import urllib3.exceptions
+
+from captcha_exception import CaptchaError
+from fetcherrors import classifyError
+
+
+@pytest.mark.parametrize("error, errorClass", [
+    (CaptchaError("captcha"), "captcha"),
+    (asyncio.TimeoutError(), "timeout"),
+    (requests.exceptions.ReadTimeout(), "timeout"),
+    (urllib3.exceptions.ReadTimeoutError(None, "http://example.com", "read timed out"), "timeout"),
+    (requests.exceptions.SSLError(), "ssl"),
+    (urllib3.exceptions.SSLError(), "ssl"),
+    (requests.exceptions.ProxyError(), "proxy"),
+    (urllib3.exceptions.ProxyError("proxy refused", OSError()), "proxy"),
+    (requests.exceptions.ChunkedEncodingError(), "connection"),
+    (urllib3.exceptions.ProtocolError("Connection broken", OSError()), "connection"),
+    (urllib3.exceptions.IncompleteRead(10, 100), "connection"),
+    (urllib3.exceptions.DecodeError("garbled gzip"), "connection"),
+    (aiohttp.ServerDisconnectedError(), "connection"),
+    (ValueError("bug"), "other"),
+])
+def test_classify_error(error, errorClass):
+    assert classifyError(error) == errorClass
@@ -0,0 +1,62 @@
+import time
+
+import data_service
+from captcha_exception import CaptchaError
+from fetchengine import AsyncFetchEngine, FetchRequest
+from hostscheduler import HostPolicy
+from stuborigin import StubOrigin
+
+CAPTCHA_ABOVE_RPS = 5
+NUM_SLOW_URLS = 20
+NUM_FAST_URLS = 200
+UNLIMITED = HostPolicy(requestsPerSecond=1e6, concurrency=1000, minRequestsPerSecond=1e6, baseBackoff=0)
+
+
+def processBody(req, body, sizeLimitHit, downloadStartTime, responseHeaders, status):
+    # xml output: buildPageEntry raises CaptchaError for captcha pages, which makes the engine retry
+    return data_service.buildPageEntry(req.urlTuple, "xml", body, sizeLimitHit, downloadStartTime, responseHeaders)
+
+
+def fetchBatch(slowPolicy):
+    '''
+    fetches from an origin that serves captchas above CAPTCHA_ABOVE_RPS and from a fast one in the same batch
+
+    :return: tuple(number of pages fetched, slow origin, seconds until the slow host was done, seconds until the fast
+        host was done, host stats of the engine)
+    '''
+    with StubOrigin(captchaAboveRps=CAPTCHA_ABOVE_RPS, host="127.0.0.2") as slowOrigin, \
+            StubOrigin(latency=0.01, host="127.0.0.3") as fastOrigin:
+        engine = AsyncFetchEngine(defaultHostPolicy=UNLIMITED, hostPolicies={"127.0.0.2": slowPolicy})
+        fetchRequests = [FetchRequest(url, (url, "{}")) for url in
+                         ["%s/page/%s" % (slowOrigin.baseURL, i) for i in range(NUM_SLOW_URLS)] +
+                         ["%s/page/%s" % (fastOrigin.baseURL, i) for i in range(NUM_FAST_URLS)]]
+        finished = {}
+        start = time.perf_counter()
+        try:
+            results = engine.fetch(fetchRequests, processBody, maxAttempts=50, retryOn=(CaptchaError,),
+                                   onResult=lambda req, result: finished.__setitem__(req.host, time.perf_counter()))
+            hostStats = engine.hostStats()
+        finally:
+            engine.close()
+    return len(results), slowOrigin, finished["127.0.0.2"] - start, finished["127.0.0.3"] - start, hostStats
+
+
+def test_configured_rate_stays_below_the_captcha_threshold():
+    policy = HostPolicy(requestsPerSecond=CAPTCHA_ABOVE_RPS * 0.8, concurrency=2)
+    fetched, slowOrigin, slowDuration, fastDuration, hostStats = fetchBatch(policy)
+    assert fetched == NUM_SLOW_URLS + NUM_FAST_URLS
+    # the origin counts the requests of the last second: no captcha means the rate never went above the threshold
+    assert slowOrigin.captchas == 0 and sum(slowOrigin.requestCounts.values()) == NUM_SLOW_URLS
+    assert slowDuration >= (NUM_SLOW_URLS - 1) / policy.requestsPerSecond * 0.9
+    assert hostStats["127.0.0.2"]["backoffs"] == 0
+    assert fastDuration < 2, "fast host waited %.1fs for the throttled one" % fastDuration
+
+
+def test_captchas_make_the_host_back_off():
+    policy = HostPolicy(requestsPerSecond=CAPTCHA_ABOVE_RPS * 4, concurrency=10, baseBackoff=0.5)
+    fetched, slowOrigin, _, fastDuration, hostStats = fetchBatch(policy)
+    assert fetched == NUM_SLOW_URLS + NUM_FAST_URLS
+    assert slowOrigin.captchas > 0 and hostStats["127.0.0.2"]["backoffs"] > 0
+    # every captcha costs a request, the backoff keeps them from piling up
+    assert sum(slowOrigin.requestCounts.values()) < NUM_SLOW_URLS * 3
+    assert fastDuration < 2, "fast host waited %.1fs for the throttled one" % fastDuration
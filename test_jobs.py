@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+from werkzeug.serving import make_server
+
+from stuborigin import StubOrigin
+from webcacheclient import WebCacheClient, dbNormalizeURL
+
+URLS_PER_JOB = 300
+
+
+@pytest.fixture
+def client(service, monkeypatch):
+    monkeypatch.setattr(service.jobRunner, "chunkSize", 100)
+    monkeypatch.setattr(service, "jobRunnerStarted", False)
+    server = make_server("127.0.0.1", 0, service.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield WebCacheClient("127.0.0.1:%s" % server.server_port)
+    finally:
+        service.jobRunner.stop()
+        server.shutdown()
+
+
+def waitUntilDone(client, jobIds, timeout=60):
+    deadline = time.monotonic() + timeout
+    while any(client.jobProgress(jobId)["state"] != "done" for jobId in jobIds):
+        assert time.monotonic() < deadline, "jobs not done after %ss" % timeout
+        time.sleep(0.2)
+
+
+def checkResults(client, jobId, urls):
+    progress = client.jobProgress(jobId)
+    counts = progress["counts"]
+    assert counts["pending"] == 0
+    assert counts["cached"] + counts["fetched"] + counts["failed"] == progress["total"] == len(urls)
+    results = list(client.iterJobResults(jobId, "json"))
+    assert [page["urlKey"] for page in results] == [dbNormalizeURL(url) for url in urls]
+    assert [page["seq"] for page in results] == list(range(1, len(urls) + 1))
+    assert len([page for page in results if page.get("error")]) == counts["failed"]
+    assert all(url.endswith(page["content"]["path"]) for url, page in zip(urls, results) if not page.get("error"))
+    return counts
+
+
+def test_overlapping_jobs_fetch_every_url_once(service, client):
+    with StubOrigin(host="127.0.0.2") as origin:
+        jobURLs = [["%s/page/%s" % (origin.baseURL, i) for i in range(job * URLS_PER_JOB // 2,
+                                                                      job * URLS_PER_JOB // 2 + URLS_PER_JOB)]
+                   for job in range(3)]
+        jobIds = [client.submitJob(urls, "test", "json", maxAgeDays=1) for urls in jobURLs]
+        waitUntilDone(client, jobIds)
+        for jobId, urls in zip(jobIds, jobURLs):
+            counts = checkResults(client, jobId, urls)
+            assert counts["failed"] == 0 and counts["cached"] + counts["fetched"] == URLS_PER_JOB
+    assert sum(origin.requestCounts.values()) == len({url for urls in jobURLs for url in urls})
+
+
+def test_job_of_a_crashed_worker_is_resumed(service, client, monkeypatch):
+    with StubOrigin(host="127.0.0.2") as origin:
+        urls = ["%s/crashed/%s" % (origin.baseURL, i) for i in range(URLS_PER_JOB)]
+        jobId = service.jobStore.submit({dbNormalizeURL(url): (url, "{}") for url in urls}, "GET", 1, "test", "json")
+        # a worker claims the job, gets through one chunk and dies without handing the job back
+        monkeypatch.setattr(service.jobStore, "leaseSeconds", 1)
+        service.jobRunner.runChunk(service.jobStore.claim("crashed-worker"), "crashed-worker")
+        assert client.jobProgress(jobId)["counts"]["pending"] == URLS_PER_JOB - 100
+        service.jobRunner.start()
+        waitUntilDone(client, [jobId])
+        counts = checkResults(client, jobId, urls)
+    # with a lease this short, two workers may end up on one chunk: the second one gets the pages as cached
+    assert counts["failed"] == 0 and counts["fetched"] + counts["cached"] == URLS_PER_JOB
+    assert sum(origin.requestCounts.values()) == URLS_PER_JOB
+
+
+def test_first_request_starts_the_job_workers(service, client, mongo):
+    assert service.jobRunner.stats()["workers"] == 0
+    assert service.app.test_client().get("/jobs/unknown").status_code == 404
+    assert service.jobRunner.stats()["workers"] == service.jobRunner.numWorkers
+    assert len(mongo.fetch_job_urls.index_information()) > 1
@@ -0,0 +1,33 @@
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from stuborigin import StubOrigin
+
+NUM_URLS = 200
+BATCH_SIZE = 100
+
+
+def test_overlapping_batches_fetch_every_url_once(service):
+    rand = random.Random(0)
+    with StubOrigin(latency=0.2, host="127.0.0.2") as origin:
+        batches = [[("%s/page/%s" % (origin.baseURL, i), "{}") for i in rand.sample(range(NUM_URLS), BATCH_SIZE)]
+                   for _ in range(8)]
+        with ThreadPoolExecutor(len(batches)) as executor:
+            results = list(executor.map(lambda batch: service.getData(batch, "GET", 1, "test", "json"), batches))
+    assert [len(pages) for pages in results] == [BATCH_SIZE] * len(batches)
+    assert not [page for pages in results for page in pages if "error" in page]
+    fetchedTwice = {path: count for path, count in origin.requestCounts.items() if count > 1}
+    assert not fetchedTwice
+    assert len(origin.requestCounts) == len({url for batch in batches for url, _ in batch})
+
+
+def test_abandoned_fetch_keeps_its_leases(service, monkeypatch):
+    monkeypatch.setattr(service, "FETCH_MAX_PENDING", 5)
+    with StubOrigin(latency=0.2, host="127.0.0.2") as origin:
+        urls = [("%s/page/%s" % (origin.baseURL, i), "{}") for i in range(50)]
+        abandoned = service.iterData(urls, "GET", 1, "test", "json")
+        next(abandoned)
+        abandoned.close()  # the reader goes away while most pages are still being downloaded
+        pages = service.getData(urls, "GET", 1, "test", "json")
+    assert len(pages) == len(urls) and not [page for page in pages if "error" in page]
+    assert set(origin.requestCounts.values()) == {1}
@@ -0,0 +1,19 @@
+import time
+
+from metrics import finishTrace, span, startTrace
+
+
+def test_span_leaves_out_paused_time():
+    def pages(stage):
+        for page in range(3):
+            with stage.paused():
+                yield page
+
+    startTrace("test")
+    with span("stage") as stage:
+        for _ in pages(stage):
+            time.sleep(0.1)  # a slow consumer of the pages
+    trace = finishTrace()
+    assert trace.asDict()["duration_ms"] >= 300
+    assert [recorded["name"] for recorded in trace.spans] == ["stage"]
+    assert trace.spans[0]["duration_ms"] < 100
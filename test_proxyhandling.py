@@ -0,0 +1,59 @@
+import random
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from fetcherrors import ERROR_CLASSES
+from proxyhandling import MIN_SCORE, SCORE_BOUNDS, FeedbackAggregator, ProxyPool
+
+NUM_PROXIES = 20
+
+
+def sendFeedback(aggregator, seed, numEvents):
+    rand = random.Random(seed)
+    sent = Counter()
+    for _ in range(numEvents):
+        address = "http://10.0.0.%s:8080" % rand.randrange(NUM_PROXIES)
+        if rand.random() < 0.5:
+            aggregator.add(address, 1, latencyMs=rand.uniform(50, 3000))
+            sent[(address, "successes")] += 1
+            sent[(address, "latency_count")] += 1
+        else:
+            aggregator.add(address, -1, errorClass=rand.choice(ERROR_CLASSES))
+            sent[(address, "failures")] += 1
+    return sent
+
+
+def test_feedback_flushed_concurrently_adds_up(mongo):
+    aggregator = FeedbackAggregator()
+    stopped = threading.Event()
+
+    def flushContinuously():
+        while not stopped.is_set():
+            aggregator.flush()
+
+    flusher = threading.Thread(target=flushContinuously)
+    flusher.start()
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            sent = sum(executor.map(lambda seed: sendFeedback(aggregator, seed, 1000), range(8)), Counter())
+    finally:
+        stopped.set()
+        flusher.join()
+    aggregator.flush()
+
+    stored = {proxy["address"]: proxy for proxy in mongo.proxies.find()}
+    assert aggregator.flushes > 1
+    assert {key: stored[key[0]].get(key[1], 0) for key in sent} == dict(sent)
+    assert all(SCORE_BOUNDS[0] <= proxy["successful_job_completion"] <= SCORE_BOUNDS[1] for proxy in stored.values())
+
+
+def test_pool_of_dropped_proxies_has_none_available(mongo):
+    mongo.proxies.insert_one({"address": "http://10.0.0.1:8080", "successful_job_completion": MIN_SCORE + 1})
+    pool = ProxyPool()
+    assert pool.pick() == "http://10.0.0.1:8080"
+    pool.feedback("http://10.0.0.1:8080", -1)
+    with pytest.raises(ValueError, match="no proxies available"):
+        pool.pick()
@@ -0,0 +1,52 @@
+import threading
+
+from fetchengine import FetchRequest
+from retryengine import RetryEngine
+
+
+def fetchInThread(engine, *args):
+    '''
+    :return: the result of engine.fetch(*args), None if it didn't return within 10s
+    '''
+    results = []
+    fetcher = threading.Thread(target=lambda: results.append(engine.fetch(*args)), daemon=True)
+    fetcher.start()
+    fetcher.join(10)
+    return results[0] if results else None
+
+
+def requests(n):
+    return [FetchRequest(i, ("http://127.0.0.2/page/%s" % i, "{}")) for i in range(n)]
+
+
+def test_fetch_returns_when_on_result_raises():
+    def onResult(req, result):
+        if req.key == 3:
+            raise ValueError("consumer went away")
+
+    results = fetchInThread(RetryEngine(4, 3), requests(8), lambda req, proxy, cancelled: req.key, None, onResult)
+    assert results is not None, "fetch hangs"
+    assert sorted(results) == [0, 1, 2, 4, 5, 6, 7]
+
+
+class FailingProxyPool:
+    def __init__(self, failingPicks):
+        self.failingPicks = failingPicks
+        self._lock = threading.Lock()
+
+    def pick(self):
+        with self._lock:
+            self.failingPicks -= 1
+            if self.failingPicks >= 0:
+                raise ValueError("no proxies available!")
+        return "http://127.0.0.3:8080"
+
+    def feedback(self, proxy, counter, latencyMs=None, errorClass=None):
+        raise ConnectionError("feedback store is down")
+
+
+def test_fetch_returns_when_the_proxy_pool_raises():
+    results = fetchInThread(RetryEngine(4, 3), requests(8), lambda req, proxy, cancelled: req.key,
+                            FailingProxyPool(2))
+    assert results is not None, "fetch hangs"
+    assert len(results) == 6  # picks that raise count as failed attempts of class "other", which are given up
@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+import pagecodecs
+from revalidation import RevalidationStats
+from stuborigin import StubOrigin
+
+
+def contents(pages):
+    return {page["urlKey"]: pagecodecs.decompress(page["content_raw"], page["codec"]) for page in pages}
+
+
+def test_expired_pages_are_revalidated(service, mongo, monkeypatch):
+    monkeypatch.setattr(service, "revalidationStats", RevalidationStats())
+    numURLs, numChanged = 50, 10
+    with StubOrigin(host="127.0.0.2", validators=True) as origin:
+        urls = [("%s/page/%s" % (origin.baseURL, i), "{}") for i in range(numURLs)]
+        first = contents(service.iterData(urls, "GET", 1, "test", "json"))
+        firstBytes = origin.bytesSent
+
+        mongo.webpages.update_many({}, {"$set": {"creation_date": datetime.now() - timedelta(days=2)}})
+        for i in range(numChanged):
+            origin.revisions["/page/%s" % i] = 1
+        revalidationStart = datetime.now()
+        second = contents(service.iterData(urls, "GET", 1, "test", "json"))
+
+    assert len(first) == len(second) == numURLs
+    changed = {urlKey for urlKey in first if first[urlKey] != second[urlKey]}
+    assert len(changed) == numChanged
+    assert origin.notModifiedCount == numURLs - numChanged
+    assert origin.bytesSent - firstBytes == sum(len(second[urlKey]) for urlKey in changed)
+    stats = service.revalidationStats.stats()
+    assert stats["conditional_requests"] == numURLs and stats["not_modified"] == numURLs - numChanged
+    assert stats["bytes_saved"] == sum(len(content) for urlKey, content in first.items() if urlKey not in changed)
+    assert mongo.webpages.count_documents({"creation_date": {"$lt": revalidationStart}}) == 0
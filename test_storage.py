@@ -0,0 +1,73 @@
+import os
+import signal
+import time
+
+import pymongo
+import pytest
+
+import storage
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_pool_metrics_usable_in_child_forked_while_lock_held():
+    storage.poolMetrics._lock.acquire()  # a pool listener callback running in another thread at fork time
+    try:
+        pid = os.fork()
+        if pid == 0:
+            storage.getClient()
+            os._exit(0 if storage.poolStats()["checkouts"] == 0 else 1)
+        deadline = time.monotonic() + 10
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        while not finished:
+            if time.monotonic() > deadline:
+                os.kill(pid, signal.SIGKILL)
+                pytest.fail("the forked child hangs on the pool metrics lock")
+            time.sleep(0.05)
+            finished, status = os.waitpid(pid, os.WNOHANG)
+    finally:
+        storage.poolMetrics._lock.release()
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def rejectingWrite(buffer, rejectedKey, times):
+    '''
+    _write of buffer that writes everything but rejectedKey and reports it as a duplicate key, the first times calls
+    '''
+    write = buffer._write
+    calls = []
+
+    def _write(docs, updates):
+        calls.append(list(docs))
+        if len(calls) > times or rejectedKey not in docs:
+            return write(docs, updates)
+        accepted = {key: doc for key, doc in docs.items() if key != rejectedKey}
+        if accepted or updates:
+            write(accepted, updates)
+        raise pymongo.errors.BulkWriteError({"writeErrors": [
+            {"index": list(docs).index(rejectedKey), "code": 11000, "errmsg": "E11000 duplicate key error"}]})
+
+    buffer._write = _write
+    return calls
+
+
+def test_bulk_write_buffer_writes_rejected_documents_again(mongo):
+    buffer = storage.BulkWriteBuffer("webpages", "urlKey", maxDelay=60)
+    calls = rejectingWrite(buffer, "b", times=1)
+    for key in "abc":
+        buffer.add({"urlKey": key, "size": 1})
+    buffer.flush()
+    assert calls == [["a", "b", "c"], ["b"]]
+    assert sorted(doc["urlKey"] for doc in mongo.webpages.find()) == ["a", "b", "c"]
+    stats = buffer.stats()
+    assert (stats["written"], stats["retried_writes"], stats["failed_writes"], stats["pending"]) == (3, 1, 0, 0)
+
+
+def test_bulk_write_buffer_counts_documents_rejected_twice(mongo):
+    buffer = storage.BulkWriteBuffer("webpages", "urlKey", maxDelay=60)
+    rejectingWrite(buffer, "b", times=2)
+    for key in "abc":
+        buffer.add({"urlKey": key, "size": 1})
+    buffer.flush()
+    assert sorted(doc["urlKey"] for doc in mongo.webpages.find()) == ["a", "c"]
+    stats = buffer.stats()
+    assert (stats["written"], stats["retried_writes"], stats["failed_writes"]) == (2, 1, 1)
@@ -0,0 +1,197 @@
+import io
+import json
+import random
+import string
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import furl
+import pytest
+
+import webcacheclient
+from stuborigin import StubOrigin
+from webcacheclient import FRAME_PREFIX, WebCacheClient, encodeFrame, readFrames
+
+HEADER = b'{"urlKey": "a"}'
+NUM_RANDOM_URLS = 5000
+
+# pieces of URLs that hit the corner cases of both url key implementations
+ALPHABET = string.ascii_letters + string.digits + "-._~!$&'()*+,;=:@/?#%[] éÄ"
+SCHEMES = ["http://", "https://", "HTTP://", "Https://"]
+HOSTS = ["a.com", "A.COM", "ex-1.org", "x_y.net", "1.2.3.4", "a..b", "ä.de", "[::1]", "u:p@a.com", "a.com."]
+PORTS = ["", "", "", ":80", ":8080", ":0", ":080", ":65536", ":"]
+PATHS = ["", "/", "/a/b/../c", "/x/./y", "//x//", "/%7E", "/%2e%2e/x", "/a%20b", "/%41", "/a/%2f/b", "/é", "/x/.."]
+QUERIES = ["", "?", "?a=1&b=2&a=3", "?q=%41%2f%zz+x", "?u=https://b.com/?c=d", "?a&a=", "?&&", "?=v", "?k=v=w",
+           "?%61=1&a=2", "?x=%e9", "?x=%C3%A9"]
+FRAGMENTS = ["", "", "", "#Frag", "#"]
+DATA = ["{}", "null", '{"A": 1, "b": [1, 2]}', '{"q": "Zürich"}']
+
+
+def referenceNormalizeURL(urlItem):
+    '''
+    dbNormalizeURL as it was before the fast path, kept verbatim as the reference
+    '''
+    theUrl, theData = (urlItem, {}) if type(urlItem) is str else (urlItem[0], json.loads(urlItem[1]))
+    try:
+        lowerLinkFurl = furl.furl(
+            theUrl.lower().strip().replace("https://", "http://"))  # consider http and https as EQUAL for the key
+        lowerLinkFurl.path.normalize()
+        lowerLinkFurl.query.params = sorted(
+            [(par, lowerLinkFurl.query.params[par]) for par in lowerLinkFurl.query.params],
+            key=lambda item: item[0])
+        lowerLinkFurl.path = "%s/" % lowerLinkFurl.path if not str(lowerLinkFurl.path).endswith(
+            "/") else lowerLinkFurl.path
+        lowerLink = lowerLinkFurl.url
+
+        if theData:
+            dataJSON = json.dumps(theData, sort_keys=True).lower()
+            lowerLink = f"{lowerLink}_{dataJSON}"
+
+        return lowerLink
+    except:
+        return None
+
+
+def randomText(rand, maxLength):
+    return "".join(rand.choice(ALPHABET) for _ in range(rand.randint(0, maxLength)))
+
+
+def randomQuery(rand):
+    if rand.random() < 0.5:
+        return rand.choice(QUERIES)
+    params = ["%s%s" % (randomText(rand, 4), rand.choice(["", "=", "=%s" % randomText(rand, 6)]))
+              for _ in range(rand.randint(1, 5))]
+    return "?%s" % "&".join(params)
+
+
+def randomURL(rand):
+    path = rand.choice(PATHS) if rand.random() < 0.5 else "/%s" % randomText(rand, 12)
+    url = "%s%s%s%s%s%s" % (rand.choice(SCHEMES), rand.choice(HOSTS), rand.choice(PORTS), path, randomQuery(rand),
+                            rand.choice(FRAGMENTS))
+    if rand.random() < 0.1:
+        url = " %s\n" % url
+    return url if rand.random() < 0.8 else (url, rand.choice(DATA))
+
+
+def realisticURL(rand):
+    # the kind of URL the service mostly sees, so the fast path gets its share of the checks
+    path = "/".join(rand.choice(["search", "Wiki", "a-b", "x_y", "1.html", "%20", "~user"])
+                    for _ in range(rand.randint(0, 4)))
+    params = ["%s=%s" % (rand.choice(["q", "Page", "format", "lang", "id"]),
+                         rand.choice(["1", "json", "en", "Hello+World", "a.b", "x%2Fy", ""]))
+              for _ in range(rand.randint(0, 4))]
+    return "%s%s/%s%s" % (rand.choice(SCHEMES), rand.choice(["example.com", "nominatim.openstreetmap.org"]), path,
+                          "?%s" % "&".join(params) if params else "")
+
+
+# the fast key has to be the furl key: otherwise the pages stored in Mongo are not found anymore
+@pytest.mark.parametrize("url", [
+    "http://ä.de/é?x=%C3%A9", "http://xn--4ca.de/", "https://A.COM/%7E/a%20b/%2e%2e/x?q=%41%2f%zz+x",
+    "http://a.com/x?", "http://a.com/x?&&", "http://a.com/x?a&a=", "http://a.com:8080/x#Frag", "http://a.com/x#",
+    "http://a.com/a/b/../c/?b=2&a=1&a=3", " HTTP://u:p@a.com./%41\n", ("http://a.com/q", '{"q": "Zürich", "A": 1}')])
+def test_url_key_edge_cases_match_the_furl_key(url):
+    assert webcacheclient.dbNormalizeURL(url) == referenceNormalizeURL(url)
+
+
+def test_random_url_keys_match_the_furl_key():
+    rand = random.Random(0)
+    urls = [randomURL(rand) if rand.random() < 0.5 else realisticURL(rand) for _ in range(NUM_RANDOM_URLS)]
+    mismatches = [(url, key, expected) for url, key, expected in
+                  ((url, webcacheclient.dbNormalizeURL(url), referenceNormalizeURL(url)) for url in urls)
+                  if key != expected]
+    assert not mismatches, mismatches[:10]
+    fastPath = [url for url in urls if webcacheclient._fastNormalizeURL(
+        (url if type(url) is str else url[0]).lower().strip().replace("https://", "http://")) is not None]
+    assert len(fastPath) > NUM_RANDOM_URLS // 4  # the fast path gets its share of the checks
+
+
+def frame(header, blob):
+    return b"".join(encodeFrame(header, blob))
+
+
+def test_read_frames_ends_with_the_stream():
+    stream = io.BytesIO(frame(HEADER, b"page a") + frame(b'{"urlKey": "b"}', b""))
+    assert list(readFrames(stream)) == [({"urlKey": "a"}, b"page a"), ({"urlKey": "b"}, b"")]
+
+
+# inside the prefix, right after the prefix, right after the header
+@pytest.mark.parametrize("cut", [3, FRAME_PREFIX.size, FRAME_PREFIX.size + len(HEADER)])
+def test_read_frames_rejects_a_truncated_frame(cut):
+    complete = frame(HEADER, b"page a")
+    with pytest.raises(ValueError):
+        list(readFrames(io.BytesIO(complete + complete[:cut])))
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    '''
+    serves a WSGI app over keep-alive connections, which werkzeug's server always closes. Buffers every response
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self._serve()
+
+    def do_POST(self):
+        self._serve()
+
+    def _serve(self):
+        stats = self.server.requestStats
+        with stats["lock"]:
+            stats["requests"] += 1
+            stats["gzipped"] += self.headers.get("Content-Encoding") == "gzip"
+            stats["connections"].add(self.client_address)
+            stats["inFlight"] += 1
+            stats["maxInFlight"] = max(stats["maxInFlight"], stats["inFlight"])
+        try:
+            path, _, query = self.path.partition("?")
+            environ = {"REQUEST_METHOD": self.command, "PATH_INFO": path, "QUERY_STRING": query,
+                       "SERVER_NAME": "127.0.0.1", "SERVER_PORT": str(self.server.server_port),
+                       "SERVER_PROTOCOL": self.protocol_version, "wsgi.version": (1, 0), "wsgi.url_scheme": "http",
+                       "wsgi.input": io.BytesIO(self.rfile.read(int(self.headers.get("Content-Length", 0)))),
+                       "wsgi.errors": io.StringIO(), "wsgi.multithread": True, "wsgi.multiprocess": False,
+                       "wsgi.run_once": False, "CONTENT_TYPE": self.headers.get("Content-Type", ""),
+                       "CONTENT_LENGTH": self.headers.get("Content-Length", "")}
+            environ.update(("HTTP_%s" % name.upper().replace("-", "_"), value) for name, value in self.headers.items()
+                           if name.lower() not in ("content-type", "content-length"))
+            response = []
+            body = b"".join(self.server.app(environ, lambda status, headers: response.extend([status, headers])))
+            status, headers = response
+            self.send_response(int(status.split()[0]))
+            for name, value in headers:
+                if name.lower() not in ("content-length", "transfer-encoding", "connection"):
+                    self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with stats["lock"]:
+                stats["inFlight"] -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_client_sends_batches_in_parallel_over_reused_connections(service, monkeypatch):
+    monkeypatch.setattr(webcacheclient, "GZIP_REQUEST_MIN_BYTES", 1024)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    server.daemon_threads = True
+    server.app = service.app
+    server.requestStats = stats = {"lock": threading.Lock(), "requests": 0, "gzipped": 0, "connections": set(),
+                                   "inFlight": 0, "maxInFlight": 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with StubOrigin(host="127.0.0.2") as origin, \
+                WebCacheClient("127.0.0.1:%s" % server.server_port, batchSize=100, parallelBatches=3) as client:
+            urls = ["%s/page/%s" % (origin.baseURL, i) for i in range(600)]
+            for _ in range(2):  # fetched, then served from the cache
+                pages = list(client.iterFetchURLs(urls, "test", "json"))
+                assert sorted(url for url, _ in pages) == sorted(urls)
+                assert all(url.endswith(page["content"]["path"]) and "error" not in page for url, page in pages)
+            byURL = client.fetchURLs(urls + urls[:10], "test", "json")
+            assert list(byURL) == urls and all(url.endswith(byURL[url]["content"]["path"]) for url in urls)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert stats["requests"] == 3 * len(urls) // 100
+    assert stats["gzipped"] == stats["requests"] and stats["maxInFlight"] == 3
+    assert len(stats["connections"]) == 3  # one per batch in flight, reused by the batches after it
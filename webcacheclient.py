@@ -1,18 +1,76 @@
-import base64
-import bz2
+import functools
+import gzip
 import json
 import os
 import pickle
+import re
+import struct
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
+from urllib.parse import quote, quote_plus, unquote, unquote_plus, urlencode
 
 import furl
 import requests
+from requests.adapters import HTTPAdapter
+
+import pagecodecs
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+FRAMES_MIMETYPE = "application/x-webcache-frames"
+# clients list the page codecs they read in this request header. In the JSON and NDJSON responses of /fetch, pages in
+# other codecs come recompressed under content_raw_bz2, the field clients from before the codecs read
+CODECS_HEADER = "X-Webcache-Codecs"
+# distinct blobs a framed response may refer back to, the data service and the client keep the same window
+CONTENT_REF_WINDOW = 1000
+FRAME_PREFIX = struct.Struct(">II")
+
+# connections kept open to the data service, and connect / read timeouts of a request. The read timeout is the
+# longest the service may go without sending anything while it fetches pages
+SESSION_POOL_SIZE = 10
+CONNECT_TIMEOUT_S = 10
+READ_TIMEOUT_S = 600
+# url lists longer than this go to the service in several batches, up to PARALLEL_BATCHES of them at a time
+BATCH_SIZE = 2000
+PARALLEL_BATCHES = 4
+GZIP_REQUEST_MIN_BYTES = 8 * 1024
+JOB_POLL_INTERVAL_S = 5
 
 
 class WebCacheClient: # add constructor to set webcache location programmatically. fall back to config if no explicit location provided
+    '''
+    client of the data service. Keeps a pool of keep-alive connections to it, share one client between threads
+    instead of creating one per call, and close() it (or use it as a context manager) when done.
+
+    :param location: host:port of the data service, None -> from ~/.labscape.env or WEBCACHE_LOCATION
+    :param poolSize: maximal number of connections kept open to the data service
+    :param connectTimeout: seconds to wait for a connection to the data service
+    :param readTimeout: seconds the data service may stay silent during a request
+    :param batchSize: url lists longer than this are split into batches sent to the service concurrently
+    :param parallelBatches: maximal number of batches in flight at a time
+    :param gzipRequests: gzip request bodies of more than GZIP_REQUEST_MIN_BYTES. Needs a data service that accepts
+        them (Content-Encoding: gzip)
+    '''
     WEBCACHE_LOCATION = "localhost:9011"
 
-    def __init__(self):
+    def __init__(self, location: str = None, poolSize: int = SESSION_POOL_SIZE,
+                 connectTimeout: float = CONNECT_TIMEOUT_S, readTimeout: float = READ_TIMEOUT_S,
+                 batchSize: int = BATCH_SIZE, parallelBatches: int = PARALLEL_BATCHES, gzipRequests: bool = True):
+        self.timeout = (connectTimeout, readTimeout)
+        self.batchSize = batchSize
+        self.parallelBatches = parallelBatches
+        self.gzipRequests = gzipRequests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=poolSize, pool_maxsize=max(poolSize, parallelBatches))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip"
+        self.session.headers[CODECS_HEADER] = ", ".join(pagecodecs.CODECS)
+        if location is not None:
+            self.WEBCACHE_LOCATION = location
+            return
+
         expectedEnvLocation = "%s/.labscape.env" % expanduser("~") #it's probably better to specify the webcache IP in the file rather than the env name
         if os.path.exists(expectedEnvLocation):
             with open(expectedEnvLocation, "r") as fi:
@@ -25,6 +83,15 @@ class WebCacheClient: # add constructor to set webcache location programmaticall
                     print("using docker-environment for cache")
                     self.WEBCACHE_LOCATION = "webcache:9011"
 
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def getProxyList(self, numProxies: int = 1000):
         '''
         gets list of proxies from data service. Some of the proxies might not work, but the probability of having a
@@ -39,7 +106,7 @@ class WebCacheClient: # add constructor to set webcache location programmaticall
             return []
         else:
             serviceURL = "http://%s/proxies/%s" % (self.WEBCACHE_LOCATION, numProxies)
-            data = requests.get(serviceURL).json()
+            data = self.session.get(serviceURL, timeout=self.timeout).json()
             if data is not None and "response" in data:
                 return data["response"]
             else:
@@ -56,6 +123,163 @@ class WebCacheClient: # add constructor to set webcache location programmaticall
         :param maxAgeDays: maximum age of page in cache in days. If a URL has been cached longer ago than these days, it is fetched again
         :return: dictionary where input url's are mapped to cache-result. available fields in cache-result-dict: content, size, url, format, creation_date, urlKey
         '''
+        filteredUrlList = self._prepareRequest(urlList, output, method)
+
+        if any('localhost' in url[0] or '127.0.0.1' in url[0] for url in filteredUrlList):
+            data = {}
+            for url in filteredUrlList:
+                data[url[0]] = {'content': self.session.get(url[0], timeout=self.timeout).json()}
+            return data
+
+        pages = dict(self.iterFetchURLs(urlList, category, output, method, maxAgeDays))
+        return {urlItem: pages[urlItem] for urlItem in urlList}
+
+    def iterFetchURLs(self, urlList, category: str, output, method="GET", maxAgeDays=360):
+        '''
+        same as fetchURLs, but streams the response of the data service and yields every page as soon as the service
+        has it. Only one page is decoded and held in memory at a time, unless the list is longer than batchSize: then
+        its batches are sent concurrently and up to parallelBatches batches are held, to be yielded in order.
+
+        :return: generator of tuples (input url, cache-result) in the order the service serves them. Input url's the
+        service could not obtain are yielded last with an error-result
+        '''
+        filteredUrlList = self._prepareRequest(urlList, output, method)
+        if any('localhost' in url[0] or '127.0.0.1' in url[0] for url in filteredUrlList):
+            yield from self.fetchURLs(urlList, category, output, method, maxAgeDays).items()
+            return
+
+        urlItemsByKey = {}
+        for urlItem in urlList:
+            urlItemsByKey.setdefault(dbNormalizeURL(urlItem), []).append(urlItem)
+        urlTuplesByKey = {}
+        for urlTuple in filteredUrlList:
+            urlTuplesByKey.setdefault(dbNormalizeURL(urlTuple), urlTuple)  # one url per key, the service dedups anyway
+        urlTuples = list(urlTuplesByKey.values())
+        batches = [urlTuples[i:i + self.batchSize] for i in range(0, len(urlTuples), self.batchSize)]
+
+        serviceURL = "http://%s/fetch/%s/%s/%s/%s" % (self.WEBCACHE_LOCATION, maxAgeDays, category, output, method)
+        pages = self._iterBatches(serviceURL, batches, output) if len(batches) > 1 else \
+            self._iterBatch(serviceURL, urlTuples, output)
+        for pageData in pages:
+            for urlItem in urlItemsByKey.pop(pageData["urlKey"], []):
+                yield urlItem, pageData
+
+        for urlItems in urlItemsByKey.values():
+            for urlItem in urlItems:
+                yield urlItem, {"url": urlItem, "content": None, "error": True}
+
+    def submitJob(self, urlList, category: str, output, method="GET", maxAgeDays=360) -> str:
+        '''
+        hands a list of url's of any length to the data service, which fetches it in the background. Follow it with
+        jobProgress and read the pages with iterJobResults, also after a restart of the service or of the caller.
+
+        :return: job id
+        '''
+        filteredUrlList = self._prepareRequest(urlList, output, method)
+        serviceURL = "http://%s/jobs/%s/%s/%s/%s" % (self.WEBCACHE_LOCATION, maxAgeDays, category, output, method)
+        body, headers = self._encodeURLs(filteredUrlList)
+        response = self.session.post(serviceURL, body, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["job"]
+
+    def jobProgress(self, jobId: str) -> dict:
+        '''
+        :return: dict with state ("pending", "running" or "done"), total number of unique url's and counts of the
+            url's per state ("pending", "cached", "fetched", "failed")
+        '''
+        response = self.session.get("http://%s/jobs/%s" % (self.WEBCACHE_LOCATION, jobId), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def iterJobResults(self, jobId: str, output, after: int = 0, wait: bool = True,
+                       pollInterval: float = JOB_POLL_INTERVAL_S):
+        '''
+        :param after: "seq" of the last result already read, to continue where an earlier call stopped
+        :param wait: wait for the job to finish, otherwise stop after the results that are ready
+        :return: generator of cache-results, one per unique url key in the order of the submitted list. Each has its
+            position "seq"; url's that could not be obtained come as error-results with "url" and "error"
+        '''
+        while True:
+            state = self.jobProgress(jobId)["state"]  # asked first: once done, every result is ready to be read
+            serviceURL = "http://%s/jobs/%s/results" % (self.WEBCACHE_LOCATION, jobId)
+            with self.session.get(serviceURL, params={"after": after}, headers={"Accept": FRAMES_MIMETYPE},
+                                  stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                for pageData, blob in resolveContentRefs(readFrames(response.raw)):
+                    after = pageData["seq"]
+                    if "error" in pageData:
+                        yield {"url": pageData["urlTuple"], "urlKey": pageData["urlKey"], "seq": pageData["seq"],
+                               "content": None, "error": True}
+                        continue
+                    yield self._decodeContent(pageData, pageData.pop("content_field"), blob, output)
+            if state == "done" or not wait:
+                return
+            time.sleep(pollInterval)
+
+    def fetchURLsWithJob(self, urlList, category: str, output, method="GET", maxAgeDays=360):
+        '''
+        same as fetchURLs, through a job: no request has to last until the whole list is fetched
+        '''
+        jobId = self.submitJob(urlList, category, output, method, maxAgeDays)
+        pages = {page["urlKey"]: page for page in self.iterJobResults(jobId, output)}
+        return {urlItem: pages.get(dbNormalizeURL(urlItem), {"url": urlItem, "content": None, "error": True})
+                for urlItem in urlList}
+
+    def _encodeURLs(self, urlTuples):
+        '''
+        :return: tuple(request body, headers) of a form with the url list, gzipped if it is large
+        '''
+        body = urlencode({"urls": json.dumps(urlTuples)}).encode()
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self.gzipRequests and len(body) > GZIP_REQUEST_MIN_BYTES:
+            body = gzip.compress(body, 5)
+            headers["Content-Encoding"] = "gzip"
+        return body, headers
+
+    def _iterBatches(self, serviceURL, batches, output):
+        with ThreadPoolExecutor(self.parallelBatches) as executor:
+            inFlight = deque()
+            for batch in batches:
+                inFlight.append(executor.submit(lambda batch: list(self._iterBatch(serviceURL, batch, output)), batch))
+                if len(inFlight) >= self.parallelBatches:
+                    yield from inFlight.popleft().result()
+            while inFlight:
+                yield from inFlight.popleft().result()
+
+    def _iterBatch(self, serviceURL, urlTuples, output):
+        '''
+        :return: generator of the decoded pages the service sends for one batch, without the error records
+        '''
+        body, headers = self._encodeURLs(urlTuples)
+        headers["Accept"] = FRAMES_MIMETYPE
+        with self.session.post(serviceURL, body, headers=headers, stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+            if not response.headers.get("Content-Type", "").startswith(FRAMES_MIMETYPE):
+                raise ValueError("cache could not obtain data. Error: %s" % response.json().get("error"))
+            response.raw.decode_content = True  # in case something on the way gzipped the frames
+            for pageData, blob in resolveContentRefs(readFrames(response.raw)):
+                if "error" in pageData:
+                    continue
+                yield self._decodeContent(pageData, pageData.pop("content_field"), blob, output)
+
+    def _decodeContent(self, pageData, target_field, blob, output):
+        try:
+            return decodeContent(pageData, target_field, blob, output)
+        except pagecodecs.UnknownCodecError as e:
+            if e.dictId is None:
+                raise
+            self._loadDictionary(e.dictId)
+            return decodeContent(pageData, target_field, blob, output)
+
+    def _loadDictionary(self, dictId):
+        response = self.session.get("http://%s/dictionaries/%s" % (self.WEBCACHE_LOCATION, dictId),
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        if pagecodecs.registerDictionary(response.content) != dictId:
+            raise ValueError("data service sent a corrupt dictionary %s" % dictId)
+
+    def _prepareRequest(self, urlList, output, method):
         if output.lower() not in ["json", "xml"]:
             raise ValueError("output-field must be either JSON or XML")
 
@@ -70,62 +294,208 @@ class WebCacheClient: # add constructor to set webcache location programmaticall
                 filteredUrlList.append(urlTuple)
             else:
                 print("invalid URL supplied to cache: %s. will ignore it" % urlTuple[0])
+        return filteredUrlList
 
-        serviceURL = "http://%s/fetch/%s/%s/%s/%s" % (self.WEBCACHE_LOCATION, maxAgeDays, category, output, method)
-        if any('localhost' in url[0] or '127.0.0.1' in url[0] for url in filteredUrlList):
-            data = {}
-            for url in filteredUrlList:
-                data[url[0]] = {'content':requests.get(url[0]).json()}
-            return data
-        else:
-            data = requests.post(serviceURL, {"urls": json.dumps(filteredUrlList)}).json()
 
-        if "error" in data:
-            raise ValueError("cache could not obtain data. Error: %s" % data["error"])
-        else:
-            urlKeys = {}
-            for pageData in data["response"]:
-                target_field = "content_bz2" if "content_bz2" in pageData and pageData[
-                    "content_bz2"] is not None else "content_raw_bz2"
-                if target_field in pageData:
-                    b64decoded = base64.b64decode(pageData[target_field][2:])
-                    decompressed = bz2.decompress(b64decoded)
-                    if target_field != "content_bz2":
-                        print("we could not parse url %s into %s" % (dbNormalizeURL(pageData["urlTuple"]), output))
-                        pageData["content"] = decompressed
-                    else:
-                        pageData["content"] = pickle.loads(decompressed)
-                    del pageData[target_field]
-                    urlKeys[pageData["urlKey"]] = pageData
-                else:
-                    print("there was a problem processing URL %s" % pageData["url"])
-
-            return {urlItem: urlKeys.get(dbNormalizeURL(urlItem), {"url": urlItem, "content": None, "error": True})
-                    for urlItem in urlList}
+class CachedPage(dict):
+    '''
+    cache-result of a page stored as raw bytes. "content" is parsed (JSON or BeautifulSoup object) on first access,
+    the raw bytes are available as `raw`.
+    '''
+
+    def __init__(self, pageData, raw: bytes, output: str):
+        super().__init__(pageData)
+        self.raw = raw
+        self.output = output
+
+    def __missing__(self, key):
+        if key != "content":
+            raise KeyError(key)
+        self["content"] = self._parse()
+        return self["content"]
+
+    def __contains__(self, key):
+        return key == "content" or super().__contains__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def _parse(self):
+        try:
+            if self.output.lower() == "json":
+                return json.loads(self.raw)
+            from bs4 import BeautifulSoup
+            return BeautifulSoup(self.raw, "lxml")
+        except ValueError:
+            print("we could not parse url %s into %s" % (self.get("urlKey"), self.output))
+            return self.raw
+
+
+def decodeContent(pageData, target_field, blob, output):
+    decompressed = pagecodecs.decompress(blob, pageData.get("codec", "bz2"))
+    if target_field == "content_bz2":  # pages cached before raw storage hold a pickled soup / JSON object
+        pageData["content"] = pickle.loads(decompressed)
+        return pageData
+    if "cancelled" in pageData:
+        print("we could not parse url %s into %s" % (dbNormalizeURL(pageData["urlTuple"]), output))
+        pageData["content"] = decompressed
+        return pageData
+    return CachedPage(pageData, decompressed, output)
+
+
+def encodeFrame(header: bytes, blob: bytes):
+    '''
+    one record of the binary transport: 8 byte prefix with the lengths of header and blob, the JSON header and the raw
+    blob. Returned as separate chunks so the blob is never copied.
+    '''
+    return FRAME_PREFIX.pack(len(header), len(blob)) + header, blob
+
+
+def readFrames(stream):
+    '''
+    :param stream: file-like object with a read(n) method
+    :return: generator of tuples (header dict, blob bytes)
+    '''
+    while True:
+        prefix = _readExactly(stream, FRAME_PREFIX.size, allowEOF=True)
+        if not prefix:
+            return
+        headerLength, blobLength = FRAME_PREFIX.unpack(prefix)
+        yield json.loads(_readExactly(stream, headerLength)), _readExactly(stream, blobLength)
+
+
+def resolveContentRefs(frames, window: int = CONTENT_REF_WINDOW):
+    '''
+    the data service sends a content blob once as long as it is among the last CONTENT_REF_WINDOW distinct blobs of
+    the response: later pages with the same content_hash come with content_field "content_ref" and an empty blob.
+    Fills those in from the blob sent first, keeping the same window of blobs as the service.
+
+    :param frames: iterable of tuples (header dict, blob bytes) as returned by readFrames
+    :return: generator of the same tuples with every reference replaced by the blob it refers to
+    '''
+    blobsByHash = OrderedDict()  # the least recently used first, like blobstore.ResponseBlobs.sent
+    for pageData, blob in frames:
+        hashValue = pageData.get("content_hash")
+        if pageData.get("content_field") == "content_ref":
+            blob, pageData["content_field"], pageData["codec"] = blobsByHash[hashValue]
+            blobsByHash.move_to_end(hashValue)
+        elif hashValue and "error" not in pageData:
+            blobsByHash[hashValue] = (blob, pageData["content_field"], pageData.get("codec"))
+            blobsByHash.move_to_end(hashValue)
+            if len(blobsByHash) > window:
+                blobsByHash.popitem(last=False)
+        yield pageData, blob
+
+
+def _readExactly(stream, n, allowEOF=False):
+    '''
+    :param allowEOF: return b"" if the stream ended before the first byte, i.e. between two frames
+    '''
+    data = stream.read(n)
+    if len(data) == n or (allowEOF and len(data) == 0):
+        return data
+    parts = [data]
+    missing = n - len(data)
+    while missing > 0:
+        part = stream.read(missing)
+        if not part:
+            raise ValueError("data service closed the stream in the middle of a frame")
+        parts.append(part)
+        missing -= len(part)
+    return b"".join(parts)
 
 
 def isValidURL(url):
     return type(url) == str and len(url.strip()) > 0 and url.startswith("http")
 
 
+URL_KEY_CACHE_SIZE = 100000
+
+# the subset of URLs _fastNormalizeURL handles: plain ascii http URLs without user info, fragment or dot segments.
+# everything else takes the furl route
+FAST_URL_PATTERN = re.compile(r"http://(?P<host>[a-z0-9_-]+(?:\.[a-z0-9_-]+)*)(?::(?P<port>[0-9]{1,5}))?"
+                              r"(?P<path>/[a-z0-9!$&'()*+,\-./:;=@_~%]*)?(?:\?(?P<query>[a-z0-9&=+\-._~%]*))?")
+ESCAPE_PATTERN = re.compile(r"%(?![0-9a-f]{2})")
+PATH_SAFE = "!$&'()*+,;=:@"
+
+
 def dbNormalizeURL(urlItem):
-    theUrl, theData = (urlItem, {}) if type(urlItem) is str else (urlItem[0], json.loads(urlItem[1]))
+    '''
+    the key a url is stored under: lower case, http and https are equal, dot segments resolved, query parameters sorted
+    and the (lower cased) request data appended for POST requests.
+
+    :param urlItem: url string or tuple (url, json data)
+    '''
+    if type(urlItem) is str:
+        return _normalizeURLKey(urlItem, None)
+    return _normalizeURLKey(urlItem[0], urlItem[1])
+
+
+@functools.lru_cache(maxsize=URL_KEY_CACHE_SIZE)
+def _normalizeURLKey(theUrl, dataJson):
+    theData = json.loads(dataJson) if dataJson is not None else {}
+    lowerLink = theUrl.lower().strip().replace("https://", "http://")  # consider http and https as EQUAL for the key
+    lowerLink = _fastNormalizeURL(lowerLink) or _furlNormalizeURL(lowerLink)
+    if lowerLink is None:
+        print("COULD NOT DB NORM URL %s" % theUrl)
+        return None
+
+    if theData:
+        dataJSON = json.dumps(theData, sort_keys=True).lower()
+        lowerLink = f"{lowerLink}_{dataJSON}"
+
+    return lowerLink
+
+
+def _fastNormalizeURL(lowerLink):
+    '''
+    urllib.parse version of _furlNormalizeURL for the URLs matching FAST_URL_PATTERN.
+
+    :return: the same string _furlNormalizeURL returns, or None if the url is not one of them
+    '''
+    match = FAST_URL_PATTERN.fullmatch(lowerLink)
+    if match is None or ESCAPE_PATTERN.search(lowerLink):
+        return None
+    host, port, path, query = match.group("host", "port", "path", "query")
+    if port is not None:
+        if not 0 < int(port) < 65536:
+            return None
+        port = "" if int(port) == 80 else ":%s" % int(port)
+
+    segments = []
+    for segment in (path or "").split("/"):
+        segment = unquote(segment)
+        if segment in (".", "..") or "/" in segment or not segment.isascii():
+            return None
+        if segment:
+            segments.append(quote(segment, safe=PATH_SAFE))
+    path = "/%s/" % "/".join(segments) if segments else "/"
+
+    params = {}
+    for param in query.split("&") if query else []:
+        key, separator, value = param.partition("=")
+        if not key:
+            return None
+        key = unquote_plus(key)
+        if key not in params:
+            params[key] = unquote_plus(value) if separator else None
+    if not all(key.isascii() and (value is None or value.isascii()) for key, value in params.items()):
+        return None
+    query = "&".join(quote_plus(key, safe="") if value is None else
+                     "%s=%s" % (quote_plus(key, safe=""), quote_plus(value, safe=""))
+                     for key, value in sorted(params.items(), key=lambda item: item[0]))
+    return "http://%s%s%s%s" % (host, port or "", path, "?%s" % query if query else "")
+
+
+def _furlNormalizeURL(lowerLink):
     try:
-        lowerLinkFurl = furl.furl(
-            theUrl.lower().strip().replace("https://", "http://"))  # consider http and https as EQUAL for the key
+        lowerLinkFurl = furl.furl(lowerLink)
         lowerLinkFurl.path.normalize()
         lowerLinkFurl.query.params = sorted(
             [(par, lowerLinkFurl.query.params[par]) for par in lowerLinkFurl.query.params],
             key=lambda item: item[0])
         lowerLinkFurl.path = "%s/" % lowerLinkFurl.path if not str(lowerLinkFurl.path).endswith(
             "/") else lowerLinkFurl.path
-        lowerLink = lowerLinkFurl.url
-
-        if theData:
-            dataJSON = json.dumps(theData, sort_keys=True).lower()
-            lowerLink = f"{lowerLink}_{dataJSON}"
-
-        return lowerLink
+        return lowerLinkFurl.url
     except:
-        print("COULD NOT DB NORM URL %s" % theUrl)
         return None